@@ -1,6 +1,9 @@
 # - Utility tools for CLI based "TUI"
 # Peter Walker, April 2022
 
+import csv
+import json
+import os
 from string import punctuation
 
 TITLE = "Command Line Utilities"
@@ -49,6 +52,20 @@ def get_number(prompt='number'):
             return int(n[0].strip(punctuation))
 
 
+def read_records(filename):
+    """
+    Reads rows from a file for non-interactive use, e.g. a batch of connections or a routing map
+    :param filename: str - .json file of a list of objects, or CSV file with a header row
+    :return: list of dicts, one per row, (CSV column names stripped & lower case)
+    """
+    if os.path.splitext(filename)[1].lower() == ".json":
+        with open(filename) as f:
+            return json.load(f)
+    with open(filename, newline='') as f:
+        return [{key.strip().lower(): value for key, value in record.items() if key}
+                for record in csv.DictReader(f)]
+
+
 if __name__ == '__main__':
     print_header(TITLE, VERSION)
 
@@ -10,7 +10,10 @@ import threading
 
 import cli_utils
 import swp_utils
-from swp_unpack import unpack_data as swp
+from receive_queue import ReceiveQueue
+from swp_message import FrameWriter, PushLabels
+from swp_pipeline import PipelinedSender, DEFAULT_WINDOW
+from swp_unpack import SwpStreamParser
 
 # - V02 - add timestamps to messaging
 # - and a log, though that should maybe be in the router
@@ -28,17 +31,29 @@ RECEIVE_TIMEOUT = 10
 
 
 class Connection:
-    def __init__(self, ip_address, log=None):
+    def __init__(self, ip_address, log=None, window=DEFAULT_WINDOW, port=swp_utils.PORT,
+                 ack_timeout=swp_utils.ACK_TIMEOUT, max_send_attempts=swp_utils.MAX_SEND_ATTEMPTS):
+        """
+        :param window: int - max messages in flight when using send_pipelined
+        :param ack_timeout: float - seconds to wait for an ACK/NAK before resending, when using send_pipelined
+        :param max_send_attempts: int - number of times to send before failing, when using send_pipelined
+        """
         self.address = ip_address
-        self.port = swp_utils.PORT
+        self.port = port
         self.sock = None
         self.status = 'Starting'
+        self.connected = threading.Event()  # - Set while connected, for callers to wait on (see wait_connected)
 
-        # Received message buffer
-        self._messages = []
-        self._residual_data = False
-        # Residual data is received data that cannot be parsed but might be the beginning of a message
+        # Received message buffer, get_message can block waiting on it rather than polling
+        self._messages = ReceiveQueue()
+        # Parses received data, holding on to any data that might be the beginning of a message
         # whose remainder is in the next chunk of data to be received
+        self._parser = SwpStreamParser()
+        # Sends messages with up to window messages awaiting ACK, ACK/NAKs are passed to it by the receive thread
+        self._pipeline = PipelinedSender(self._write, window, ack_timeout, max_send_attempts)
+        # Functions called by the receive thread with (timestamp, message bytes) for each message received,
+        # (other than ACK/NAK), e.g. RouterMirror.on_message to keep a local copy of the router's state
+        self._listeners = []
 
         # - I'm logging sent messages here in the connection to timestamp them at point of send
         # - but I'm not logging the received messages here... received get timestamped and put into a buffer
@@ -68,11 +83,12 @@ class Connection:
             # self.sock.connect((self.address, self.port))
             #self.sock.connect((self.address, swp_utils.PORT))
             self.sock.connect((self.address, self.port))
-            print('[Connection]: Connection established with address {} on port {}'.format(self.address, swp_utils.PORT))
+            print('[Connection]: Connection established with address {} on port {}'.format(self.address, self.port))
 
             # I just have to send any message, not this one specifically)
             # TODO - ping device / request some data
             self.status = "Connected"
+            self.connected.set()
 
         except socket.timeout:
             print('[Connection]: socket timeout - Failed to create connection with address {} on port {}'.format(
@@ -107,25 +123,36 @@ class Connection:
         self.pinged = False
         while True:
             try:
-                data = self.sock.recv(1024)
+                # - Receive straight into the parser's buffer
+                received = self._parser.recv_into(self.sock)
                 # TODO - experiment setting value very small to see if I can split messages and test unpack's residual data on a real connection
             except:
-                data = False
+                received = 0
 
-            # print('CSCP_connection run: data received', data, 'pinged', self.pinged)
+            # print('CSCP_connection run: bytes received', received, 'pinged', self.pinged)
 
-            if data:
+            if received:
                 self.pinged = False
-                messages, self._residual_data = swp(data, self._residual_data)  # TODO - TEST SPLIT MESSAGES
-
-                if messages:
-                    for msg in messages:
-                        timestamp = datetime.datetime.now()
-                        self._messages.append((timestamp, msg))
+                # - Messages are extracted as views of the parser's buffer, only copied once into the receive buffer
+                for msg in self._parser.extract_views():
+                    timestamp = datetime.datetime.now()
+                    msg = bytes(msg)
+                    if (msg == swp_utils.ACK or msg == swp_utils.NAK) and self._pipeline.on_response(msg):
+                        # - Response to a pipelined message, not added to the receive buffer
+                        continue
+                    for listener in self._listeners:
+                        try:
+                            listener(timestamp, msg)
+                        except Exception as e:
+                            print("[Connection]: Listener {} failed, error: {!r}".format(listener, e))
+                    self._messages.put((timestamp, msg))
 
             elif self.pinged:
                 self.status = "Connection Lost!"
+                self.connected.clear()
+                self._pipeline.fail_all(ConnectionError("[Connection]: Connection lost"))
                 self.close()
+                self._parser.reset()
                 self._connect()
                 self._run()
 
@@ -157,22 +184,126 @@ class Connection:
             # TODO - check this, not sure this exception will always be a lost connection
             # ... and should detect lost connection before having to send a message
             self.status = "Connection Lost!"
+            self.connected.clear()
             return False
 
-    def get_message(self):
-        if len(self._messages):
-            timestamp, oldest_message = self._messages[0]
-            self._messages = self._messages[1:]
-            #self._received_log.append((timestamp, oldest_message))
-            return timestamp, oldest_message
-        else:
-            return None
+    def add_listener(self, listener):
+        """
+        :param listener: function taking (timestamp, message bytes), called from the receive thread for every
+                         message received other than ACK/NAK, so should return quickly
+        """
+        # - Replaced rather than modified, so the receive thread can iterate it without a lock
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [l for l in self._listeners if l != listener]
+
+    def send_many(self, messages):
+        """
+        Sends any number of messages with a single sendall, (e.g. a salvo of Connects), not waiting for ACKs
+        :param messages: iterable of bytes or swp_message objects
+        :return: bool - True if sent, False if the connection failed
+        """
+        writer = FrameWriter()
+        writer.extend(messages)
+        try:
+            writer.flush(self.sock)
+        except (socket.error, AttributeError) as e:
+            print("[Connection.send_many]: Failed to send, error:", e)
+            self.status = "Connection Lost!"
+            self.connected.clear()
+            return False
+        if self.log:
+            for message in messages:
+                self.log.log(time.time(), message, 'sent')
+        return True
+
+    def send_pipelined(self, message):
+        """
+        Sends without waiting for the previous message's ACK, (up to the window size of messages awaiting ACK).
+        ACK/NAKs are matched to messages in the order sent, NAK'd or timed out messages are resent up to
+        swp_utils.MAX_SEND_ATTEMPTS
+        :param message: bytes or swp_message object
+        :return: concurrent.futures.Future - result() returns True once ACK'd, or raises
+                 swp_pipeline.NakError / AckTimeout, or ConnectionError
+        """
+        return self._pipeline.submit(message)
+
+    def send_pipelined_many(self, messages):
+        """
+        As send_pipelined, for a batch of messages, (those that fit in the window are sent with one write)
+        :param messages: iterable of bytes or swp_message objects
+        :return: list of concurrent.futures.Future, one per message
+        """
+        return self._pipeline.submit_many(messages)
+
+    def push_labels(self, labels, matrix=0, char_len=12, cache=None):
+        """
+        Pushes any number of labels, packed into as few messages as possible (see PushLabels.bulk) & sent pipelined
+        :param labels: dict - {destination ID: label}
+        :param cache: label_cache.LabelCache - only push labels that differ from those last ACK'd, then record the
+                      ACK'd labels and save the cache once every message is done
+        :return: list of concurrent.futures.Future, one per message sent
+        """
+        if cache is not None:
+            labels = cache.changed(labels, matrix, char_len)
+        messages = PushLabels.bulk(labels, matrix, char_len)
+        futures = self.send_pipelined_many(messages)
+        if cache is not None:
+            remaining = [len(futures)]
+            lock = threading.Lock()
+
+            def done(future, message):
+                if not future.exception():
+                    cache.update_message(message)
+                with lock:
+                    remaining[0] -= 1
+                    last = not remaining[0]
+                if last:
+                    cache.save()
+            for future, message in zip(futures, messages):
+                future.add_done_callback(lambda future, message=message: done(future, message))
+        return futures
+
+    def _write(self, message_bytes):
+        # - Used by the pipeline, raises OSError on failure
+        if not self.sock:
+            raise ConnectionError("Not connected")
+        self.sock.sendall(message_bytes)
+        if self.log:
+            self.log.log(time.time(), message_bytes, 'sent')
+
+    def wait_connected(self, timeout=None):
+        """
+        Blocks until the connection is established
+        :param timeout: float - max seconds to wait, None to wait indefinitely
+        :return: bool - True if connected
+        """
+        return self.connected.wait(timeout)
+
+    def get_message(self, timeout=0):
+        """
+        Removes and returns the oldest message in the receive buffer
+        :param timeout: float - seconds to wait for a message if the buffer is empty, 0 to return immediately,
+                        None to wait indefinitely
+        :return: tuple - (datetime.datetime object, message bytes), or None if no message received
+        """
+        return self._messages.get(timeout)
+
+    def get_messages(self, timeout=0):
+        """
+        Removes and returns all messages in the receive buffer
+        :param timeout: float - seconds to wait for a message if the buffer is empty, 0 to return immediately,
+                        None to wait indefinitely
+        :return: list of (datetime.datetime object, message bytes) tuples, oldest first
+        """
+        return self._messages.get_many(timeout=timeout)
 
     def flush_receive_buffer(self):
         """
         Clears/deletes all messages in the receive buffer
         """
-        self._messages = []
+        self._messages.clear()
 
     def receive_buffer_len(self):
         """
@@ -197,7 +328,7 @@ if __name__ == '__main__':
     print("[{}] :".format(TITLE), connection)
 
     while True:
-        message = connection.get_message()
+        message = connection.get_message(timeout=None)  # - Blocks until a message is received
         if message:
             print("[{}]: messages in receive buffer: {}, message: {}".format(TITLE, len(connection._messages),
                                                                                         message))
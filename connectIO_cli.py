@@ -1,11 +1,20 @@
 # - ConnectIO CLI
 # - CLI interface for For testing the sending of SWP08/Probel control messages to a router,
 # - making connections, pushing labels and requesting connection/tally data.
+#
+# - Batch mode, (non-interactive), sends the connections & labels listed in a CSV or JSON file:
+# -   python connectIO_cli.py --batch patch.csv --report report.csv
+# - Rows have matrix, level, source, destination & optional label, (one based as per the prompts & Calrec UI/csv).
+# - Matrix & level default to 1, and a row without a source only pushes its label.
 
 # Peter Walker, March 2022
 
-import time
+import argparse
+import csv
 import datetime
+import sys
+import threading
+import time
 from string import punctuation
 
 # Local files
@@ -13,17 +22,20 @@ import cli_utils
 import settings as config
 from client_connection import Connection
 import swp_message
+from label_cache import LabelCache
+from router_mirror import RouterMirror
+from swp_pipeline import DEFAULT_WINDOW, NakError, AckTimeout
 from swp_node import Node
 import swp_utils as swp_utils
 
 
 # Time to wait for ACK before retry.
-TIMEOUT = 3
+TIMEOUT = swp_utils.ACK_TIMEOUT
 # Number of send/resend to attempt until ACK received
-MAX_SEND_ATTEMPTS = 5
+MAX_SEND_ATTEMPTS = swp_utils.MAX_SEND_ATTEMPTS
 
 TITLE = "ConnectIO"
-VERSION = 1.3
+VERSION = 1.5
 
 
 def prompt_matrix_level():
@@ -37,12 +49,29 @@ def prompt_matrix_level():
 
 
 def prompt_for_tally_dump(matrix, level):
+    # - Only needed once per matrix & level, the mirror is then kept current by the Connected messages received
+    if mirror.has_tally_dump(matrix, level):
+        return
     confirm = input("Get current connection state for matrix {}, level {}? (y/n)".format(matrix + 1, level + 1))
     if confirm.lower() in ("y", "yes", ""):
         msg = swp_message.GetConnections(matrix, level)
         send_message(connection, msg)
 
 
+def print_crosspoint(matrix, level, destination, source):
+    """
+    Waits for the router to confirm the connection, then prints the destination's source & the source's
+    destinations from the mirror, (1 based IDs to match the GUI/csv)
+    """
+    if not mirror.wait_for(lambda: mirror.source(matrix, level, destination) == source, timeout=TIMEOUT):
+        print("Connection not confirmed by the router after {}s".format(TIMEOUT))
+    connected = mirror.source(matrix, level, destination)
+    print("Destination {} <- Source {}".format(destination + 1,
+                                                "none" if connected == swp_utils.MUTE_ID else connected + 1))
+    print("Source {} -> Destinations {}".format(source + 1, [d + 1 for d in mirror.destinations(matrix, level,
+                                                                                                 source)]))
+
+
 def prompt_source_dest_label():
     while True:
         s = input("\nEnter source ID, destination ID & optional label "
@@ -67,14 +96,17 @@ def prompt_source_dest_label():
             return None, None, None
 
 
-def get_received_messages(conn):
-    response = False
-    while conn.receive_buffer_len():
-        response = True
-        timestamp, msg = conn.get_message()
-        msg = swp_message.decode(msg)
+def get_received_messages(conn, timeout=0):
+    """
+    Prints and removes all messages in the connection's receive buffer
+    :param timeout: float - seconds to wait for a message if the buffer is empty
+    :return: bool - True if any messages were received
+    """
+    messages = conn.get_messages(timeout)
+    for timestamp, msg in messages:
+        msg = swp_message.LazyMessage(msg)
         swp_utils.print_message(timestamp, "received", msg)
-    return response
+    return len(messages) > 0
 
 
 def send_message(conn, msg):
@@ -91,21 +123,211 @@ def send_message(conn, msg):
     swp_utils.print_message(datetime.datetime.now(), "sending", msg)
 
     conn.send(msg)
-    t = time.time()
-    ts = 0  # - timer
 
     # TODO Retry after timeout, check for ACK, add optional short delay after ACK for Brio lag on tally dump
-    response = False
-    while not response and ts < TIMEOUT:
-        ts = time.time() - t
-        response = get_received_messages(conn)
+    # - Blocks until the router responds or the timeout expires
+    response = get_received_messages(conn, timeout=TIMEOUT)
 
     if not response:
         print("Timeout, no response from router after timeout setting of {}s".format(TIMEOUT))
 
 
+# - BATCH MODE - #
+REPORT_FIELDS = ("row", "matrix", "level", "source", "destination", "label",
+                 "connect", "connect_ms", "confirmed", "label_result", "label_ms")
+
+
+class BatchRow:
+    """ A row of a batch file, (IDs zero based), and the results of sending it """
+    def __init__(self, row, matrix, level, source, destination, label=None):
+        self.row = row  # - Row number in the file, (1 for the first row after any CSV header)
+        self.matrix = matrix
+        self.level = level
+        self.source = source  # - None to only push the label
+        self.destination = destination
+        self.label = label
+        self.connect = ""  # - "ACK", "NAK", "timeout" or "connection lost", blank if not sent
+        self.connect_ms = None  # - Milliseconds from the start of the batch to the result
+        self.confirmed = ""  # - Connected message received for the crosspoint
+        self.label_result = ""
+        self.label_ms = None
+
+    def report(self):
+        """
+        :return: dict - the row and its results for the report, (one based IDs)
+        """
+        return {"row": self.row, "matrix": self.matrix + 1, "level": self.level + 1,
+                "source": "" if self.source is None else self.source + 1, "destination": self.destination + 1,
+                "label": self.label or "", "connect": self.connect, "connect_ms": _ms(self.connect_ms),
+                "confirmed": self.confirmed, "label_result": self.label_result, "label_ms": _ms(self.label_ms)}
+
+
+def _ms(seconds):
+    return "" if seconds is None else "{:.1f}".format(1000 * seconds)
+
+
+def read_batch(filename):
+    """
+    :param filename: str - CSV (with a header row) or JSON file of matrix, level, source, destination & label rows
+    :return: list of BatchRow
+    """
+    def number(record, field, default=None):
+        value = record.get(field)
+        if value is None or str(value).strip() == "":
+            if default is None and field != "source":
+                raise ValueError("no {}".format(field))
+            return default
+        value = int(value) - 1
+        if not 0 <= value <= (15 if field in ("matrix", "level") else swp_utils.MUTE_ID):
+            raise ValueError("{} out of range".format(field))
+        return value
+
+    rows = []
+    for i, record in enumerate(cli_utils.read_records(filename), 1):
+        try:
+            rows.append(BatchRow(i, number(record, "matrix", 0), number(record, "level", 0),
+                                 number(record, "source"), number(record, "destination"),
+                                 record.get("label") or None))
+        except ValueError as e:
+            raise ValueError("[{}]: Row {} of {}, {}: {}".format(TITLE, i, filename, e, record))
+    return rows
+
+
+def batch_messages(rows, char_len, cache=None):
+    """
+    Connects for each row with a source, and labels grouped into one PushLabels message per run of consecutive
+    destinations on the same matrix, (up to the max labels per message), in the order of the rows
+    :param cache: label_cache.LabelCache - labels the same as last ACK'd are not sent, (label_result "unchanged")
+    :return: list of (message, rows, "connect" or "label") tuples
+    """
+    messages = []
+    group = []
+    max_labels = swp_utils.max_labels(char_len)
+
+    def push_labels():
+        if group:
+            messages.append((swp_message.PushLabels(group[0].destination, [row.label for row in group],
+                                                    group[0].matrix, char_len), list(group), "label"))
+            group.clear()
+
+    for row in rows:
+        if row.source is not None:
+            messages.append((swp_message.Connect(row.source, row.destination, row.matrix, row.level), [row],
+                             "connect"))
+        if row.label and cache is not None and \
+                cache.get(row.matrix, row.destination, char_len) == swp_utils.set_label_length([row.label],
+                                                                                              char_len)[0]:
+            row.label_result = "unchanged"
+        elif row.label:
+            if not group or row.matrix != group[-1].matrix or row.destination != group[-1].destination + 1 \
+                    or len(group) == max_labels:
+                push_labels()
+            group.append(row)
+    push_labels()
+    return messages
+
+
+def run_batch(conn, rows, char_len, timeout=TIMEOUT, mirror=None, cache=None):
+    """
+    Sends the rows pipelined, recording each row's results & timing
+    :param conn: client_connection.Connection
+    :param mirror: RouterMirror attached to the connection, to check the connections are confirmed
+    :param cache: label_cache.LabelCache - only push labels that have changed, recording those ACK'd
+    :return: int - number of messages sent
+    """
+    messages = batch_messages(rows, char_len, cache)
+    start = time.monotonic()
+    finished = threading.Semaphore(0)  # - Released once per message as its results are recorded
+
+    def done(future, message, rows, kind):
+        error = future.exception()
+        if error is None:
+            result = "ACK"
+            if kind == "label" and cache is not None:
+                cache.update_message(message)
+        elif isinstance(error, NakError):
+            result = "NAK"
+        elif isinstance(error, AckTimeout):
+            result = "timeout"
+        else:
+            result = "connection lost"
+        for row in rows:
+            setattr(row, "connect" if kind == "connect" else "label_result", result)
+            setattr(row, "connect_ms" if kind == "connect" else "label_ms", time.monotonic() - start)
+        finished.release()
+
+    futures = conn.send_pipelined_many([message for message, rows, kind in messages])
+    for future, (message, rows_sent, kind) in zip(futures, messages):
+        future.add_done_callback(lambda future, message=message, rows_sent=rows_sent, kind=kind:
+                                 done(future, message, rows_sent, kind))
+    for _ in futures:
+        finished.acquire()  # - Waits for every message to be ACK'd or failed
+
+    if mirror:
+        connected = [row for row in rows if row.connect == "ACK"]
+
+        def confirmed(row):
+            return mirror.source(row.matrix, row.level, row.destination) == row.source
+        mirror.wait_for(lambda: all(confirmed(row) for row in connected), timeout)
+        for row in connected:
+            row.confirmed = "yes" if confirmed(row) else "no"
+    return len(messages)
+
+
+def write_report(rows, filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(row.report() for row in rows)
+
+
+def main(args=None):
+    saved = config.load_settings()
+    parser = argparse.ArgumentParser(description="Send the connections & labels in a CSV or JSON file")
+    parser.add_argument("--batch", required=True, help="CSV or JSON file of matrix, level, source, destination "
+                                                       "& optional label rows")
+    parser.add_argument("--report", help="CSV file to write each row's results to")
+    parser.add_argument("--address", default=saved["Router IP Address"] or "127.0.0.1")
+    parser.add_argument("--port", type=int, default=saved.get("Port", swp_utils.PORT))
+    parser.add_argument("--char-len", type=int, default=saved.get("Label Length", 12),
+                        choices=sorted(swp_utils.CHAR_LEN_CODES))
+    parser.add_argument("--label-cache", help="file of the labels last pushed, only labels that have changed "
+                                              "since are pushed")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="max messages in flight awaiting ACK")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    options = parser.parse_args(args)
+
+    rows = read_batch(options.batch)
+    conn = Connection(options.address, window=options.window, port=options.port, ack_timeout=options.timeout)
+    if not conn.wait_connected(options.timeout):
+        print("[{}]: Failed to connect to {}:{}".format(TITLE, options.address, options.port))
+        return False
+    batch_mirror = RouterMirror()
+    batch_mirror.attach(conn)
+    cache = LabelCache(options.label_cache) if options.label_cache else None
+
+    start = time.monotonic()
+    sent = run_batch(conn, rows, options.char_len, options.timeout, batch_mirror, cache)
+    elapsed = time.monotonic() - start
+    if cache is not None:
+        cache.save()
+
+    if options.report:
+        write_report(rows, options.report)
+    failed = [row for row in rows if row.connect not in ("", "ACK") or
+              row.label_result not in ("", "ACK", "unchanged")]
+    unconfirmed = [row for row in rows if row.confirmed == "no"]
+    for row in failed + unconfirmed:
+        print("Row {}: {}".format(row.row, row.report()))
+    print("{} rows, {} messages sent in {:.3f}s ({:.0f} rows/s), {} failed, {} unconfirmed".format(
+        len(rows), sent, elapsed, len(rows) / elapsed if elapsed else 0, len(failed), len(unconfirmed)))
+    return not failed and not unconfirmed
+
+
 if __name__ == '__main__':
     cli_utils.print_header(TITLE, VERSION)
+    if len(sys.argv) > 1:
+        sys.exit(0 if main() else 1)
 
     # - Get last used settings, and prompt user to accept or change
     # - Note my router is 192.169.1.201
@@ -115,18 +337,21 @@ if __name__ == '__main__':
 
     # - Open a TCP client connection with the router
     connection = Connection(settings["Router IP Address"])
+    # - Local copy of the router's crosspoints, kept current from the messages it sends
+    mirror = RouterMirror()
+    mirror.attach(connection)
 
     # - Wait for connection status to be Connected
-    while connection.status != "Connected":
-        pass
+    connection.wait_connected()
 
     mtx, lvl = prompt_matrix_level()
     prompt_for_tally_dump(mtx, lvl)
 
     while True:
         # - Check connection and wait for reconnect if down
-        while connection.status != "Connected":
+        if not connection.connected.is_set():
             print("connection status:", connection.status)
+            connection.wait_connected()
 
         source_id, destination_id, label = prompt_source_dest_label()
 
@@ -141,9 +366,8 @@ if __name__ == '__main__':
 
             patch_msg = swp_message.Connect(source, destination)
             send_message(connection, patch_msg)
+            print_crosspoint(mtx, lvl, destination_id, source_id)
 
             if label:
                 label_msg = swp_message.PushLabels(destination, [label], matrix=mtx, char_len=settings["Label Length"])
                 send_message(connection, label_msg)
-
-        prompt_for_tally_dump(mtx, lvl)
@@ -0,0 +1,302 @@
+# - Crosspoint state table
+# - Holds the connected source ID of every destination as one array per matrix & level, with swp_utils.MUTE_ID for
+# - destinations that have no source connected. Arrays grow to fit the highest destination ID seen, (up to 65535,
+# - as per CSV imports and word tally dumps).
+# - Uses NumPy arrays when NumPy is installed, (not required, falls back to standard library arrays)
+
+from array import array
+
+import cli_utils
+import swp_message
+import swp_utils
+from swp_node import iter_consecutive_runs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TITLE = "Crosspoint Table"
+VERSION = 0.1
+
+DEFAULT_SIZE = 1024  # - Initial number of destinations per matrix & level (IDs 0-1023, as supported by Connect messages)
+MAX_SIZE = 65536  # - Destination IDs 0-65535, as supported by word tally dumps
+
+
+class CrosspointTable:
+    """
+    Connected source ID per destination, for each matrix & level.
+    Arrays are created on first use of a matrix & level and grown when a higher destination ID is seen.
+    Connect and query are O(1), diff compares whole levels at once (vectorised with NumPy if available) and only
+    returns the destinations that differ.
+    """
+    def __init__(self, size=DEFAULT_SIZE, use_numpy=True):
+        """
+        :param size: int - initial number of destination IDs per matrix & level
+        :param use_numpy: bool - use NumPy arrays if NumPy is installed
+        """
+        self.size = size
+        self.use_numpy = use_numpy and numpy is not None
+        self._levels = {}  # - (matrix, level): array of source IDs indexed by destination ID
+
+    def __str__(self):
+        return "[crosspoint_table object]: {} matrix/levels, up to {} destinations per level, {}".format(
+            len(self._levels), max([len(s) for s in self._levels.values()] + [self.size]),
+            "NumPy" if self.use_numpy else "array")
+
+    def _new_level(self, size=None):
+        if size is None:
+            size = self.size
+        if self.use_numpy:
+            return numpy.full(size, swp_utils.MUTE_ID, dtype=numpy.uint16)
+        return array('H', [swp_utils.MUTE_ID]) * size
+
+    def level(self, matrix, level, size=0):
+        """
+        :param size: int - min number of destination IDs the array must hold, it's grown if smaller
+        :return: the array of source IDs for the matrix & level, indexed by destination ID (created if new).
+                 The array is replaced when grown, so don't hold on to it across calls that may grow it
+        """
+        key = (matrix, level)
+        sources = self._levels.get(key)
+        if sources is None:
+            sources = self._levels[key] = self._new_level(max(self.size, size))
+        elif len(sources) < size:
+            sources = self._levels[key] = self._grow(sources, size)
+        return sources
+
+    def _grow(self, sources, size):
+        """
+        :return: sources extended with unconnected destinations to at least size, (doubling to limit regrowth)
+        """
+        if size > MAX_SIZE:
+            raise ValueError("[{}]: Destination ID {} out of range 0-{}".format(TITLE, size - 1, MAX_SIZE - 1))
+        return _padded(sources, min(max(size, len(sources) * 2), MAX_SIZE), self)
+
+    def size_of(self, matrix, level):
+        """
+        :return: int - number of destination IDs currently held for the matrix & level, (0 if none)
+        """
+        sources = self._levels.get((matrix, level))
+        return 0 if sources is None else len(sources)
+
+    def matrix_levels(self):
+        """
+        :return: sorted list of (matrix, level) tuples held in the table
+        """
+        return sorted(self._levels)
+
+    def copy(self):
+        table = CrosspointTable(self.size, self.use_numpy)
+        for key, sources in self._levels.items():
+            table._levels[key] = sources.copy() if self.use_numpy else array('H', sources)
+        return table
+
+    # - CONNECT / QUERY - #
+    def connect(self, matrix, level, destination, source):
+        """
+        :param source: int - source ID, swp_utils.MUTE_ID to disconnect
+        """
+        self.level(matrix, level, destination + 1)[destination] = source
+
+    def disconnect(self, matrix, level, destination):
+        self.connect(matrix, level, destination, swp_utils.MUTE_ID)
+
+    def source(self, matrix, level, destination):
+        """
+        :return: int - ID of the source connected to the destination, swp_utils.MUTE_ID if none
+        """
+        sources = self._levels.get((matrix, level))
+        if sources is None or destination >= len(sources):
+            return swp_utils.MUTE_ID
+        return int(sources[destination])
+
+    def is_connected(self, matrix, level, destination):
+        return self.source(matrix, level, destination) != swp_utils.MUTE_ID
+
+    def apply(self, connections):
+        """
+        :param connections: iterable of (matrix, level, destination, source) tuples, e.g. as returned by diff()
+        """
+        for matrix, level, destination, source in connections:
+            self.level(matrix, level, destination + 1)[destination] = source
+
+    def apply_message(self, message):
+        """
+        Updates the table from a Connected message or cross-point tally dump (byte or word) message
+        :param message: swp_message object (or swp_message.LazyMessage)
+        """
+        if message.command == "connected":
+            self.connect(message.matrix, message.level, message.destination, message.source)
+        elif message.command in ("cross-point tally dump (byte)", "cross-point tally dump (word/extended)"):
+            self.set_sources(message.matrix, message.level, message.first_destination, message.sources)
+
+    def set_sources(self, matrix, level, first_destination, sources):
+        """
+        Sets the sources of a run of consecutive destinations in one go
+        :param sources: array('H') (or list) of source IDs for first_destination and following destinations
+        """
+        if type(sources) is not array:
+            sources = array('H', sources)
+        end = first_destination + len(sources)
+        if self.use_numpy:
+            self.level(matrix, level, end)[first_destination: end] = numpy.frombuffer(sources, dtype=numpy.uint16)
+        else:
+            self.level(matrix, level, end)[first_destination: end] = sources
+
+    # - DIFF - #
+    def diff(self, other):
+        """
+        :param other: CrosspointTable
+        :return: list of (matrix, level, destination, source) tuples for the destinations whose source in other
+                 differs from this table, (i.e. the connections to apply to this table to match other).
+                 Matrix/levels & destinations missing from either table are treated as having no connections.
+        """
+        changes = []
+        for matrix, level in sorted(set(self._levels) | set(other._levels)):
+            size = max(self.size_of(matrix, level), other.size_of(matrix, level))
+            current = self._levels.get((matrix, level))
+            target = other._levels.get((matrix, level))
+            current = self._new_level(size) if current is None else _padded(current, size, self)
+            target = other._new_level(size) if target is None else _padded(target, size, other)
+            for destination, source in _diff_level(current, target):
+                changes.append((matrix, level, destination, source))
+        return changes
+
+    # - TALLY DUMPS - #
+    def tally_dumps(self, matrix, level, destinations=None, message_class=swp_message.CrossPointTallyDumpWord):
+        """
+        :param destinations: sorted iterable of destination IDs to include, (default all connected destinations)
+        :param message_class: swp_message.CrossPointTallyDumpWord or CrossPointTallyDumpByte
+        :return: list of cross-point tally dump messages for the matrix & level, one per run of consecutive IDs
+                 (up to the max tallies per message)
+        """
+        if destinations is None:
+            destinations = [d for d, s in enumerate(self._levels.get((matrix, level), ())) if s != swp_utils.MUTE_ID]
+        runs = iter_consecutive_runs(destinations, message_class.MAX_TALLIES)
+        return self.tally_dumps_for_runs(matrix, level, runs, message_class)
+
+    def tally_dumps_for_runs(self, matrix, level, runs, message_class=swp_message.CrossPointTallyDumpWord):
+        """
+        :param runs: iterable of lists of consecutive destination IDs, each up to message_class.MAX_TALLIES long
+                     (e.g. as cached by IOCatalogue.runs())
+        :param message_class: swp_message.CrossPointTallyDumpWord or CrossPointTallyDumpByte
+        :return: list of cross-point tally dump messages for the matrix & level, one per run, (runs with IDs above
+                 message_class.MAX_ID, e.g. unconnected destinations in byte form, are sent as word tally dumps)
+        """
+        messages = []
+        word_class = swp_message.CrossPointTallyDumpWord
+        for run in runs:
+            if not 0 < len(run) <= message_class.MAX_TALLIES:
+                raise ValueError("[{}]: Runs must have 1-{} destinations, got {}".format(
+                    TITLE, message_class.MAX_TALLIES, len(run)))
+            first = run[0]
+            run_sources = self.run_sources(matrix, level, first, len(run))
+            if max(first + len(run) - 1, max(run_sources)) <= message_class.MAX_ID:
+                messages.append(message_class.from_sources(matrix, level, first, run_sources))
+                continue
+            for start in range(0, len(run), word_class.MAX_TALLIES):
+                messages.append(word_class.from_sources(matrix, level, first + start,
+                                                        run_sources[start: start + word_class.MAX_TALLIES]))
+        return messages
+
+    def run_sources(self, matrix, level, first_destination, count):
+        """
+        Reads without creating or growing the level, destinations not held are unconnected
+        :return: list of the source IDs of count consecutive destinations from first_destination
+        """
+        sources = self._levels.get((matrix, level))
+        if sources is None:
+            return [swp_utils.MUTE_ID] * count
+        run_sources = sources[first_destination: first_destination + count]
+        run_sources = run_sources.tolist() if self.use_numpy else list(run_sources)
+        return run_sources + [swp_utils.MUTE_ID] * (count - len(run_sources))
+
+
+def _padded(sources, size, table):
+    """
+    :return: sources, or a copy extended with unconnected destinations if shorter than size
+    """
+    if len(sources) >= size:
+        return sources
+    if table.use_numpy:
+        return numpy.concatenate((sources, table._new_level(size - len(sources))))
+    return sources + table._new_level(size - len(sources))
+
+
+def _diff_level(current, target):
+    """
+    :return: list of (destination, source) for the destinations whose source in target differs from current
+    """
+    if numpy is not None and isinstance(current, numpy.ndarray) and isinstance(target, numpy.ndarray):
+        changed = numpy.nonzero(current != target)[0]
+        return list(zip(changed.tolist(), target[changed].tolist()))
+
+    if bytes(current) == bytes(target):
+        # - Compared as one block, the usual case for levels that haven't changed
+        return []
+    return [(d, int(t)) for d, (c, t) in enumerate(zip(current, target)) if c != t]
+
+
+def test_crosspoint_table(use_numpy=True):
+    table = CrosspointTable(use_numpy=use_numpy)
+    table.connect(0, 0, 10, 1)
+    table.connect(0, 0, 11, 2)
+    table.connect(1, 2, 500, 300)
+
+    target = table.copy()
+    target.connect(0, 0, 11, 3)
+    target.disconnect(1, 2, 500)
+    target.connect(3, 3, 0, 7)
+
+    dumps = table.tally_dumps(0, 0, destinations=range(8, 80))
+    received = CrosspointTable(use_numpy=use_numpy)
+    for message in dumps:
+        received.apply_message(swp_message.decode(message.encoded))
+
+    passed = table.source(0, 0, 11) == 2 and table.source(5, 5, 0) == swp_utils.MUTE_ID \
+        and table.diff(target) == [(0, 0, 11, 3), (1, 2, 500, swp_utils.MUTE_ID), (3, 3, 0, 7)] \
+        and [len(m.sources) for m in dumps] == [64, 8] \
+        and received.diff(table) == [(1, 2, 500, 300)]
+
+    table.apply(table.diff(target))
+    passed = passed and not table.diff(target)
+
+    # - A 4096 destination level, (e.g. from a catalogue's runs), gives 64 full frames
+    runs = list(iter_consecutive_runs(range(4096)))
+    dumps = table.tally_dumps_for_runs(2, 2, runs)
+    passed = passed and [len(m.sources) for m in dumps] == [64] * 64 \
+        and dumps[-1].first_destination == 4032 and set(dumps[-1].sources) == {swp_utils.MUTE_ID}
+
+    # - Tally dumps don't create or grow levels, destinations not held are unconnected
+    dumps = table.tally_dumps(0, 0, range(1020, 1030))
+    passed = passed and table.size_of(2, 2) == 0 and table.size_of(0, 0) == 1024 \
+        and list(dumps[0].sources) == [swp_utils.MUTE_ID] * 10 and table.tally_dumps(9, 9) == []
+
+    # - Byte tally dumps fall back to word form for runs with IDs too high for a byte, (e.g. MUTE_ID)
+    byte_dumps = table.tally_dumps(0, 0, message_class=swp_message.CrossPointTallyDumpByte)
+    mixed_dumps = table.tally_dumps(0, 0, range(100), message_class=swp_message.CrossPointTallyDumpByte)
+    received = CrosspointTable(use_numpy=use_numpy)
+    for message in mixed_dumps:
+        received.apply_message(swp_message.decode(message.encoded))
+    passed = passed and [m.command for m in byte_dumps] == ["cross-point tally dump (byte)"] \
+        and list(byte_dumps[0].connections()) == [(10, 1), (11, 3)] \
+        and [len(m.sources) for m in mixed_dumps] == [64, 36] \
+        and received.run_sources(0, 0, 0, 100) == table.run_sources(0, 0, 0, 100)
+
+    # - IDs above 1023, (e.g. from CSV imports or word tally dumps), grow the level
+    table.connect(0, 0, 5000, 4000)
+    passed = passed and table.source(0, 0, 5000) == 4000 and table.source(0, 0, 60000) == swp_utils.MUTE_ID \
+        and table.size_of(0, 0) >= 5001 and table.size_of(0, 1) == 0 \
+        and table.diff(target) == [(0, 0, 5000, swp_utils.MUTE_ID)] and target.diff(table) == [(0, 0, 5000, 4000)]
+
+    if passed:
+        print("TEST CROSSPOINT TABLE ({}): PASS".format(table))
+    else:
+        print("TEST CROSSPOINT TABLE ({}): FAIL".format(table))
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    test_crosspoint_table()
+    test_crosspoint_table(use_numpy=False)
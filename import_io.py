@@ -7,13 +7,30 @@
 #
 # - TODO, check handling of invalid csv files
 
+# - V07 - caches the parsed nodes in a compact binary file next to the CSV (<csv filename>.cache), loaded in one read
+# -       on later imports. The cache is keyed on the CSV's modification time & size, and on the CSV rows' Checksum
+# -       column, and is rebuilt automatically when the CSV changes.
+
 import csv
+import hashlib
+import os
+import struct
+import tempfile
+from array import array
 
 import cli_utils
 from swp_node import Node  # TODO TEST _03 with gui router
 
 TITLE = "Import IO"
-VERSION = 0.6
+VERSION = 0.7
+
+CACHE_SUFFIX = '.cache'
+_CACHE_FORMAT_ID = b'SWPIO'
+_CACHE_VERSION = 1
+# - Header: format id, version, CSV mtime (ns), CSV size, digest of CSV checksums, node qty, string table length
+_CACHE_HEADER = struct.Struct('<5sHqq16sII')
+_NODE_TYPES = ('Source', 'Destination')
+_STRING_SEPARATOR = '\x00'
 
 
 # - PRIVATE FUNCTIONS USED BY import_io_from_csv
@@ -69,25 +86,155 @@ def _csv_line_to_node(line, io_type):
         return False
 
 
+def _read_rows(csv_file):
+    with open(csv_file, 'r') as data:
+        return list(csv.DictReader(data))
+
+
+def _parse_rows(rows):
+    source_nodes = []
+    destination_nodes = []
+    io_nodes = (source_nodes, destination_nodes)
+    for line in rows:
+        io_nodes = _parse_line(line, io_nodes)
+    return io_nodes
+
+
+def _rows_digest(rows):
+    """
+    :return: bytes - digest of the CSV rows' Checksum column (or of the whole row for CSVs without one)
+    """
+    digest = hashlib.md5()
+    for line in rows:
+        checksum = line.get('Checksum')
+        if checksum is None:
+            checksum = ','.join(str(v) for v in line.values())
+        digest.update(checksum.encode() + b'\n')
+    return digest.digest()
+
+
+def _save_cache(cache_file, io_nodes, csv_stat, digest):
+    """
+    Writes nodes as an array of ints (type, matrix, level, id per node) followed by a table of their strings
+    """
+    numbers = array('i')
+    strings = []
+    for type_index, nodes in enumerate(io_nodes):
+        for node in nodes:
+            numbers.extend((type_index, node.matrix, node.level, node.id))
+            # - None for fields missing from short rows, (read back as '', which Nodes treat the same)
+            strings += [node.group or '', node.ch or '', node.label or '', node.user_label or '']
+
+    string_table = _STRING_SEPARATOR.join(strings).encode('utf-8')
+    header = _CACHE_HEADER.pack(_CACHE_FORMAT_ID, _CACHE_VERSION, csv_stat.st_mtime_ns, csv_stat.st_size, digest,
+                                len(numbers) // 4, len(string_table))
+    temp_file = cache_file + '.tmp'
+    try:
+        with open(temp_file, 'wb') as f:
+            f.write(header + numbers.tobytes() + string_table)
+        os.replace(temp_file, cache_file)
+    except OSError as e:
+        # - Not fatal, just slower next time (e.g. read-only folder)
+        print(f"[{TITLE}]: Unable to save IO cache {cache_file}: {e}")
+
+
+def _load_cache(cache_file):
+    """
+    :return: tuple (csv mtime, csv size, digest, (source_nodes, destination_nodes)), or None if no valid cache
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            data = f.read()
+        format_id, version, mtime, size, digest, node_qty, string_len = _CACHE_HEADER.unpack_from(data)
+        if format_id != _CACHE_FORMAT_ID or version != _CACHE_VERSION:
+            return None
+
+        start = _CACHE_HEADER.size
+        numbers = array('i')
+        numbers.frombytes(data[start: start + node_qty * 4 * numbers.itemsize])
+        start += node_qty * 4 * numbers.itemsize
+        strings = data[start: start + string_len].decode('utf-8').split(_STRING_SEPARATOR)
+    except (OSError, struct.error, ValueError):
+        return None
+
+    if len(numbers) != node_qty * 4 or (node_qty and len(strings) != node_qty * 4):
+        return None
+
+    io_nodes = ([], [])
+    n = iter(numbers)
+    s = iter(strings)
+    for type_index, matrix, level, swp_id, group, ch, label, user_label in zip(n, n, n, n, s, s, s, s):
+        io_nodes[type_index].append(Node(matrix, level, swp_id, _NODE_TYPES[type_index], group, ch, label,
+                                         user_label))
+    return mtime, size, digest, io_nodes
+
+
 # - PUBLIC FUNCTIONS - #
-def import_io_from_csv(csv_file):
+def import_io_from_csv(csv_file, use_cache=True):
     """
     :param csv_file: filename of local calrec format IO/SWP csv file
+    :param use_cache: bool - load from / save to the binary cache file alongside the csv
     :return: tuple of source_nodes, destination_nodes
     """
-    source_nodes = []
-    destination_nodes = []
-    io_nodes = (source_nodes, destination_nodes)
-
-    with open(csv_file, 'r') as data:
-        for line in csv.DictReader(data):
-            io_nodes = _parse_line(line, io_nodes)
+    if not use_cache:
+        return _parse_rows(_read_rows(csv_file))
+
+    csv_stat = os.stat(csv_file)
+    cache_file = csv_file + CACHE_SUFFIX
+    cached = _load_cache(cache_file)
+
+    if cached:
+        mtime, size, digest, io_nodes = cached
+        if mtime == csv_stat.st_mtime_ns and size == csv_stat.st_size:
+            return io_nodes
+
+    # - CSV modified (or no cache), check whether its content has actually changed
+    rows = _read_rows(csv_file)
+    digest = _rows_digest(rows)
+    if cached and cached[2] == digest:
+        io_nodes = cached[3]
+    else:
+        io_nodes = _parse_rows(rows)
 
+    _save_cache(cache_file, io_nodes, csv_stat, digest)
     return io_nodes
 
 
+def test_cache():
+    # - Nodes loaded from the cache should match those parsed from the csv
+    csv_file = "VirtualPatchbays.csv"
+    parsed = import_io_from_csv(csv_file, use_cache=False)
+    import_io_from_csv(csv_file)  # - Creates/updates cache
+    cached = _load_cache(csv_file + CACHE_SUFFIX)
+
+    passed = cached is not None
+    if passed:
+        for parsed_nodes, cached_nodes in zip(parsed, cached[3]):
+            passed = passed and [n.__str__() for n in parsed_nodes] == [n.__str__() for n in cached_nodes] \
+                and [n.type for n in parsed_nodes] == [n.type for n in cached_nodes]
+
+    # - Rows short of the label columns, (None values from the csv reader), are cached as empty labels
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file = os.path.join(directory, "short_rows.csv")
+        with open(csv_file, 'w') as f:
+            f.write('"EDIT Out SW-P-08 Matrix","EDIT Out SW-P-08 Level","EDIT Out SW-P-08 ID",'
+                    '"EDIT In SW-P-08 Matrix","EDIT In SW-P-08 Level","EDIT In SW-P-08 ID",'
+                    '"Virtual Patchbay Name","Patch Point Number","Patch Point Default Label",'
+                    '"EDIT Patch Point User Label"\n1,1,1,,,,VPB-1,1,Mic 1,Presenter\n1,1,2,,,,VPB-1,2\n')
+        parsed = import_io_from_csv(csv_file)
+        cached = _load_cache(csv_file + CACHE_SUFFIX)
+        passed = passed and cached is not None and parsed[0][1].label is None \
+            and [n.__str__() for n in parsed[0]] == [n.__str__() for n in cached[3][0]]
+
+    if passed:
+        print("TEST CACHE: PASS")
+    else:
+        print("TEST CACHE: FAIL")
+
+
 if __name__ == '__main__':
     cli_utils.print_header(TITLE, VERSION)
+    test_cache()
     csv_file = "VirtualPatchbays.csv"
 
     io = import_io_from_csv(csv_file)
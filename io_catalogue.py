@@ -0,0 +1,201 @@
+# - Indexed catalogue of SWP sources & destinations
+# - Holds the Nodes imported from a Calrec VPB CSV (import_io.import_io_from_csv) indexed by
+# - type, matrix, level & ID, so matching incoming messages to Nodes doesn't depend on the number of IO,
+# - and keeps a sorted ID list per matrix & level for tally dumps.
+
+from bisect import bisect_left, insort
+
+import cli_utils
+from import_io import import_io_from_csv
+from swp_node import Node, iter_consecutive_runs
+
+TITLE = "IO Catalogue"
+VERSION = 0.1
+
+SOURCE = "source"
+DESTINATION = "destination"
+
+
+def _io_type(node):
+    # - Node types are 'Source'/'Destination' from the Node constructors, but 'source'/'destination' where Node()
+    # - is called directly
+    return node.type.lower()
+
+
+class IOCatalogue:
+    """
+    Sources & destinations indexed by (type, matrix, level, id) for O(1) lookup, and by (type, matrix, level)
+    with IDs kept sorted for iterating over a matrix & level in ID order.
+    Nodes can be added and removed incrementally.
+    """
+    def __init__(self, sources=(), destinations=()):
+        """
+        :param sources: iterable of source Nodes
+        :param destinations: iterable of destination Nodes
+        """
+        self._nodes = {}  # - (type, matrix, level, id): Node
+        self._by_matrix_level = {}  # - (type, matrix, level): {id: Node}
+        self._sorted_ids = {}  # - (type, matrix, level): sorted list of ids
+        self._runs = {}  # - (type, matrix, level, max_run): cached runs of consecutive ids, cleared on add/remove
+
+        for node in sources:
+            self.add(node)
+        for node in destinations:
+            self.add(node)
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        """
+        :param csv_file: filename of local calrec format IO/SWP csv file
+        """
+        sources, destinations = import_io_from_csv(csv_file)
+        return cls(sources, destinations)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __str__(self):
+        return "[io_catalogue object]: {} sources, {} destinations".format(len(self.sources),
+                                                                          len(self.destinations))
+
+    # - ADD / REMOVE - #
+    def add(self, node):
+        """
+        Adds a Node, replacing any existing Node of the same type, matrix, level & ID
+        :param node: Node object
+        """
+        key = (_io_type(node), node.matrix, node.level)
+        if key + (node.id,) not in self._nodes:
+            insort(self._sorted_ids.setdefault(key, []), node.id)
+            self._clear_runs(key)
+        self._nodes[key + (node.id,)] = node
+        self._by_matrix_level.setdefault(key, {})[node.id] = node
+
+    def remove(self, node):
+        """
+        :param node: Node object (or any Node of the same type, matrix, level & ID)
+        :return: the removed Node, or None if not in the catalogue
+        """
+        key = (_io_type(node), node.matrix, node.level)
+        removed = self._nodes.pop(key + (node.id,), None)
+        if removed:
+            del self._by_matrix_level[key][node.id]
+            ids = self._sorted_ids[key]
+            del ids[bisect_left(ids, node.id)]
+            self._clear_runs(key)
+        return removed
+
+    def _clear_runs(self, key):
+        for runs_key in [k for k in self._runs if k[:3] == key]:
+            del self._runs[runs_key]
+
+    # - LOOKUP - #
+    def get(self, io_type, matrix, level, swp_id):
+        """
+        :param io_type: str - 'source' or 'destination'
+        :return: Node or None
+        """
+        return self._nodes.get((io_type, matrix, level, swp_id))
+
+    def source(self, matrix, level, swp_id):
+        return self._nodes.get((SOURCE, matrix, level, swp_id))
+
+    def destination(self, matrix, level, swp_id):
+        return self._nodes.get((DESTINATION, matrix, level, swp_id))
+
+    def match_source(self, msg):
+        """
+        :param msg: swp_message object with matrix, level & source attributes, e.g. Connect
+        :return: source Node or None
+        """
+        return self._nodes.get((SOURCE, msg.matrix, msg.level, msg.source))
+
+    def match_destination(self, msg):
+        """
+        :param msg: swp_message object with matrix, level & destination attributes, e.g. Connect
+        :return: destination Node or None
+        """
+        return self._nodes.get((DESTINATION, msg.matrix, msg.level, msg.destination))
+
+    # - ITERATION - #
+    def ids(self, io_type, matrix, level):
+        """
+        :return: sorted list of the IDs of the given type on the matrix & level (do not modify)
+        """
+        return self._sorted_ids.get((io_type, matrix, level), [])
+
+    def runs(self, io_type, matrix, level, max_run=64):
+        """
+        :param max_run: int, max length of a run (max tally qty in a tally dump message is 64)
+        :return: list of lists of consecutive IDs of the given type on the matrix & level,
+                 cached until Nodes are added to or removed from the matrix & level (do not modify)
+        """
+        key = (io_type, matrix, level, max_run)
+        runs = self._runs.get(key)
+        if runs is None:
+            runs = self._runs[key] = list(iter_consecutive_runs(self.ids(io_type, matrix, level), max_run))
+        return runs
+
+    def nodes(self, io_type, matrix, level):
+        """
+        :return: list of Nodes of the given type on the matrix & level, sorted by ID
+        """
+        nodes = self._by_matrix_level.get((io_type, matrix, level), {})
+        return [nodes[i] for i in self.ids(io_type, matrix, level)]
+
+    def sources_at(self, matrix, level):
+        return self.nodes(SOURCE, matrix, level)
+
+    def destinations_at(self, matrix, level):
+        return self.nodes(DESTINATION, matrix, level)
+
+    def matrix_levels(self, io_type):
+        """
+        :return: sorted list of (matrix, level) tuples that have Nodes of the given type
+        """
+        return sorted((matrix, level) for (t, matrix, level), nodes in self._by_matrix_level.items()
+                      if t == io_type and nodes)
+
+    @property
+    def sources(self):
+        """ All sources, sorted by matrix, level & ID """
+        return [node for matrix, level in self.matrix_levels(SOURCE) for node in self.sources_at(matrix, level)]
+
+    @property
+    def destinations(self):
+        """ All destinations, sorted by matrix, level & ID """
+        return [node for matrix, level in self.matrix_levels(DESTINATION)
+                for node in self.destinations_at(matrix, level)]
+
+
+def test_catalogue():
+    catalogue = IOCatalogue([Node.source(0, 0, i) for i in (5, 1, 3)],
+                            [Node.destination(0, 0, i) for i in (9, 7)] + [Node.destination(1, 2, 0)])
+    catalogue.add(Node.source(0, 0, 2))
+    catalogue.remove(Node.source(0, 0, 3))
+
+    runs = catalogue.runs(SOURCE, 0, 0)
+    catalogue.add(Node.source(0, 0, 4))
+
+    passed = catalogue.ids(SOURCE, 0, 0) == [1, 2, 4, 5] \
+        and runs == [[1, 2], [5]] and catalogue.runs(SOURCE, 0, 0) == [[1, 2], [4, 5]] \
+        and catalogue.destination(0, 0, 7).id == 7 \
+        and catalogue.destination(0, 0, 8) is None \
+        and catalogue.source(0, 0, 3) is None \
+        and [n.id for n in catalogue.destinations] == [7, 9, 0] \
+        and catalogue.matrix_levels(DESTINATION) == [(0, 0), (1, 2)]
+
+    if passed:
+        print("TEST CATALOGUE: PASS")
+    else:
+        print("TEST CATALOGUE: FAIL")
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    test_catalogue()
+
+    catalogue = IOCatalogue.from_csv("VirtualPatchbays.csv")
+    print(catalogue)
+    for node in catalogue.sources + catalogue.destinations:
+        print(node)
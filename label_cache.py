@@ -0,0 +1,146 @@
+# - Client-side cache of the labels last pushed to a router
+# - Calrec routers apply a pushed label to every destination fed from the same source, so pushing a label that
+# - hasn't changed still costs the router work. The cache holds the last ACK'd label per matrix, destination & label
+# - length, (padded/truncated as sent), so only labels that differ are pushed. Saved to a small JSON file so a
+# - restarted controller doesn't push everything again.
+
+import json
+import os
+import tempfile
+import threading
+
+import cli_utils
+import swp_utils
+
+TITLE = "Label Cache"
+VERSION = 0.1
+DEFAULT_CACHE_FILE = "label_cache.json"
+
+
+class LabelCache:
+    """
+    Last ACK'd label for each (matrix, destination, char_len).
+    Usage:
+        labels = cache.changed(labels, matrix, char_len)  # - Only the labels to push
+        ... push, then for each message ACK'd:
+        cache.update(acked_labels, matrix, char_len)
+        cache.save()
+    """
+    def __init__(self, filename=DEFAULT_CACHE_FILE):
+        """
+        :param filename: str - file to load from & save to, None to not persist
+        """
+        self.filename = filename
+        self._labels = {}  # - (matrix, destination, char_len): label as sent, (padded to char_len)
+        self._modified = False
+        self._lock = threading.Lock()  # - Updated from a connection's receive thread as labels are ACK'd
+        if filename:
+            self.load()
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __str__(self):
+        return "[label_cache object]: {} labels, file: {}".format(len(self._labels), self.filename)
+
+    def get(self, matrix, destination, char_len):
+        """
+        :return: str - last ACK'd label, padded to char_len, or None if not pushed
+        """
+        return self._labels.get((matrix, destination, char_len))
+
+    def changed(self, labels, matrix=0, char_len=12):
+        """
+        :param labels: dict - {destination ID: label}
+        :return: dict - {destination ID: label} for the labels that differ from those last ACK'd, (compared as sent,
+                 so e.g. labels that only differ beyond char_len are unchanged)
+        """
+        destinations = list(labels)
+        padded = swp_utils.set_label_length([labels[d] for d in destinations], char_len)
+        return {d: labels[d] for d, label in zip(destinations, padded)
+                if self._labels.get((matrix, d, char_len)) != label}
+
+    def update(self, labels, matrix=0, char_len=12):
+        """
+        Records labels as ACK'd by the router
+        :param labels: dict - {destination ID: label}
+        """
+        destinations = list(labels)
+        padded = swp_utils.set_label_length([labels[d] for d in destinations], char_len)
+        with self._lock:
+            for destination, label in zip(destinations, padded):
+                self._labels[(matrix, destination, char_len)] = label
+            self._modified = True
+
+    def update_message(self, message):
+        """
+        Records the labels of an ACK'd swp_message.PushLabels
+        """
+        with self._lock:
+            for i, label in enumerate(message.labels):
+                self._labels[(message.matrix, message.destination + i, message.char_len)] = label
+            self._modified = True
+
+    def clear(self):
+        """ Forgets every label, e.g. if the router's labels may have been changed by another controller """
+        with self._lock:
+            self._labels.clear()
+            self._modified = True
+
+    def load(self):
+        """
+        Loads the cache file, (starts empty if there isn't a valid one)
+        """
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+            self._labels = {(matrix, destination, char_len): label
+                            for matrix, destination, char_len, label in entries}
+        except (OSError, ValueError, TypeError):
+            self._labels = {}
+        self._modified = False
+
+    def save(self):
+        """
+        Writes the cache file if anything changed since loaded/saved
+        """
+        with self._lock:
+            if not self.filename or not self._modified:
+                return
+            entries = [[matrix, destination, char_len, label]
+                       for (matrix, destination, char_len), label in sorted(self._labels.items())]
+            self._modified = False
+        temp_file = self.filename + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(entries, f, separators=(',', ':'))
+            os.replace(temp_file, self.filename)
+        except OSError as e:
+            # - Not fatal, labels are just pushed again next time
+            print("[{}]: Unable to save label cache {}: {}".format(TITLE, self.filename, e))
+
+
+def test_label_cache():
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "labels.json")
+        cache = LabelCache(filename)
+        labels = {1: "Main L", 2: "Main R", 3: "Aux 1"}
+        passed = cache.changed(labels) == labels
+
+        cache.update({1: "Main L", 2: "Main R"})
+        cache.save()
+        restarted = LabelCache(filename)
+    passed = passed and restarted.changed(labels) == {3: "Aux 1"} \
+        and restarted.changed({1: "Main L      ", 2: "Main R"}) == {} \
+        and restarted.changed(labels, char_len=8) == labels \
+        and restarted.changed(labels, matrix=1) == labels and restarted.get(0, 1, 12) == "Main L      "
+
+    if passed:
+        print("TEST LABEL CACHE: PASS")
+    else:
+        print("TEST LABEL CACHE: FAIL")
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    test_label_cache()
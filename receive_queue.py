@@ -0,0 +1,133 @@
+# - Thread-safe receive buffer for socket connections
+# - Received messages are put on the queue by a connection's receive thread and taken off by the application,
+# - which can block waiting for them rather than repeatedly polling the buffer.
+
+import collections
+import threading
+import time
+
+import cli_utils
+
+TITLE = "Receive Queue"
+VERSION = 0.1
+
+DEFAULT_HIGH_WATER_MARK = 10000  # - Max messages held before the overflow policy applies
+
+# - Overflow policies, what to do when putting to a queue that is at its high water mark
+DROP_OLDEST = "drop oldest"  # - Discard the oldest message to make room (default)
+DROP_NEWEST = "drop newest"  # - Discard the message being put
+BLOCK = "block"  # - Wait for room, (the receive thread stops reading the socket until the application catches up)
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class ReceiveQueue:
+    """
+    FIFO of received messages, (deque guarded by a Condition).
+    get & get_many block until a message is available or the timeout expires, so callers do not need to busy-wait.
+    """
+    def __init__(self, high_water_mark=DEFAULT_HIGH_WATER_MARK, overflow=DROP_OLDEST):
+        """
+        :param high_water_mark: int - max number of messages to hold
+        :param overflow: str - one of OVERFLOW_POLICIES
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("[receive_queue.ReceiveQueue]: overflow must be one of {}, received: {}"
+                             .format(OVERFLOW_POLICIES, overflow))
+        self.high_water_mark = high_water_mark
+        self.overflow = overflow
+        self.dropped = 0  # - Number of messages discarded by the overflow policy
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, timeout=None):
+        """
+        :param item: message to add to the end of the queue
+        :param timeout: float - seconds to wait for room with the BLOCK overflow policy, None to wait indefinitely
+        :return: bool - False if the item was dropped
+        """
+        with self._condition:
+            if len(self._items) >= self.high_water_mark:
+                if self.overflow == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.overflow == DROP_NEWEST or \
+                        not self._condition.wait_for(lambda: len(self._items) < self.high_water_mark, timeout):
+                    self.dropped += 1
+                    return False
+
+            self._items.append(item)
+            self._condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest item
+        :param timeout: float - seconds to wait for an item, 0 to return immediately, None to wait indefinitely
+        :return: oldest item, or None if the queue is still empty after the timeout
+        """
+        with self._condition:
+            if not self._wait(timeout):
+                return None
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def get_many(self, max_items=None, timeout=None):
+        """
+        Removes and returns all items (up to max_items) in one go
+        :param max_items: int - max number of items to return, None for all
+        :param timeout: float - seconds to wait for at least one item, 0 to return immediately,
+                        None to wait indefinitely
+        :return: list of items, oldest first, (empty if the queue is still empty after the timeout)
+        """
+        with self._condition:
+            if not self._wait(timeout):
+                return []
+            if max_items is None or max_items >= len(self._items):
+                items = list(self._items)
+                self._items.clear()
+            else:
+                items = [self._items.popleft() for _ in range(max_items)]
+            self._condition.notify_all()
+            return items
+
+    def clear(self):
+        """ Discards all items """
+        with self._condition:
+            self._items.clear()
+            self._condition.notify_all()
+
+    def _wait(self, timeout):
+        # - Call with the condition held
+        if timeout == 0:
+            return len(self._items) > 0
+        return self._condition.wait_for(lambda: len(self._items) > 0, timeout)
+
+
+def test_receive_queue():
+    queue = ReceiveQueue(high_water_mark=3)
+    for i in range(5):
+        queue.put(i)
+    passed = queue.get_many() == [2, 3, 4] and queue.dropped == 2
+
+    # - Blocking get, woken by a put from another thread
+    threading.Timer(0.1, queue.put, args=("late",)).start()
+    t = time.time()
+    passed = passed and queue.get(timeout=1) == "late" and time.time() - t < 0.5
+    passed = passed and queue.get(timeout=0.1) is None and queue.get(timeout=0) is None
+
+    full = ReceiveQueue(high_water_mark=1, overflow=DROP_NEWEST)
+    passed = passed and full.put(1) and not full.put(2) and full.get() == 1
+
+    if passed:
+        print("TEST RECEIVE QUEUE: PASS")
+    else:
+        print("TEST RECEIVE QUEUE: FAIL")
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    test_receive_queue()
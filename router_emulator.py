@@ -3,17 +3,20 @@
 # - Peter Walker, June 2022
 
 import os
+import sys
 import datetime
 
 import cli_utils
 import swp_utils
-from import_io import import_io_from_csv
+from crosspoint_table import CrosspointTable
+from io_catalogue import IOCatalogue, SOURCE, DESTINATION
 from socket_connection_manager import Server
+from swp_node import Node
 import swp_message as swp_message
-import swp_node
+import swp_unpack
 
 TITLE = "SWP08/Probel Router Emulator"
-VERSION = 1.2
+VERSION = 1.3
 LOCALHOST = '127.0.0.1'
 CONFIG_FILE = 'router_emulator_settings.txt'
 
@@ -36,38 +39,163 @@ def prompt_for_csv_file():
     return csv_files[int(input("\nSelect a csv file for the I/O: "))]
 
 
+class LabelTable:
+    """
+    Source & destination names per matrix & level, (destination names are per matrix, held as level 0).
+    Responses to name requests are encoded on first request and kept until a name on that matrix & level changes.
+    """
+    def __init__(self):
+        self._names = {}  # - (io type, matrix, level): {ID: name}
+        self._responses = {}  # - (io type, matrix, level): {(char_len, ID or None for all): encoded response}
+
+    def set_names(self, io_type, matrix, level, first_id, names):
+        """
+        :param names: list of strings - names of first_id and the following consecutive IDs
+        :return: bool - True if any name changed
+        """
+        key = (io_type, matrix, level)
+        table = self._names.setdefault(key, {})
+        changed = False
+        for swp_id, name in enumerate(names, first_id):
+            name = name.rstrip()  # - Stored without padding, as it's padded to the char length requested
+            if table.get(swp_id) != name:
+                table[swp_id] = name
+                changed = True
+        if changed:
+            self._responses.pop(key, None)
+        return changed
+
+    def name(self, io_type, matrix, level, swp_id):
+        return self._names.get((io_type, matrix, level), {}).get(swp_id, "")
+
+    def response(self, io_type, matrix, level, char_len, swp_id=None):
+        """
+        :param swp_id: int - ID for a single name response, None for all names
+        :return: bytes - encoded source names (106) or destination names (107) message/s, (empty if no names)
+        """
+        responses = self._responses.setdefault((io_type, matrix, level), {})
+        encoded = responses.get((char_len, swp_id))
+        if encoded is None:
+            names = self._names.get((io_type, matrix, level), {})
+            if swp_id is not None:
+                names = {swp_id: names.get(swp_id, "")}
+            if io_type == SOURCE:
+                messages = swp_message.SourceNames.bulk(names, matrix, level, char_len)
+            else:
+                messages = swp_message.PushLabels.bulk(names, matrix, char_len)
+            writer = swp_message.FrameWriter()
+            writer.extend(messages)
+            encoded = responses[(char_len, swp_id)] = writer.getvalue()
+        return encoded
+
+
+class _LevelTallyDumps:
+    """ Encoded tally dump messages for a matrix & level, one per run of consecutive destination IDs """
+    def __init__(self, runs):
+        self.runs = runs  # - As cached by IOCatalogue.runs(), replaced if IO is added/removed
+        self.run_index = {destination: i for i, run in enumerate(runs) for destination in run}
+        self.frames = [b''] * len(runs)  # - Encoded message per run
+        self.dirty = set(range(len(runs)))  # - Indexes of runs to re-encode
+        self.response = None  # - All the frames joined, None when any are dirty
+
+
+class TallyDumpCache:
+    """
+    Encoded response to a cross-point tally dump request for each matrix & level. Connects mark just the run
+    containing their destination dirty, which is re-encoded on the next request, so repeated requests cost a
+    dictionary lookup.
+    """
+    def __init__(self, io, crosspoints):
+        """
+        :param io: IOCatalogue - destinations to include, (runs of consecutive IDs)
+        :param crosspoints: CrosspointTable - connected sources
+        """
+        self.io = io
+        self.crosspoints = crosspoints
+        self._levels = {}  # - (matrix, level): _LevelTallyDumps
+
+    def mark(self, matrix, level, destination):
+        """ Call when the destination's connected source changes """
+        cached = self._levels.get((matrix, level))
+        if cached is not None:
+            i = cached.run_index.get(destination)
+            if i is not None:
+                cached.dirty.add(i)
+                cached.response = None
+
+    def response(self, matrix, level):
+        """
+        :return: bytes - encoded cross-point tally dump messages for every destination in the IO on the matrix & level
+        """
+        runs = self.io.runs(DESTINATION, matrix, level)
+        cached = self._levels.get((matrix, level))
+        if cached is None or cached.runs is not runs:
+            cached = self._levels[(matrix, level)] = _LevelTallyDumps(runs)
+
+        if cached.response is None:
+            dirty = sorted(cached.dirty)
+            messages = self.crosspoints.tally_dumps_for_runs(matrix, level, [runs[i] for i in dirty])
+            for i, message in zip(dirty, messages):
+                cached.frames[i] = message.encoded
+            cached.dirty.clear()
+            cached.response = b''.join(cached.frames)
+        return cached.response
+
+
 class Router:
-    def __init__(self, server_connection, io_csv):
+    def __init__(self, server_connection, io_csv, verbose=True):
+        """
+        :param verbose: bool - print messages sent & received to the terminal, (turn off for load testing)
+        """
         self.connection = server_connection
+        self.verbose = verbose
         self.io_csv = io_csv
-        self.sources, self.destinations = import_io_from_csv(self.io_csv)
+        self.io = IOCatalogue.from_csv(self.io_csv)  # - Sources & destinations indexed by matrix, level & ID
+        self.crosspoints = CrosspointTable()  # - Connected source ID per destination for each matrix & level
+        self.tally_dumps = TallyDumpCache(self.io, self.crosspoints)  # - Encoded responses to tally dump requests
+        self.labels = LabelTable()  # - Names from the IO csv, destination names updated by labels pushed to us
+        for node in self.io.sources:
+            self.labels.set_names(SOURCE, node.matrix, node.level, node.id, [node.user_label or node.label])
+        for node in self.io.destinations:
+            self.labels.set_names(DESTINATION, node.matrix, 0, node.id, [node.user_label or node.label])
 
-    def process_incoming_messages(self):
-        while len(self.connection.messages):
+    def _print_message(self, timestamp, direction, message):
+        if self.verbose:
+            swp_utils.print_message(timestamp, direction, message)
 
-            timestamp, message = self.connection.get_received_message()  # - pops oldest message off the receive buffer
-            message = swp_message.decode(message)
+    def process_incoming_messages(self, timeout=None):
+        """
+        Processes all messages in the connection's receive buffer
+        :param timeout: float - seconds to wait for a message if the buffer is empty, None to wait indefinitely
+        """
+        # - Takes all messages off the receive buffer in one go, blocking until there is at least one.
+        # - Each is tagged with the client that sent it, for replying to just that client
+        for timestamp, message, client in self.connection.get_received_messages(timeout):
+            message = swp_message.LazyMessage(message)  # - Decodes fields on access
 
             # - Output to terminal
-            swp_utils.print_message(timestamp, "received", message)
+            self._print_message(timestamp, "received", message)
 
             # - Messages in the connection's receive buffer are pre-validated by checksum
             # - so send an acknowledgement of receipt
             response = swp_message.Response("ACK")
-            swp_utils.print_message(datetime.datetime.now(), "sending", response)
-            self.connection.send_message(response)
+            self._print_message(datetime.datetime.now(), "sending", response)
+            self.connection.send_message(response, client)
 
             if message.command == "connect":
-                destination = swp_utils.match_destination(message, self.destinations)
-                source = swp_utils.match_source(message, self.sources)
+                destination = self.io.match_destination(message)
+                source = self.io.match_source(message)
 
                 if destination and source:
-                    destination.connected_source = source
+                    if self.crosspoints.source(message.matrix, message.level, destination.id) != source.id:
+                        self.crosspoints.connect(message.matrix, message.level, destination.id, source.id)
+                        self.tally_dumps.mark(message.matrix, message.level, destination.id)
                     response = swp_message.Connected(source, destination)
-                    swp_utils.print_message(datetime.datetime.now(), "sending", response)
-                    connection.send_message(response)
+                    self._print_message(datetime.datetime.now(), "sending", response)
+                    # - Like a real router, tell every connected controller about the new connection
+                    self.connection.broadcast(response)
 
-                else:
+                elif self.verbose:
                     if not destination:
                         print(f"[{TITLE}.process_incoming_messages]: No destination for matrix {message.matrix}, "
                               f"level {message.level}, id {message.destination} in {self.io_csv}")
@@ -76,25 +204,145 @@ class Router:
                               f"level {message.level}, id {message.source} in {self.io_csv}")
 
             elif message.command in ('push_labels', 'push_labels_extended'):
-                print(f'[{TITLE}.process_incoming_messages]:Label/s received')
-                # TODO Apply labels to self.destinations
+                if self.verbose:
+                    print(f'[{TITLE}.process_incoming_messages]:Label/s received')
+                self.labels.set_names(DESTINATION, message.matrix, 0, message.destination, message.labels)
+
+            elif message.command in ('source names request', 'single source name request'):
+                self._send_names(client, SOURCE, message.matrix, message.level, message.char_len, message.source)
+
+            elif message.command in ('destination names request', 'single destination name request'):
+                self._send_names(client, DESTINATION, message.matrix, 0, message.char_len, message.destination)
 
             elif message.command == 'cross-point tally dump request':
                 #print(f'[{TITLE}.process_incoming_messages]:Cross-point tally dump request received for '
                 #      f'matrix:{message.matrix}, level:{message.level}')
-                consecutive_destinations = swp_node.get_consecutive_nodes(self.destinations, matrix=message.matrix, level=message.level)
+                # - One tally dump message per run of consecutive destination IDs in the IO csv,
+                # - pre-encoded and sent together
+                response = self.tally_dumps.response(message.matrix, message.level)
+                self._print_encoded(response)
+                if response:
+                    self.connection.send_message(response, client)
 
-                for destinations in consecutive_destinations:
-                    response = swp_message.CrossPointTallyDumpWord(destinations)
-                    swp_utils.print_message(datetime.datetime.now(), "sending", response)
-                    connection.send_message(response)
-
-            else:
+            elif self.verbose:
                 print(f'[{TITLE}.process_incoming_messages]:Message type unsupported: {message.command}')
 
 
+    def _print_encoded(self, response):
+        # - Prints each message in an encoded response
+        if self.verbose:
+            for message in swp_unpack.SwpStreamParser().feed(response):
+                self._print_message(datetime.datetime.now(), "sending", swp_message.LazyMessage(message))
+
+    def _send_names(self, client, io_type, matrix, level, char_len, swp_id=None):
+        response = self.labels.response(io_type, matrix, level, char_len, swp_id)
+        self._print_encoded(response)
+        if response:
+            self.connection.send_message(response, client)
+
+
+class _TestConnection:
+    # - Stands in for the Server in tests, holding messages to process and recording what is sent
+    def __init__(self, messages):
+        self.messages = [(datetime.datetime.now(), m.encoded, "client") for m in messages]
+        self.sent = []  # - (client, or None if broadcast, bytes)
+
+    def get_received_messages(self, timeout=None):
+        messages, self.messages = self.messages, []
+        return messages
+
+    def send_message(self, message, client=None):
+        self.sent.append((client, message if type(message) is bytes else message.encoded))
+
+    def broadcast(self, message):
+        self.send_message(message)
+
+
+def _sent_messages(connection):
+    # - Decodes everything sent to the test connection, except ACKs
+    encoded = b''.join(data for client, data in connection.sent)
+    return [swp_message.decode(m) for m in swp_unpack.SwpStreamParser().feed(encoded) if m != swp_utils.ACK]
+
+
+def test_tally_dump_cache():
+    # - 200 destinations, so runs of 64, 64, 64 & 8
+    io = IOCatalogue([Node.source(0, 0, i) for i in range(200)], [Node.destination(0, 0, i) for i in range(200)])
+    crosspoints = CrosspointTable()
+    for destination in range(200):
+        crosspoints.connect(0, 0, destination, destination)
+    cache = TallyDumpCache(io, crosspoints)
+    response = cache.response(0, 0)
+    frames = list(cache._levels[(0, 0)].frames)
+    passed = cache.response(0, 0) is response and len(frames) == 4
+
+    # - A Connect in the second run re-encodes only that run
+    crosspoints.connect(0, 0, 70, 5)
+    cache.mark(0, 0, 70)
+    dirty = set(cache._levels[(0, 0)].dirty)
+    changed = cache.response(0, 0)
+    new_frames = cache._levels[(0, 0)].frames
+    passed = passed and dirty == {1} and changed != response and cache.response(0, 0) is changed \
+        and [new is old for new, old in zip(new_frames, frames)] == [True, False, True, True]
+
+    # - The response decodes to the table's current state
+    received = CrosspointTable()
+    for message in swp_unpack.SwpStreamParser().feed(changed):
+        received.apply_message(swp_message.decode(message))
+    passed = passed and not received.diff(crosspoints) and received.source(0, 0, 70) == 5
+
+    if passed:
+        print("TEST TALLY DUMP CACHE: PASS")
+    else:
+        print("TEST TALLY DUMP CACHE: FAIL")
+
+
+def test_names(io_csv="VirtualPatchbays.csv"):
+    router = Router(_TestConnection([]), io_csv, verbose=False)
+    destination = router.io.destinations[0]  # - ID 10, label 'labelA'
+    source = router.io.sources[0]  # - ID 0, label 'label1'
+
+    # - All destination names, then a single source name, padded to the char length requested
+    router.connection = _TestConnection([swp_message.GetDestinationNames(destination.matrix, char_len=8),
+                                         swp_message.GetSourceNames(source.matrix, source.level, char_len=4,
+                                                                    source=source.id)])
+    router.process_incoming_messages()
+    names, single = _sent_messages(router.connection)
+    passed = names.command == "push_labels" and names.destination == destination.id \
+        and names.labels[0] == "labelA  " and all(len(label) == 8 for label in names.labels) \
+        and single.command == "source names" and single.source == source.id and single.labels == ["labe"]
+
+    # - A pushed label that changes a name drops the cached response, one that doesn't keeps it
+    cached = router.labels.response(DESTINATION, destination.matrix, 0, 8)
+    router.connection = _TestConnection([swp_message.PushLabels(destination.id, ["Main L"], destination.matrix, 8)])
+    router.process_incoming_messages()
+    renamed = router.labels.response(DESTINATION, destination.matrix, 0, 8)
+    router.connection = _TestConnection([swp_message.PushLabels(destination.id, ["Main L"], destination.matrix, 8),
+                                         swp_message.PushLabels(300, ["Extended"], 20, 8)])
+    router.process_incoming_messages()
+    passed = passed and renamed != cached and router.labels.response(DESTINATION, destination.matrix, 0, 8) is renamed \
+        and router.labels.name(DESTINATION, destination.matrix, 0, destination.id) == "Main L" \
+        and router.labels.name(DESTINATION, 20, 0, 300) == "Extended"
+
+    # - Names of a matrix above 15 are returned in extended (235) messages
+    router.connection = _TestConnection([])
+    router._send_names("client", DESTINATION, 20, 0, 12, 300)
+    extended, = _sent_messages(router.connection)
+    passed = passed and extended.command == "push_labels_extended" and extended.matrix == 20 \
+        and extended.labels == ["Extended    "] \
+        and router.connection.sent[0][0] == "client"
+
+    if passed:
+        print("TEST NAMES: PASS")
+    else:
+        print("TEST NAMES: FAIL")
+
+
 if __name__ == '__main__':
     cli_utils.print_header(TITLE, VERSION)
+    if sys.argv[1:] == ["--test"]:
+        test_tally_dump_cache()
+        test_names()
+        sys.exit()
 
     # - Check to see if there is a config file
     try:
@@ -118,10 +366,10 @@ if __name__ == '__main__':
     router = Router(connection, io_filename)
 
     print("Sources:")
-    for src in router.sources:
+    for src in router.io.sources:
         print(src)
     print("Destinations:")
-    for dst in router.destinations:
+    for dst in router.io.destinations:
         print(dst)
 
     print("Listening for client connections...")
@@ -0,0 +1,190 @@
+# - Client-side mirror of a router's crosspoint state
+# - Kept current from the Connected and cross-point tally dump messages received from the router, so a controller
+# - can look up what is routed where without requesting a tally dump from the router each time.
+#
+# - Usage:
+# -   mirror = RouterMirror()
+# -   mirror.attach(connection)  # - client_connection.Connection, or call mirror.apply(message) for each received
+# -   mirror.source(matrix, level, destination)
+# -   mirror.destinations(matrix, level, source)
+
+import threading
+
+import cli_utils
+import swp_message
+import swp_utils
+from crosspoint_table import CrosspointTable, DEFAULT_SIZE
+
+TITLE = "Router Mirror"
+VERSION = 0.1
+
+# - Command bytes of the messages that carry crosspoint state, any others are ignored without decoding
+CONNECTED = swp_utils.COMMANDS["connected"]
+TALLY_DUMPS = (swp_utils.COMMANDS["cross-point tally dump (byte)"],
+               swp_utils.COMMANDS["cross-point tally dump (word/extended)"])
+
+
+class RouterMirror:
+    """
+    Connected source of each destination (a CrosspointTable) plus a reverse index of the destinations fed by each
+    source, per matrix & level. Both lookups are O(1).
+    version is incremented whenever a crosspoint changes, so callers can tell if anything changed since they last
+    looked. Updates can come from a connection's receive thread while queried from another, so access is locked.
+    """
+    def __init__(self, size=DEFAULT_SIZE):
+        """
+        :param size: int - initial number of destination IDs per matrix & level, (grown to fit those received)
+        """
+        self.table = CrosspointTable(size)
+        self.version = 0
+        self.updates = 0  # - Number of Connected/tally dump messages applied, whether or not anything changed
+        self._fed = {}  # - (matrix, level): {source ID: set of destination IDs}
+        self._dumped = set()  # - (matrix, level) that tally dumps have been received for
+        self._condition = threading.Condition()
+
+    def __str__(self):
+        return "[router_mirror object]: version {}, {} matrix/levels, tally dumps received for {}".format(
+            self.version, len(self.table.matrix_levels()), sorted(self._dumped))
+
+    # - UPDATE - #
+    def attach(self, connection):
+        """
+        Keeps the mirror current from the messages received by the connection
+        :param connection: client_connection.Connection
+        """
+        connection.add_listener(self.on_message)
+
+    def detach(self, connection):
+        connection.remove_listener(self.on_message)
+
+    def on_message(self, timestamp, message):
+        """
+        Listener for client_connection.Connection.add_listener
+        :param message: bytes - received message
+        """
+        self.apply(message)
+
+    def apply(self, message):
+        """
+        Updates the mirror from a Connected or cross-point tally dump message, anything else is ignored
+        :param message: bytes (as received), swp_message object or swp_message.LazyMessage
+        :return: bool - True if any crosspoint changed
+        """
+        if type(message) is bytes:
+            if len(message) <= swp_utils.COMMAND_BYTE or message[swp_utils.COMMAND_BYTE] not in TALLY_DUMPS + (
+                    CONNECTED,):
+                return False
+            message = swp_message.decode(message)
+            if message is None:
+                return False
+
+        if message.command == "connected":
+            return self._update(message.matrix, message.level, [(message.destination, message.source)])
+        if message.command in ("cross-point tally dump (byte)", "cross-point tally dump (word/extended)"):
+            return self._update(message.matrix, message.level, message.connections(), dumped=True)
+        return False
+
+    def _update(self, matrix, level, tallies, dumped=False):
+        """
+        :param tallies: iterable of (destination, source)
+        """
+        tallies = list(tallies)
+        changed = False
+        with self._condition:
+            # - Grown to fit every destination before any are changed, so a message is applied fully or not at all
+            sources = self.table.level(matrix, level, max(destination for destination, source in tallies) + 1
+                                       if tallies else 0)
+            fed = self._fed.setdefault((matrix, level), {})
+            for destination, source in tallies:
+                previous = int(sources[destination])
+                if previous == source:
+                    continue
+                sources[destination] = source
+                if previous != swp_utils.MUTE_ID:
+                    destinations = fed[previous]
+                    destinations.discard(destination)
+                    if not destinations:
+                        del fed[previous]
+                if source != swp_utils.MUTE_ID:
+                    fed.setdefault(source, set()).add(destination)
+                changed = True
+            self.updates += 1
+            if dumped:
+                self._dumped.add((matrix, level))
+            if changed:
+                self.version += 1
+            # - Waiters are woken for every update, (e.g. a Connected confirming a crosspoint that was already made)
+            self._condition.notify_all()
+        return changed
+
+    # - QUERY - #
+    def source(self, matrix, level, destination):
+        """
+        :return: int - ID of the source connected to the destination, swp_utils.MUTE_ID if none (or not known)
+        """
+        return self.table.source(matrix, level, destination)
+
+    def destinations(self, matrix, level, source):
+        """
+        :return: sorted list of the IDs of the destinations the source is connected to
+        """
+        with self._condition:
+            return sorted(self._fed.get((matrix, level), {}).get(source, ()))
+
+    def has_tally_dump(self, matrix, level):
+        """
+        :return: bool - True if a tally dump has been received for the matrix & level, (if not, only destinations
+                 reported by Connected messages are known)
+        """
+        return (matrix, level) in self._dumped
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Blocks until predicate() is true, checked after each update
+        :param predicate: function taking no arguments, e.g. lambda: mirror.source(0, 0, 5) == 10
+        :param timeout: float - max seconds to wait, None to wait indefinitely
+        :return: bool - the last result of predicate()
+        """
+        with self._condition:
+            return self._condition.wait_for(predicate, timeout)
+
+    def copy(self):
+        """
+        :return: CrosspointTable - snapshot of the mirrored state, e.g. to diff() against
+        """
+        with self._condition:
+            return self.table.copy()
+
+
+def test_router_mirror():
+    mirror = RouterMirror()
+    dump = swp_message.CrossPointTallyDumpWord.from_sources(0, 0, 10, [1, 2, 1, swp_utils.MUTE_ID])
+    passed = mirror.apply(dump.encoded) and mirror.version == 1 and mirror.has_tally_dump(0, 0) \
+        and mirror.destinations(0, 0, 1) == [10, 12] and mirror.source(0, 0, 13) == swp_utils.MUTE_ID
+
+    # - Destination 12 moved from source 1 to 2, then the same again which is not a change
+    connected = swp_message.Connected(2, 12, 0, 0).encoded
+    passed = passed and mirror.apply(connected) and not mirror.apply(connected) and mirror.version == 2 \
+        and mirror.destinations(0, 0, 1) == [10] and mirror.destinations(0, 0, 2) == [11, 12] \
+        and not mirror.has_tally_dump(1, 1)
+
+    # - Other messages are ignored, updates from another thread wake waiters
+    passed = passed and not mirror.apply(swp_message.Connect(5, 5, 0, 0).encoded) and mirror.version == 2
+    threading.Timer(0.05, mirror.apply, [swp_message.Connected(7, 500, 1, 1)]).start()
+    passed = passed and mirror.wait_for(lambda: mirror.source(1, 1, 500) == 7, timeout=1) \
+        and not mirror.wait_for(lambda: mirror.source(1, 1, 501) == 7, timeout=0.05)
+
+    # - A tally dump running past destination 1023 is applied in full
+    dump = swp_message.CrossPointTallyDumpWord.from_sources(0, 0, 1020, [3] * 8)
+    passed = passed and mirror.apply(dump.encoded) and mirror.version == 4 \
+        and mirror.destinations(0, 0, 3) == list(range(1020, 1028)) and mirror.source(0, 0, 1027) == 3
+
+    if passed:
+        print("TEST ROUTER MIRROR: PASS")
+    else:
+        print("TEST ROUTER MIRROR: FAIL")
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    test_router_mirror()
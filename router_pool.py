@@ -0,0 +1,294 @@
+# - Pool of SWP08/Probel router connections on one asyncio event loop
+# - Each router is an AsyncClient (swp_async_client.py), kept connected by the pool with a shared reconnect/backoff
+# - policy. Messages to send are queued per router and sent once it is connected, and messages received from every
+# - router are merged into one stream tagged with the router's name.
+
+import asyncio
+import random
+
+import cli_utils
+import swp_message
+import swp_utils
+from receive_queue import DEFAULT_HIGH_WATER_MARK
+from swp_async_client import AsyncClient
+from swp_pipeline import AckTimeout
+from swp_unpack import SwpStreamParser
+
+TITLE = "Router Pool"
+VERSION = 0.1
+
+
+class ReconnectPolicy:
+    """ Exponential backoff between connection attempts, shared by every router in a pool """
+    def __init__(self, initial_delay=0.5, max_delay=30, multiplier=2, jitter=0.1):
+        """
+        :param initial_delay: float - seconds to wait after the first failed attempt
+        :param max_delay: float - max seconds between attempts
+        :param multiplier: float - delay is multiplied by this after each failed attempt
+        :param jitter: float - fraction of the delay to randomly add, so routers don't all retry in step
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """
+        :param attempt: int - number of failed attempts so far, (0 for the first)
+        :return: float - seconds to wait before the next attempt
+        """
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** attempt)
+        return delay + delay * self.jitter * random.random()
+
+
+class _Router:
+    """ A router in the pool, its client, outgoing message queue and the tasks the pool runs for it """
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.send_queue = asyncio.Queue()  # - (message, future) to send once connected
+        self.tasks = []
+
+
+class RouterPool:
+    """
+    Many router connections driven by one asyncio event loop, (no thread per router).
+    Usage:
+        async with RouterPool() as pool:
+            pool.add("192.169.1.201", name="studio 1")
+            await pool.send("studio 1", swp_message.Connect(...))
+            async for name, message in pool.messages():
+                ...
+    """
+    def __init__(self, reconnect_policy=None, high_water_mark=DEFAULT_HIGH_WATER_MARK, **client_options):
+        """
+        :param reconnect_policy: ReconnectPolicy, (default ReconnectPolicy())
+        :param high_water_mark: int - max received messages held for messages(), oldest dropped when full
+        :param client_options: keyword arguments for each AsyncClient, e.g. ack_timeout, window
+        """
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy()
+        self.high_water_mark = high_water_mark
+        self.client_options = client_options
+        self.dropped = 0  # - Number of received messages discarded when over the high water mark
+        self._routers = {}  # - name: _Router
+        self._messages = asyncio.Queue()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._routers)
+
+    def __getitem__(self, name):
+        """
+        :return: the router's AsyncClient
+        """
+        return self._routers[name].client
+
+    def __str__(self):
+        return "[router_pool object]: {} routers, {} connected".format(
+            len(self._routers), sum(1 for r in self._routers.values() if r.client.connected.is_set()))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # - ROUTERS - #
+    def add(self, address, port=swp_utils.PORT, name=None):
+        """
+        Adds a router and starts connecting to it, (call from within the event loop)
+        :param name: str - name to identify the router by, (default the address)
+        :return: str - the router's name
+        """
+        name = address if name is None else name
+        if name in self._routers:
+            raise ValueError("[{}]: Router {} already in the pool".format(TITLE, name))
+
+        router = self._routers[name] = _Router(name, AsyncClient(address, port, **self.client_options))
+        router.tasks = [asyncio.create_task(self._keep_connected(router)),
+                        asyncio.create_task(self._send_queued(router)),
+                        asyncio.create_task(self._receive(router))]
+        return name
+
+    async def remove(self, name):
+        """ Disconnects the router and removes it from the pool """
+        router = self._routers.pop(name)
+        await self._stop(router)
+
+    async def close(self):
+        """ Disconnects every router and ends any messages() iteration """
+        self._closed = True
+        for name in list(self._routers):
+            await self.remove(name)
+        self._messages.put_nowait(None)
+
+    async def _stop(self, router):
+        for task in router.tasks:
+            task.cancel()
+        router.client.close()
+        await router.client.wait_closed()
+        await asyncio.gather(*router.tasks, return_exceptions=True)
+        while not router.send_queue.empty():
+            message, future = router.send_queue.get_nowait()
+            if not future.done():
+                future.set_exception(ConnectionError("[{}]: Router {} removed".format(TITLE, router.name)))
+
+    def names(self):
+        return list(self._routers)
+
+    def status(self):
+        """
+        :return: dict - {router name: connection status}
+        """
+        return {name: router.client.status for name, router in self._routers.items()}
+
+    async def wait_connected(self, name=None):
+        """
+        :param name: str - router to wait for, None to wait for all of them
+        """
+        names = self.names() if name is None else [name]
+        await asyncio.gather(*(self._routers[n].client.wait_connected() for n in names))
+
+    # - SEND / RECEIVE - #
+    def send(self, name, message):
+        """
+        Queues a message for the router, sent (pipelined) as soon as it is connected
+        :param name: str - router name
+        :param message: bytes or swp_message object
+        :return: asyncio.Future - result True once ACK'd, or raises swp_pipeline.SendError, or ConnectionError
+                 if the connection is lost before it is ACK'd
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._routers[name].send_queue.put_nowait((message, future))
+        return future
+
+    def broadcast(self, message):
+        """
+        Queues a message for every router
+        :return: dict - {router name: asyncio.Future}
+        """
+        return {name: self.send(name, message) for name in self._routers}
+
+    async def messages(self):
+        """
+        Async iterator of messages received from every router (other than ACK/NAK), until close() is called
+        :return: (router name, swp_message.LazyMessage) tuples
+        """
+        while True:
+            item = await self._messages.get()
+            if item is None:
+                return
+            yield item
+
+    # - TASKS, one of each per router - #
+    async def _keep_connected(self, router):
+        attempt = 0
+        while not self._closed:
+            try:
+                await router.client.connect()
+                attempt = 0
+                await router.client.wait_closed()  # - Until the connection is lost
+            except (OSError, asyncio.TimeoutError) as e:
+                print("[{}]: Failed to connect to {}: {!r}".format(TITLE, router.name, e))
+            delay = self.reconnect_policy.delay(attempt)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _send_queued(self, router):
+        while True:
+            message, future = await router.send_queue.get()
+            await router.client.wait_connected()
+            if future.done():
+                continue  # - Cancelled by the caller while queued
+            try:
+                sent = router.client.send_pipelined(message)
+            except ConnectionError as e:
+                future.set_exception(e)
+                continue
+            sent.add_done_callback(lambda sent, future=future: _chain(sent, future))
+
+    async def _receive(self, router):
+        async for message in router.client.messages():
+            if self._messages.qsize() >= self.high_water_mark:
+                self._messages.get_nowait()
+                self.dropped += 1
+            self._messages.put_nowait((router.name, message))
+
+
+def _chain(source, target):
+    # - Copies the outcome of one future to another
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception():
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+async def _test_router(reader, writer):
+    # - ACKs everything, replying Connected to Connects, except Connects to destination 3 which get no response.
+    # - Stops when sent a Connect to destination 0
+    parser = SwpStreamParser()
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            break
+        for encoded in parser.feed(data):
+            if encoded == swp_utils.ACK:
+                continue
+            message = swp_message.decode(encoded)
+            if message.destination == 3:
+                continue
+            writer.write(swp_utils.ACK + swp_message.Connected(message.source, message.destination,
+                                                               message.matrix, message.level).encoded)
+            if message.destination == 0:
+                writer.close()
+                return
+    writer.close()
+
+
+async def test_router_pool():
+    servers = [await asyncio.start_server(_test_router, "127.0.0.1", 0) for _ in range(3)]
+    ports = [server.sockets[0].getsockname()[1] for server in servers]
+
+    async with RouterPool(ReconnectPolicy(initial_delay=0.05), ack_timeout=0.5, max_send_attempts=2) as pool:
+        for i, port in enumerate(ports):
+            pool.add("127.0.0.1", port, name="router {}".format(i))
+        await asyncio.wait_for(pool.wait_connected(), 2)
+
+        # - Router 0 drops the connection after this message, so the next must wait for the pool to reconnect
+        await pool.send("router 0", swp_message.Connect(1, 0, 0, 0))
+        await pool["router 0"].wait_closed()
+        futures = pool.broadcast(swp_message.Connect(2, 5, 0, 0))
+        passed = all(await asyncio.wait_for(asyncio.gather(*futures.values()), 2))
+
+        received = []
+        async for name, message in pool.messages():
+            received.append((name, message.destination))
+            if len(received) == 4:
+                break
+
+        # - An unanswered Connect in the middle of a batch fails just one message, later sends still succeed
+        futures = [pool.send("router 1", swp_message.Connect(2, destination, 0, 0)) for destination in (6, 3, 7, 8)]
+        results = await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), 5)
+        passed = passed and [type(r) for r in results].count(AckTimeout) == 1 and results.count(True) == 3 \
+            and await asyncio.wait_for(pool.send("router 1", swp_message.Connect(2, 9, 0, 0)), 2)
+
+    passed = passed and sorted(received) == [("router 0", 0), ("router 0", 5), ("router 1", 5), ("router 2", 5)] \
+        and not len(pool)
+
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+    if passed:
+        print("TEST ROUTER POOL: PASS")
+    else:
+        print("TEST ROUTER POOL: FAIL")
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    asyncio.run(test_router_pool())
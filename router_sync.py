@@ -0,0 +1,344 @@
+# - Desired-state sync for SWP08/Probel routers
+# - Applies a routing map (e.g. a show file / scene) by sending Connects for only the destinations whose source
+# - differs from the router's current state, rather than a Connect for every destination in the map.
+# - Current state is taken from tally dumps via a RouterMirror, the Connects are sent pipelined, and the result is
+# - verified from the Connected messages the router sends back.
+#
+# - Usage:
+# -   python router_sync.py scene.csv --address 192.169.1.201            (apply the scene)
+# -   python router_sync.py scene.json --address 192.169.1.201 --dry-run  (only list what would change)
+#
+# - Routing map files have a row per destination with matrix, level, destination & source, (one based as per the
+# - Calrec UI/csv unless --zero-based). A blank source disconnects the destination. CSV files have a header row with
+# - those column names, JSON files are a list of objects with those keys.
+
+import argparse
+import socket
+import sys
+import threading
+import time
+from array import array
+
+import cli_utils
+import swp_message
+import swp_utils
+from client_connection import Connection
+from crosspoint_table import CrosspointTable
+from router_mirror import RouterMirror
+from swp_pipeline import DEFAULT_WINDOW, SendError
+from swp_unpack import SwpStreamParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TITLE = "Router Sync"
+VERSION = 0.1
+
+FIELDS = ("matrix", "level", "destination", "source")
+SETTLE_TIME = 0.2  # - Seconds without tally dump messages after which a tally dump is taken to be complete
+TIMEOUT = swp_utils.ACK_TIMEOUT  # - Seconds to wait for tally dumps, and for Connects to be confirmed
+
+
+class DesiredState:
+    """
+    Routing map to apply. For each matrix & level, a sorted array of destination IDs and a parallel array of the
+    source ID each should be connected to. Only the destinations in the map are synced, others are left as they are.
+    """
+    def __init__(self):
+        self._levels = {}  # - (matrix, level): (array('H') of destination IDs, array('H') of source IDs)
+
+    def __len__(self):
+        return sum(len(destinations) for destinations, sources in self._levels.values())
+
+    def __str__(self):
+        return "[desired_state object]: {} destinations over {} matrix/levels".format(len(self), len(self._levels))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: iterable of (matrix, level, destination, source) tuples, zero based. If a destination is
+                     listed more than once the last row wins
+        """
+        levels = {}
+        for matrix, level, destination, source in rows:
+            levels.setdefault((matrix, level), {})[destination] = source
+
+        state = cls()
+        for key, connections in levels.items():
+            destinations = sorted(connections)
+            state._levels[key] = (array('H', destinations), array('H', [connections[d] for d in destinations]))
+        return state
+
+    @classmethod
+    def load(cls, filename, one_based=True):
+        """
+        :param filename: str - .json file, or CSV file
+        :param one_based: bool - IDs in the file are one based, (as per the Calrec UI/csv)
+        """
+        return cls.from_rows(read_rows(filename, one_based))
+
+    def matrix_levels(self):
+        return sorted(self._levels)
+
+    def connections(self):
+        """
+        :return: iterator of (matrix, level, destination, source) tuples
+        """
+        for (matrix, level), (destinations, sources) in sorted(self._levels.items()):
+            for destination, source in zip(destinations, sources):
+                yield matrix, level, destination, source
+
+    def diff(self, table, unknown=()):
+        """
+        :param table: CrosspointTable - current state, (grown to fit the map's destinations)
+        :param unknown: collection of (matrix, level) whose current state isn't known, all their destinations in
+                        the map are returned
+        :return: list of (matrix, level, destination, source) tuples for the destinations whose source in the
+                 table differs from this map, (the Connects to send)
+        """
+        changes = []
+        for (matrix, level), (destinations, sources) in sorted(self._levels.items()):
+            current = table.level(matrix, level, destinations[-1] + 1)
+            if (matrix, level) in unknown:
+                changed = range(len(destinations))
+            elif table.use_numpy:
+                # - Compares the whole level at once
+                wanted = numpy.frombuffer(sources, dtype=numpy.uint16)
+                indexes = numpy.frombuffer(destinations, dtype=numpy.uint16)
+                changed = numpy.nonzero(current[indexes] != wanted)[0].tolist()
+            else:
+                changed = [i for i, (d, s) in enumerate(zip(destinations, sources)) if current[d] != s]
+            changes += [(matrix, level, destinations[i], sources[i]) for i in changed]
+        return changes
+
+
+def read_rows(filename, one_based=True):
+    """
+    :return: list of (matrix, level, destination, source) tuples, zero based, source swp_utils.MUTE_ID if blank
+    """
+    records = cli_utils.read_records(filename)
+    offset = 1 if one_based else 0
+    rows = []
+    for i, record in enumerate(records):
+        try:
+            values = [record.get(field) for field in FIELDS]
+            if values[-1] in (None, ""):
+                values[-1] = swp_utils.MUTE_ID + offset
+            matrix, level, destination, source = (int(value) - offset for value in values)
+        except (TypeError, ValueError):
+            raise ValueError("[{}]: Row {} of {}, expected integer {}, got {}".format(
+                TITLE, i + 1, filename, ", ".join(FIELDS), record))
+        if not (0 <= matrix <= 15 and 0 <= level <= 15 and 0 <= destination <= swp_utils.MUTE_ID
+                and 0 <= source <= swp_utils.MUTE_ID):
+            raise ValueError("[{}]: Row {} of {}, value out of range: {}".format(TITLE, i + 1, filename, record))
+        rows.append((matrix, level, destination, source))
+    return rows
+
+
+class SyncResult:
+    """ Outcome of RouterSync.apply() """
+    def __init__(self, desired, changes):
+        self.desired = len(desired)  # - Number of destinations in the routing map
+        self.changes = changes  # - (matrix, level, destination, source) that differed from the router
+        self.failed = []  # - (change, exception) for Connects not ACK'd by the router
+        self.unconfirmed = []  # - Changes ACK'd but not confirmed by a Connected message in time
+        self.fetch_time = 0  # - Seconds to get the current state
+        self.apply_time = 0  # - Seconds to send the Connects & get them confirmed
+
+    @property
+    def ok(self):
+        return not self.failed and not self.unconfirmed
+
+    def __str__(self):
+        return "{} destinations in map, {} changed, {} failed, {} unconfirmed " \
+               "(state {:.3f}s, apply {:.3f}s)".format(self.desired, len(self.changes), len(self.failed),
+                                                       len(self.unconfirmed), self.fetch_time, self.apply_time)
+
+
+class RouterSync:
+    """
+    Applies a DesiredState to a router over a client_connection.Connection, sending only the Connects needed
+    """
+    def __init__(self, connection, mirror=None, timeout=TIMEOUT, settle_time=SETTLE_TIME):
+        """
+        :param mirror: RouterMirror already attached to the connection, (default a new one is attached)
+        :param timeout: float - seconds to wait for tally dumps to start, and for Connects to be confirmed
+        :param settle_time: float - seconds without tally dump messages after which a tally dump is complete
+        """
+        self.connection = connection
+        self.timeout = timeout
+        self.settle_time = settle_time
+        if mirror is None:
+            mirror = RouterMirror()
+            mirror.attach(connection)
+        self.mirror = mirror
+
+    def fetch_state(self, matrix_levels):
+        """
+        Requests a tally dump for each matrix & level not yet held by the mirror, returning once they are received
+        :return: bool - False if the router did not reply to all of them in time
+        """
+        missing = [key for key in matrix_levels if not self.mirror.has_tally_dump(*key)]
+        if not missing:
+            return True
+        self.connection.send_pipelined_many([swp_message.GetConnections(matrix, level) for matrix, level in missing])
+        received = self.mirror.wait_for(lambda: all(self.mirror.has_tally_dump(*key) for key in missing),
+                                        self.timeout)
+        # - A level may take many tally dump messages, wait for them to stop arriving
+        while True:
+            updates = self.mirror.updates
+            if not self.mirror.wait_for(lambda: self.mirror.updates != updates, self.settle_time):
+                return received
+
+    def plan(self, desired):
+        """
+        :return: list of (matrix, level, destination, source) tuples - the Connects needed to apply desired
+        """
+        self.fetch_state(desired.matrix_levels())
+        unknown = [key for key in desired.matrix_levels() if not self.mirror.has_tally_dump(*key)]
+        if unknown:
+            print("[{}]: No tally dump received for matrix/levels {}, "
+                  "all their destinations in the map will be sent".format(TITLE, unknown))
+        return desired.diff(self.mirror.copy(), unknown)
+
+    def apply(self, desired, dry_run=False):
+        """
+        :param desired: DesiredState
+        :param dry_run: bool - only work out the changes, don't send them
+        :return: SyncResult
+        """
+        start = time.monotonic()
+        changes = self.plan(desired)
+        result = SyncResult(desired, changes)
+        result.fetch_time = time.monotonic() - start
+        if dry_run or not changes:
+            return result
+
+        start = time.monotonic()
+        futures = self.connection.send_pipelined_many([swp_message.Connect(source, destination, matrix, level)
+                                                       for matrix, level, destination, source in changes])
+        sent = []
+        for change, future in zip(changes, futures):
+            try:
+                future.result()
+                sent.append(change)
+            except (SendError, ConnectionError) as e:
+                result.failed.append((change, e))
+
+        def unconfirmed():
+            return [(m, l, d, s) for m, l, d, s in sent if self.mirror.source(m, l, d) != s]
+        self.mirror.wait_for(lambda: not unconfirmed(), self.timeout)
+        result.unconfirmed = unconfirmed()
+        result.apply_time = time.monotonic() - start
+        return result
+
+
+def _test_router(listener, table):
+    # - Minimal router for testing, ACKs everything, replying Connected to Connects and tally dumps to
+    # - tally dump requests, from/to table, (no tally dumps for matrix 2, no response to Connects to destination 99)
+    sock, address = listener.accept()
+    parser = SwpStreamParser()
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        for encoded in parser.feed(data):
+            if encoded == swp_utils.ACK:
+                continue
+            message = swp_message.decode(encoded)
+            if message.command == "connect" and message.destination == 99:
+                continue
+            writer = swp_message.FrameWriter()
+            writer.append(swp_utils.ACK)
+            if message.command == "connect":
+                table.connect(message.matrix, message.level, message.destination, message.source)
+                writer.append(swp_message.Connected(message.source, message.destination, message.matrix,
+                                                    message.level))
+            elif message.command == "cross-point tally dump request" and message.matrix != 2:
+                size = max(table.size, table.size_of(message.matrix, message.level))
+                writer.extend(table.tally_dumps(message.matrix, message.level, range(size)))
+            writer.flush(sock)
+    sock.close()
+
+
+def test_router_sync():
+    table = CrosspointTable()
+    for destination in range(200):
+        table.connect(0, 0, destination, destination)
+    listener = socket.create_server(("127.0.0.1", 0))
+    threading.Thread(target=_test_router, args=(listener, table), daemon=True).start()
+
+    # - 200 destinations wanted, of which 3 differ, (one to be disconnected), one on another level, and a
+    # - disconnect on a level with no tally dump which is sent as its state isn't known
+    rows = [(0, 0, d, d) for d in range(200)] + [(0, 0, 5, 7), (0, 0, 150, swp_utils.MUTE_ID), (0, 0, 300, 1),
+                                                  (1, 2, 16, 16), (2, 0, 3, swp_utils.MUTE_ID)]
+    desired = DesiredState.from_rows(rows)
+    connection = Connection("127.0.0.1", port=listener.getsockname()[1], ack_timeout=0.2, max_send_attempts=2)
+    connection.wait_connected(3)
+    sync = RouterSync(connection, timeout=0.5)
+    result = sync.apply(desired)
+    again = sync.apply(desired)
+
+    passed = result.ok and len(desired) == 203 \
+        and result.changes == [(0, 0, 5, 7), (0, 0, 150, swp_utils.MUTE_ID), (0, 0, 300, 1), (1, 2, 16, 16),
+                               (2, 0, 3, swp_utils.MUTE_ID)] \
+        and again.changes == [(2, 0, 3, swp_utils.MUTE_ID)] and table.source(0, 0, 5) == 7 \
+        and table.source(1, 2, 16) == 16
+
+    # - A Connect the router doesn't respond to, in the middle of the Connects sent, is reported without failing
+    # - the others, (which one times out is down to the ACK window, ACKs carry no ID, but destination 99 is
+    # - reported as failed or unconfirmed)
+    unanswered = sync.apply(DesiredState.from_rows([(0, 0, d, 1) for d in (98, 99, 100, 101)]))
+    reported = [change for change, error in unanswered.failed] + unanswered.unconfirmed
+    passed = passed and len(unanswered.failed) == 1 and (0, 0, 99, 1) in reported \
+        and [table.source(0, 0, d) for d in (98, 99, 100, 101)] == [1, 99, 1, 1] \
+        and sync.apply(DesiredState.from_rows([(0, 0, 100, 2)])).ok and table.source(0, 0, 100) == 2
+    connection.sock.close()
+    listener.close()
+
+    if passed:
+        print("TEST ROUTER SYNC: PASS")
+    else:
+        print("TEST ROUTER SYNC: FAIL")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Connect only the destinations whose source differs from the "
+                                                 "routing map")
+    parser.add_argument("map", help="routing map, CSV or JSON, with matrix, level, destination & source per row")
+    parser.add_argument("--address", default="127.0.0.1", help="router IP address")
+    parser.add_argument("--port", type=int, default=swp_utils.PORT)
+    parser.add_argument("--zero-based", action="store_true", help="IDs in the map are zero based, (protocol "
+                                                                  "values rather than as per the Calrec UI/csv)")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="max Connects in flight awaiting ACK")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    parser.add_argument("--dry-run", action="store_true", help="list the changes without sending them")
+    options = parser.parse_args(args)
+
+    desired = DesiredState.load(options.map, one_based=not options.zero_based)
+    connection = Connection(options.address, window=options.window, port=options.port)
+    if not connection.wait_connected(options.timeout):
+        print("[{}]: Failed to connect to {}:{}".format(TITLE, options.address, options.port))
+        return False
+
+    result = RouterSync(connection, timeout=options.timeout).apply(desired, dry_run=options.dry_run)
+    offset = 0 if options.zero_based else 1
+    for matrix, level, destination, source in result.changes:
+        print("{}Matrix {}, level {}: destination {} <- source {}".format(
+            "(dry run) " if options.dry_run else "", matrix + offset, level + offset, destination + offset,
+            "none" if source == swp_utils.MUTE_ID else source + offset))
+    for change, error in result.failed:
+        print("FAILED: {} {!r}".format(change, error))
+    for change in result.unconfirmed:
+        print("UNCONFIRMED: {}".format(change))
+    print(result)
+    return result.ok
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    if len(sys.argv) > 1:
+        sys.exit(0 if main() else 1)
+    test_router_sync()
@@ -144,6 +144,14 @@ def get_settings():
     return r
 
 
+def load_settings():
+    """
+    Loads the saved connection settings without prompting the user, e.g. for non-interactive use
+    :return: dict of settings (defaults if none saved)
+    """
+    return _load_settings()
+
+
 def save_settings(config):
     with open(CONFIG_FILE, "w") as f:
         json.dump(config, f, indent=4)
@@ -1,20 +1,26 @@
 # - Server-side IP socket connection manager for SWP08/Probel Router (used by router emulator)
+# - The Server handles many clients at once on one thread, using a selector.
 # - Buffers incoming messages, provides send and receive methods.
 # - Peter Walker, June 2022.
 # - Ref for working with sockets: https://realpython.com/python-sockets/
 
+import selectors
 import socket
+import sys
 import threading
+import time
 import datetime
 
 import cli_utils
 import swp_utils
-from swp_unpack import unpack_data
+from receive_queue import ReceiveQueue
+from swp_unpack import SwpStreamParser
 
 TITLE = "Socket Connection Manager"
 VERSION = 0.1
 LOCALHOST = "127.0.0.1"
 CLIENT_CONNECTION_TIMEOUT = 3
+LISTEN_BACKLOG = 512  # - Max pending client connections, (the server can serve hundreds of clients at once)
 
 # TODO - Check is a router responds with an ACk if sent an ACK
 #        or find a benign message type that change be sent to check if the client connection is
@@ -25,37 +31,63 @@ class Connection:
     def __init__(self, ip_address, log=None):
         self.connection = None  # - the socket connection
         self.status = False
+        self.connected = threading.Event()  # - Set while a connection is up, for callers to wait on
         self.address = ip_address
         self.log = log
-        self.messages = []  # - Buffer for storing received messages
+        self.messages = ReceiveQueue()  # - Buffer for storing received messages
 
-        # - For storing data from end of a received chunk if it looks like the beginning of another message,
-        # - to check for the rest of it in the next chunk
-        self.residual_data = None
+        # - Parses received data, storing data from end of a received chunk if it looks like the beginning
+        # - of another message, to check for the rest of it in the next chunk
+        self.parser = SwpStreamParser()
 
     def _buffer_incoming_messages(self):
-        data = self.connection.recv(1024)  # - Receive up to 1MB of data
-        while data:
-            msgs, residual_data = unpack_data(data)
-            for msg in msgs:
-                self.messages.append((datetime.datetime.now(), msg))
+        self.parser.reset()  # - Don't carry partial messages over from a previous connection
+        try:
+            received = self.parser.recv_into(self.connection)  # - Receive straight into the parser's buffer
+        except ConnectionResetError:
+            received = 0
+
+        while received:
+            # - Messages are extracted as views of the parser's buffer, only copied once into the receive buffer
+            for msg in self.parser.extract_views():
+                self.messages.put((datetime.datetime.now(), bytes(msg)))
 
             try:
-                data = self.connection.recv(1024)
+                received = self.parser.recv_into(self.connection)
             except ConnectionResetError:
-                data = False
+                received = 0
 
     ########################
     # -- PUBLIC METHODS -- #
-    def get_received_message(self):
+    def wait_connected(self, timeout=None):
+        """
+        Blocks until a connection is established
+        :param timeout: float - max seconds to wait, None to wait indefinitely
+        :return: bool - True if connected
+        """
+        return self.connected.wait(timeout)
+
+    def get_received_message(self, timeout=0):
         """
         Returns and removes the first/oldest message in the received message buffer.
-        :return: tuple - (datetime.datetime object, swp_message object) or (None, None)
+        :param timeout: float - seconds to wait for a message if the buffer is empty, 0 to return immediately,
+                        None to wait indefinitely
+        :return: tuple - (datetime.datetime object, message bytes) or (None, None)
         """
-        if self.messages:
-            return self.messages.pop(0)
+        message = self.messages.get(timeout)
+        if message:
+            return message
         return None, None
 
+    def get_received_messages(self, timeout=0):
+        """
+        Returns and removes all messages in the received message buffer.
+        :param timeout: float - seconds to wait for a message if the buffer is empty, 0 to return immediately,
+                        None to wait indefinitely
+        :return: list of (datetime.datetime object, message bytes) tuples, oldest first
+        """
+        return self.messages.get_many(timeout=timeout)
+
     def send_message(self, message):
         """
         :param message: bytes or swp_message object
@@ -70,13 +102,42 @@ class Connection:
                 print(f'[{TITLE}.Connection.send_message]: Failed to send message')
 
     def flush_receive_buffer(self):
-        self.messages = []
+        self.messages.clear()
+
+
+class ServerClient:
+    """ A client connected to the Server, with its own parser and buffer of data waiting to be sent to it """
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.parser = SwpStreamParser()
+        self.outgoing = bytearray()  # - Data the socket couldn't take yet, sent when it is writable
+        self.writing = False  # - Registered with the selector for write events
+        self.closed = False
+
+    def __str__(self):
+        return "[ServerClient]: {}:{}".format(*self.address)
 
 
 class Server(Connection):
-    """ Server-side, for SWP router emulator """
-    def __init__(self, ip_address, log=None):
+    """
+    Server-side, for SWP router emulator.
+    Serves any number of clients from one thread using a selector. Received messages are buffered as
+    (timestamp, message bytes, ServerClient) so replies can be sent to the client that sent the message,
+    with send_message(message, client), or to every client with broadcast(message).
+    """
+    def __init__(self, ip_address, log=None, port=swp_utils.PORT):
         super().__init__(ip_address, log)
+        self.port = port  # - Updated to the port bound once listening, (e.g. if 0 for any free port)
+        self.listening = threading.Event()  # - Set once the server is listening for clients
+        self.clients = {}  # - (ip address, port): ServerClient
+        self._lock = threading.Lock()  # - Guards clients & their outgoing buffers, send_message is called by other threads
+        self._selector = selectors.DefaultSelector()
+        # - Written to by send_message to wake the selector when data is left waiting to be sent
+        self._wakeup_receive, self._wakeup_send = socket.socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
         # - Set up to receive messages in a separate thread
         self.receiver = threading.Thread(target=self._run)
         self.receiver.daemon = True  # - Can't remember, think I need this to be able to quit.stop thread with control+c
@@ -85,16 +146,157 @@ class Server(Connection):
     def _run(self):
         """ Called by self.receiver.start on initialisation """
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((self.address, swp_utils.PORT))
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.address, self.port))
+            s.listen(LISTEN_BACKLOG)
+            self.port = s.getsockname()[1]
+            self.listening.set()
+            s.setblocking(False)
+            self._selector.register(s, selectors.EVENT_READ, self._accept)
+            self._selector.register(self._wakeup_receive, selectors.EVENT_READ, self._wakeup)
+
             while True:
-                s.listen()
+                for key, events in self._selector.select():
+                    key.data(key.fileobj, events)
 
-                # - s.accept() seems to block until a client connects in
-                self.connection, addr = s.accept()
-                self.status = True
-                with self.connection:
-                    print(f'[{TITLE}.Server]: New connection with client:', addr, self.connection)
-                    self._buffer_incoming_messages()
+    def _accept(self, listener, events):
+        sock, address = listener.accept()
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = ServerClient(sock, address)
+        with self._lock:
+            self.clients[address] = client
+            self.status = True
+        self._selector.register(sock, selectors.EVENT_READ, lambda sock, events: self._service(client, events))
+        self.connected.set()
+        print(f'[{TITLE}.Server]: New connection with client:', address)
+
+    def _service(self, client, events):
+        if events & selectors.EVENT_READ:
+            try:
+                received = client.parser.recv_into(client.sock)  # - Receive straight into the client's parser
+            except BlockingIOError:
+                received = None
+            except OSError:
+                received = 0
+
+            if received == 0:
+                self._disconnect(client)
+                return
+
+            timestamp = datetime.datetime.now()
+            for msg in client.parser.extract_views():
+                self.messages.put((timestamp, bytes(msg), client))
+
+        if events & selectors.EVENT_WRITE:
+            with self._lock:
+                self._flush(client)
+
+    def _wakeup(self, sock, events):
+        try:
+            while sock.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            for client in list(self.clients.values()):
+                if client.outgoing and not client.writing:
+                    self._flush(client)
+
+    def _flush(self, client):
+        # - Call from the selector thread with the lock held. Sends what the socket will take of the client's
+        # - outgoing data, and registers for write events while any is left
+        try:
+            sent = client.sock.send(client.outgoing)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._disconnect(client, locked=True)
+            return
+        del client.outgoing[:sent]
+
+        writing = len(client.outgoing) > 0
+        if writing != client.writing:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self._selector.modify(client.sock, events, lambda sock, events: self._service(client, events))
+            client.writing = writing
+
+    def _disconnect(self, client, locked=False):
+        if not locked:
+            with self._lock:
+                return self._disconnect(client, locked=True)
+
+        if client.closed:
+            return
+        client.closed = True
+        self.clients.pop(client.address, None)
+        self._selector.unregister(client.sock)
+        client.sock.close()
+        print(f'[{TITLE}.Server]: Client disconnected:', client.address)
+        if not self.clients:
+            self.status = False
+            self.connected.clear()
+
+    ########################
+    # -- PUBLIC METHODS -- #
+    def get_received_message(self, timeout=0):
+        """
+        Returns and removes the first/oldest message in the received message buffer.
+        :param timeout: float - seconds to wait for a message if the buffer is empty, 0 to return immediately,
+                        None to wait indefinitely
+        :return: tuple - (datetime.datetime object, message bytes, ServerClient) or (None, None, None)
+        """
+        message = self.messages.get(timeout)
+        if message:
+            return message
+        return None, None, None
+
+    def get_received_messages(self, timeout=0):
+        """
+        Returns and removes all messages in the received message buffer.
+        :return: list of (datetime.datetime object, message bytes, ServerClient) tuples, oldest first
+        """
+        return self.messages.get_many(timeout=timeout)
+
+    def send_message(self, message, client=None):
+        """
+        :param message: bytes or swp_message object
+        :param client: ServerClient to send to, (as received with the message being replied to),
+                       None to send to every client
+        """
+        if type(message) != bytes:
+            message = message.encoded
+
+        wake = False
+        with self._lock:
+            for c in (self.clients.values() if client is None else [client]):
+                if c.closed:
+                    continue
+                if not c.outgoing:
+                    # - Send straight away, only buffering what the socket can't take
+                    try:
+                        sent = c.sock.send(message)
+                    except BlockingIOError:
+                        sent = 0
+                    except OSError:
+                        print(f'[{TITLE}.Server.send_message]: Failed to send message to', c.address)
+                        continue
+                    if sent == len(message):
+                        continue
+                    c.outgoing += message[sent:]
+                else:
+                    c.outgoing += message
+                wake = True
+
+        if wake:
+            try:
+                self._wakeup_send.send(b'\x00')
+            except BlockingIOError:
+                pass  # - Wakeup already pending
+
+    def broadcast(self, message):
+        """ Sends the message to every connected client, e.g. Connected tallies """
+        self.send_message(message)
 
 
 class Client(Connection):
@@ -115,6 +317,7 @@ class Client(Connection):
             try:
                 self.connection.connect((self.address, swp_utils.PORT))
                 self.status = True
+                self.connected.set()
                 # send an ACK to check if up, handle exceptions and reconnect if fails.
                 print('[{}.Client]: Connection established with server on address {} port {}'.format(TITLE,
                                                                                                      self.address,
@@ -124,22 +327,101 @@ class Client(Connection):
 
         with self.connection:
             self._buffer_incoming_messages()
+        self.status = False
+        self.connected.clear()
+
+
+def _receive(sock, size, timeout=2):
+    # - Reads from a test client's socket until size bytes are received or timed out
+    sock.settimeout(timeout)
+    data = bytearray()
+    try:
+        while len(data) < size:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    return bytes(data)
+
+
+def _wait_for(predicate, timeout=2):
+    end = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < end:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_server(client_count=5):
+    import swp_message
+    server = Server(LOCALHOST, port=0)
+    server.listening.wait(2)
+    clients = [socket.create_connection((LOCALHOST, server.port)) for _ in range(client_count)]
+    passed = _wait_for(lambda: len(server.clients) == client_count)
+
+    # - Each client sends a Connect to a different destination, the server replies to that client only with an ACK
+    # - & Connected for its destination, then broadcasts another Connected to all
+    for destination, sock in enumerate(clients):
+        sock.sendall(swp_message.Connect(1, destination, 0, 0).encoded)
+    received = []
+    while len(received) < client_count:
+        message = server.get_received_message(timeout=2)
+        if message[1] is None:
+            break
+        received.append(message)
+    for timestamp, message, client in received:
+        server.send_message(swp_utils.ACK + swp_message.Connected(1, swp_message.decode(message).destination,
+                                                                  0, 0).encoded, client)
+    connected = swp_message.Connected(2, 0, 0, 0).encoded
+    server.broadcast(connected)
+    replies = [swp_utils.ACK + swp_message.Connected(1, destination, 0, 0).encoded + connected
+               for destination in range(client_count)]
+    passed = passed and len(received) == client_count \
+        and all(_receive(sock, len(reply)) == reply for sock, reply in zip(clients, replies))
+
+    # - More than the socket will take is buffered and sent in order as the client reads it
+    slow, leaving = clients[0], clients[1]
+    slow_client = [c for c in server.clients.values() if c.address == slow.getsockname()][0]
+    bulk = bytes(range(256)) * 20000
+    server.send_message(bulk, slow_client)
+    server.send_message(bulk, [c for c in server.clients.values() if c.address == leaving.getsockname()][0])
+    passed = passed and _wait_for(lambda: slow_client.writing)
+
+    # - A client disconnecting with data waiting to be sent to it is dropped, the others are unaffected
+    leaving.close()
+    passed = passed and _wait_for(lambda: len(server.clients) == client_count - 1)
+    server.broadcast(connected)
+    passed = passed and _receive(slow, len(bulk) + len(connected)) == bulk + connected \
+        and all(_receive(sock, len(connected)) == connected for sock in clients[2:]) \
+        and _wait_for(lambda: not slow_client.outgoing and not slow_client.writing)
+
+    for sock in clients:
+        sock.close()
+    passed = passed and _wait_for(lambda: not server.clients and not server.status)
+
+    if passed:
+        print("TEST SERVER ({} clients): PASS".format(client_count))
+    else:
+        print("TEST SERVER ({} clients): FAIL".format(client_count))
 
 
 if __name__ == '__main__':
     import swp_message as swp
-    import time
     cli_utils.print_header(TITLE, VERSION)
+    if sys.argv[1:] == ["--test"]:
+        test_server()
+        test_server(300)
+        sys.exit()
     server = Server(LOCALHOST)
     print("Server running and listening for client connection...")
 
     ack = swp.Response()
     while True:
-        timestamp, received = server.get_received_message()
+        timestamp, received, client = server.get_received_message(timeout=1)  # - Waits up to 1s for a message
         if received:
-            print(timestamp, received)
-            server.send_message(bytes(swp_utils.ACK))
-            server.send_message(ack)
+            print(timestamp, client, received)
+            server.send_message(bytes(swp_utils.ACK), client)
+            server.send_message(ack, client)
 
-        server.send_message(swp.Response(response="NAK"))
-        time.sleep(1)
\ No newline at end of file
+        server.send_message(swp.Response(response="NAK"))
\ No newline at end of file
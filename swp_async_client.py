@@ -0,0 +1,274 @@
+# - asyncio client-side connection for SWP08/Probel controllers
+# - Runs on an asyncio event loop rather than a receive thread per connection, so one process
+# - can drive connections to many routers. Received data is parsed by swp_unpack.SwpStreamParser.
+
+import asyncio
+import datetime
+import time
+
+import cli_utils
+import swp_message
+import swp_utils
+from receive_queue import DEFAULT_HIGH_WATER_MARK
+from swp_pipeline import AckWindow, DEFAULT_WINDOW, SendError, NakError, AckTimeout
+from swp_unpack import SwpStreamParser
+
+TITLE = "Async SWP Client"
+VERSION = 0.1
+CONNECT_TIMEOUT = 3  # - Seconds to wait when opening the connection
+
+
+class _SwpProtocol(asyncio.Protocol):
+    """ Feeds received data through a stream parser, passing complete messages on to the client """
+    def __init__(self, client):
+        self.client = client
+        self.parser = SwpStreamParser()
+
+    def connection_made(self, transport):
+        self.client._connection_made(transport)
+
+    def data_received(self, data):
+        timestamp = datetime.datetime.now()
+        for message in self.parser.feed(data):
+            self.client._message_received(timestamp, message)
+
+    def connection_lost(self, exc):
+        self.client._connection_lost(exc)
+
+
+class AsyncClient:
+    """
+    asyncio SWP08 client.
+    await send() resolves when the router ACKs the message, resending on NAK or timeout up to max_send_attempts,
+    and other received messages are iterated with: async for message in client.messages()
+    Concurrent sends are pipelined, with up to window messages in flight awaiting ACK (see swp_pipeline.py).
+    """
+    def __init__(self, address, port=swp_utils.PORT, ack_timeout=swp_utils.ACK_TIMEOUT,
+                 max_send_attempts=swp_utils.MAX_SEND_ATTEMPTS, auto_ack=True,
+                 high_water_mark=DEFAULT_HIGH_WATER_MARK, log=None, window=DEFAULT_WINDOW):
+        """
+        :param window: int - max messages in flight awaiting ACK, (1 to wait for each ACK before the next send)
+        :param ack_timeout: float - seconds to wait for an ACK/NAK before resending
+        :param max_send_attempts: int - number of times to send a message before giving up
+        :param auto_ack: bool - ACK every message received from the router, as per the protocol
+        :param high_water_mark: int - max received messages held for messages(), oldest dropped when full
+        """
+        self.address = address
+        self.port = port
+        self.auto_ack = auto_ack
+        self.high_water_mark = high_water_mark
+        self.log = log
+        self.status = "Not Connected"
+        self.connected = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self.dropped = 0  # - Number of received messages discarded when over the high water mark
+
+        self._transport = None
+        self._closed = False
+        self._window = AckWindow(window, ack_timeout, max_send_attempts)
+        self._expiry = None  # - Timer handle for the oldest message in flight timing out
+        self._messages = asyncio.Queue()
+
+    def __str__(self):
+        return "AsyncClient object - IP address: {}, port: {}, status: {}".format(self.address, self.port,
+                                                                                  self.status)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+        await self.wait_closed()
+
+    # - CONNECTION - #
+    async def connect(self, timeout=CONNECT_TIMEOUT):
+        """
+        Opens the connection, raising OSError (e.g. ConnectionRefusedError) or asyncio.TimeoutError on failure
+        :return: self
+        """
+        loop = asyncio.get_running_loop()
+        self.status = "Connecting"
+        self._closed = False
+        try:
+            await asyncio.wait_for(loop.create_connection(lambda: _SwpProtocol(self), self.address, self.port),
+                                   timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.status = "Not Connected"
+            raise
+        return self
+
+    @property
+    def pending(self):
+        """ Number of messages sent or queued to send that are awaiting ACK """
+        return len(self._window)
+
+    async def wait_connected(self):
+        await self.connected.wait()
+
+    def close(self):
+        """ Closes the connection and ends any messages() iteration """
+        self._closed = True
+        if self._transport:
+            self._transport.close()
+        self._messages.put_nowait(None)
+
+    async def wait_closed(self):
+        """ Waits for the connection to be closed after calling close() """
+        if self._transport:
+            await self._disconnected.wait()
+
+    def _connection_made(self, transport):
+        self._transport = transport
+        self.status = "Connected"
+        self.connected.set()
+        self._disconnected.clear()
+        print('[{}]: Connection established with address {} on port {}'.format(TITLE, self.address, self.port))
+
+    def _connection_lost(self, exc):
+        self._transport = None
+        self.status = "Not Connected" if self._closed else "Connection Lost!"
+        self.connected.clear()
+        self._disconnected.set()
+        self._window.fail_all(ConnectionError("[{}]: Connection lost".format(TITLE)))
+        self._schedule_expiry()
+
+    # - RECEIVE - #
+    def _message_received(self, timestamp, message):
+        if message == swp_utils.ACK or message == swp_utils.NAK:
+            # - Response to the oldest message in flight, (ignored if none)
+            self._window.on_response(message)
+            self._send_frames()
+            return
+
+        if self.auto_ack and self._transport:
+            self._transport.write(swp_utils.ACK)
+
+        if self._messages.qsize() >= self.high_water_mark:
+            self._messages.get_nowait()
+            self.dropped += 1
+        self._messages.put_nowait(swp_message.LazyMessage(message, timestamp))
+
+    async def messages(self):
+        """
+        Async iterator of messages received from the router (other than ACK/NAK), until close() is called
+        :return: swp_message.LazyMessage objects, with timestamp set to the time received
+        """
+        while True:
+            message = await self._messages.get()
+            if message is None:
+                return
+            yield message
+
+    # - SEND - #
+    def send_pipelined(self, message):
+        """
+        Queues the message to send without waiting for the ACK of previous messages
+        :param message: bytes or swp_message object
+        :return: asyncio.Future - result True once ACK'd, or raises NakError/AckTimeout if not ACK'd after
+                 max attempts, ConnectionError if the connection is lost
+        """
+        if not self._transport:
+            raise ConnectionError("[{}]: Not connected".format(TITLE))
+        future = asyncio.get_running_loop().create_future()
+        self._window.submit(message, future)
+        self._send_frames()
+        return future
+
+    async def send(self, message):
+        """
+        Sends the message and waits for the router to ACK it, resending on NAK or timeout
+        :param message: bytes or swp_message object
+        :return: True once ACK'd, raises NakError/AckTimeout if not ACK'd after max attempts,
+                 ConnectionError if the connection is down
+        """
+        return await self.send_pipelined(message)
+
+    def _send_frames(self):
+        # - Writes whatever the window allows in one go, and reschedules the timeout of the oldest in flight
+        frames = self._window.to_send(asyncio.get_running_loop().time())
+        if frames and self._transport:
+            self._transport.write(b''.join(frame.encoded for frame in frames))
+            if self.log:
+                for frame in frames:
+                    self.log.log(time.time(), frame.message, 'sent')
+        self._schedule_expiry()
+
+    def _schedule_expiry(self):
+        if self._expiry:
+            self._expiry.cancel()
+            self._expiry = None
+        deadline = self._window.next_deadline()
+        if deadline is not None:
+            self._expiry = asyncio.get_running_loop().call_at(deadline, self._expire)
+
+    def _expire(self):
+        self._expiry = None
+        self._window.expire(asyncio.get_running_loop().time())
+        self._send_frames()
+
+
+async def _test_router(reader, writer):
+    # - Minimal router for testing, NAKs the first Connect to destination 1 then ACKs & replies Connected,
+    # - always NAKs destination 2, doesn't respond to destination 3 and ACKs anything else
+    parser = SwpStreamParser()
+    naked = False
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            break
+        for encoded in parser.feed(data):
+            if encoded == swp_utils.ACK:
+                continue
+            message = swp_message.decode(encoded)
+            if message.destination == 1 and naked:
+                writer.write(swp_utils.ACK + swp_message.Connected(message.source, 1, 0, 0).encoded)
+            elif message.destination in (1, 2):
+                naked = True
+                writer.write(swp_utils.NAK)
+            elif message.destination != 3:
+                writer.write(swp_utils.ACK)
+    writer.close()
+
+
+async def test_async_client():
+    server = await asyncio.start_server(_test_router, "127.0.0.1", 0)  # - Any free port
+    port = server.sockets[0].getsockname()[1]
+
+    async with AsyncClient("127.0.0.1", port, ack_timeout=0.2, max_send_attempts=2) as client:
+        passed = await client.send(swp_message.Connect(5, 1, 0, 0))
+        async for message in client.messages():
+            passed = passed and message.command == "connected" and message.source == 5
+            break
+
+        # - Pipelined, the NAK'd message is resent & fails without holding up the others
+        futures = [client.send_pipelined(swp_message.Connect(5, destination, 0, 0)) for destination in (2, 4, 5)]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        passed = passed and type(results[0]) is NakError and results[1:] == [True, True]
+
+        try:
+            await client.send(swp_message.Connect(5, 3, 0, 0))
+            passed = False
+        except AckTimeout:
+            pass
+
+        # - Sends after an unanswered message still succeed, and one unanswered in the middle of a pipelined batch
+        # - fails just one message
+        passed = passed and await client.send(swp_message.Connect(5, 4, 0, 0))
+        futures = [client.send_pipelined(swp_message.Connect(5, destination, 0, 0)) for destination in (4, 3, 5, 6)]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        passed = passed and [type(r) for r in results].count(AckTimeout) == 1 and results.count(True) == 3 \
+            and await client.send(swp_message.Connect(5, 6, 0, 0))
+
+    server.close()
+    await server.wait_closed()
+    passed = passed and client.status == "Not Connected"
+
+    if passed:
+        print("TEST ASYNC CLIENT: PASS")
+    else:
+        print("TEST ASYNC CLIENT: FAIL")
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    asyncio.run(test_async_client())
@@ -0,0 +1,320 @@
+# - SWP08/Probel load generator & latency benchmark
+# - Runs N synthetic controller clients (swp_async_client.AsyncClient, all on one event loop) against a router
+# - or the router emulator, each sending a mix of Connect, PushLabels & GetConnections messages, and reports
+# - Connect to ACK and Connect to Connected latency percentiles, frames/s and error counts.
+#
+# - Usage:
+# -   python swp_bench.py --emulator                      (starts a router emulator in a separate process)
+# -   python swp_bench.py --address 192.169.1.201 --destinations 0-63 --sources 0-63
+# -   python swp_bench.py --emulator --clients 50 --rate 20 --output run1.json --compare run0.json
+
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import sys
+
+import cli_utils
+import swp_message
+import swp_utils
+from swp_async_client import AsyncClient
+from swp_pipeline import DEFAULT_WINDOW
+
+TITLE = "SWP Bench"
+VERSION = 0.1
+LOCALHOST = "127.0.0.1"
+EMULATOR_PORT = 61001  # - Port for the emulator started by --emulator, (so it doesn't clash with a running one)
+EMULATOR_CSV = "VirtualPatchbays.csv"
+CONNECT_ATTEMPTS = 50  # - Attempts to connect each client, 0.1s apart, (gives the emulator time to start)
+DRAIN_TIMEOUT = 2  # - Seconds to wait for outstanding ACKs & Connected messages after the run
+COMMANDS = ("connect", "push_labels", "get_connections")
+PERCENTILES = (50, 90, 99)
+
+
+def parse_range(text):
+    """
+    :param text: str - IDs as "first-last" (inclusive) and/or comma separated, e.g. "0-63,100"
+    :return: list of int
+    """
+    ids = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        ids.extend(range(int(first), int(last or first) + 1))
+    return ids
+
+
+def parse_mix(text):
+    """
+    :param text: str - relative weights per command, e.g. "connect:8,push_labels:1,get_connections:1"
+    :return: dict - {command: weight}
+    """
+    mix = {}
+    for part in text.split(','):
+        command, _, weight = part.partition(':')
+        if command not in COMMANDS:
+            raise ValueError("[{}]: Unknown command {} in mix, expected one of {}".format(TITLE, command, COMMANDS))
+        mix[command] = float(weight or 1)
+    return mix
+
+
+def latency_summary(latencies):
+    """
+    :param latencies: list of float - seconds
+    :return: dict - count, mean, percentiles & max in milliseconds
+    """
+    if not latencies:
+        return {"count": 0}
+    latencies = sorted(latencies)
+    summary = {"count": len(latencies), "mean": 1000 * sum(latencies) / len(latencies)}
+    for p in PERCENTILES:
+        # - Nearest rank
+        summary["p{}".format(p)] = 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+    summary["max"] = 1000 * latencies[-1]
+    return summary
+
+
+class BenchClient:
+    """ One synthetic controller, sending a random mix of messages and timing the responses """
+    def __init__(self, index, options, destinations):
+        """
+        :param destinations: list of destination IDs for this client, (each client uses its own destinations
+                             so Connected messages broadcast by the router are matched to the right client)
+        """
+        self.index = index
+        self.options = options
+        self.destinations = destinations
+        self.random = random.Random(options.seed + index)
+        self.client = AsyncClient(options.address, options.port, ack_timeout=options.ack_timeout,
+                                  window=options.window)
+        self.sent = dict.fromkeys(COMMANDS, 0)
+        self.ack_latencies = []
+        self.connected_latencies = []
+        self.errors = {}
+        self.received = 0
+        self._awaiting_connected = {}  # - (destination, source): send time
+        self._outstanding = asyncio.Semaphore(options.window * 2)  # - Limits messages queued ahead of their ACK
+
+    def _error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def connect(self):
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                return await self.client.connect()
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(0.1)
+        raise ConnectionRefusedError("[{}]: Client {} failed to connect".format(TITLE, self.index))
+
+    def _next_message(self):
+        options = self.options
+        command = self.random.choices(list(options.mix), weights=list(options.mix.values()))[0]
+        destination = self.random.choice(self.destinations)
+        if command == "connect":
+            source = self.random.choice(options.sources)
+            return command, swp_message.Connect(source, destination, options.matrix, options.level)
+        if command == "push_labels":
+            label = "B{}-{}".format(self.index, destination)
+            return command, swp_message.PushLabels(destination, [label], options.matrix, options.char_len)
+        return command, swp_message.GetConnections(options.matrix, options.level)
+
+    async def run(self, end_time):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.options.rate if self.options.rate else 0
+        next_send = loop.time()
+        while loop.time() < end_time:
+            if interval:
+                next_send += interval
+                await asyncio.sleep(max(0, next_send - loop.time()))
+            await self._outstanding.acquire()
+
+            command, message = self._next_message()
+            sent_at = loop.time()
+            if command == "connect":
+                self._awaiting_connected[(message.destination, message.source)] = sent_at
+            try:
+                future = self.client.send_pipelined(message)
+            except ConnectionError:
+                self._error("ConnectionError")
+                self._outstanding.release()
+                break
+            self.sent[command] += 1
+            future.add_done_callback(lambda f, command=command, sent_at=sent_at: self._acked(f, command, sent_at))
+
+    def _acked(self, future, command, sent_at):
+        self._outstanding.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error:
+            self._error(type(error).__name__)
+        elif command == "connect":
+            self.ack_latencies.append(asyncio.get_running_loop().time() - sent_at)
+
+    async def receive(self):
+        async for message in self.client.messages():
+            self.received += 1
+            if message.command == "connected":
+                sent_at = self._awaiting_connected.pop((message.destination, message.source), None)
+                if sent_at is not None:
+                    self.connected_latencies.append(asyncio.get_running_loop().time() - sent_at)
+
+    async def drain(self):
+        # - Waits for everything sent to be ACK'd and for the Connected replies
+        loop = asyncio.get_running_loop()
+        end = loop.time() + DRAIN_TIMEOUT
+        while (self.client.pending or self._awaiting_connected) and loop.time() < end:
+            await asyncio.sleep(0.01)
+        if self._awaiting_connected:
+            self.errors["no Connected"] = len(self._awaiting_connected)
+
+
+async def run_bench(options):
+    """
+    :param options: argparse.Namespace as returned by parse_args()
+    :return: dict - the results
+    """
+    destinations = options.destinations
+    clients = [BenchClient(i, options, destinations[i % len(destinations)::options.clients] or destinations)
+               for i in range(options.clients)]
+    await asyncio.gather(*(c.connect() for c in clients))
+    receivers = [asyncio.create_task(c.receive()) for c in clients]
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.gather(*(c.run(start + options.duration) for c in clients))
+    await asyncio.gather(*(c.drain() for c in clients))
+    elapsed = loop.time() - start
+
+    for c in clients:
+        c.client.close()
+        await c.client.wait_closed()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    sent = {command: sum(c.sent[command] for c in clients) for command in COMMANDS}
+    errors = {}
+    for c in clients:
+        for name, count in c.errors.items():
+            errors[name] = errors.get(name, 0) + count
+    received = sum(c.received for c in clients)
+
+    return {"elapsed": elapsed,
+            "sent": sent,
+            "frames_sent_per_second": sum(sent.values()) / elapsed,
+            "frames_received": received,
+            "frames_received_per_second": received / elapsed,
+            "connect_to_ack_ms": latency_summary([t for c in clients for t in c.ack_latencies]),
+            "connect_to_connected_ms": latency_summary([t for c in clients for t in c.connected_latencies]),
+            "errors": errors}
+
+
+def run_emulator(port, csv_file, matrix, level, sources, destinations):
+    """
+    Runs the router emulator, (target for a separate process so it doesn't share the benchmark's CPU/GIL).
+    The CSV's IO is extended with the benchmark's sources & destinations so every Connect is made.
+    """
+    from router_emulator import Router
+    from socket_connection_manager import Server
+    from swp_node import Node
+
+    sys.stdout = open(os.devnull, 'w')  # - Quiet, (the server prints each client connection)
+    router = Router(Server(LOCALHOST, port=port), csv_file, verbose=False)
+    for i in sources:
+        router.io.add(Node.source(matrix, level, i))
+    for i in destinations:
+        router.io.add(Node.destination(matrix, level, i))
+    while True:
+        router.process_incoming_messages()
+
+
+def compare(results, previous_file):
+    """ Prints the change in the headline numbers from a previous run's JSON output """
+    with open(previous_file) as f:
+        previous = json.load(f)["results"]
+    rows = [("frames sent/s", ["frames_sent_per_second"]),
+            ("connect->ACK p50 ms", ["connect_to_ack_ms", "p50"]),
+            ("connect->ACK p99 ms", ["connect_to_ack_ms", "p99"]),
+            ("connect->Connected p50 ms", ["connect_to_connected_ms", "p50"]),
+            ("connect->Connected p99 ms", ["connect_to_connected_ms", "p99"])]
+    print("\nCompared with {}:".format(previous_file))
+    for name, keys in rows:
+        old, new = previous, results
+        for key in keys:
+            old, new = old.get(key, {}), new.get(key, {})
+        if old and new:
+            print("  {:<28} {:>10.2f} -> {:>10.2f} ({:+.1f}%)".format(name, old, new, 100 * (new - old) / old))
+
+
+def print_results(results):
+    print("\nElapsed: {:.2f}s, sent: {}".format(results["elapsed"], results["sent"]))
+    print("Frames/s sent: {:.0f}, received: {:.0f}".format(results["frames_sent_per_second"],
+                                                          results["frames_received_per_second"]))
+    for name in ("connect_to_ack_ms", "connect_to_connected_ms"):
+        print("{}: {}".format(name, ", ".join("{}={:.2f}".format(k, v) if type(v) is float else
+                                               "{}={}".format(k, v) for k, v in results[name].items())))
+    print("Errors:", results["errors"] or "none")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="SWP08/Probel load generator & latency benchmark")
+    parser.add_argument("--address", default=LOCALHOST, help="router address")
+    parser.add_argument("--port", type=int, default=swp_utils.PORT)
+    parser.add_argument("--emulator", action="store_true",
+                        help="start a router emulator on localhost port {} to benchmark against".format(EMULATOR_PORT))
+    parser.add_argument("--csv", default=EMULATOR_CSV, help="IO csv for the emulator")
+    parser.add_argument("--clients", type=int, default=10, help="number of controller clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send for")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages/s per client, 0 for as fast as the ACK window allows")
+    parser.add_argument("--mix", type=parse_mix, default="connect:8,push_labels:1,get_connections:1",
+                        help="relative weights of the messages sent")
+    parser.add_argument("--matrix", type=int, default=0)
+    parser.add_argument("--level", type=int, default=0)
+    parser.add_argument("--sources", type=parse_range, default="0-255", help="source IDs to connect, e.g. 0-63")
+    parser.add_argument("--destinations", type=parse_range, default="0-255",
+                        help="destination IDs to connect & label, shared out between the clients")
+    parser.add_argument("--char-len", type=int, default=8, choices=sorted(swp_utils.CHAR_LENS.values()))
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="max messages in flight per client")
+    parser.add_argument("--ack-timeout", type=float, default=swp_utils.ACK_TIMEOUT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON output of a previous run to compare with")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    emulator = None
+    if options.emulator:
+        options.address, options.port = LOCALHOST, EMULATOR_PORT
+        emulator = multiprocessing.Process(target=run_emulator, daemon=True,
+                                           args=(options.port, options.csv, options.matrix, options.level,
+                                                 options.sources, options.destinations))
+        emulator.start()
+
+    print("Benchmarking {} clients against {}:{} for {}s...".format(options.clients, options.address, options.port,
+                                                                    options.duration))
+    try:
+        results = asyncio.run(run_bench(options))
+    finally:
+        if emulator:
+            emulator.terminate()
+
+    print_results(results)
+    if options.compare:
+        compare(results, options.compare)
+    if options.output:
+        config = {k: v for k, v in vars(options).items() if k not in ("output", "compare", "sources", "destinations")}
+        config.update(sources=len(options.sources), destinations=len(options.destinations))
+        with open(options.output, 'w') as f:
+            json.dump({"timestamp": datetime.datetime.now().isoformat(), "version": VERSION,
+                       "config": config, "results": results}, f, indent=2)
+        print("Results written to", options.output)
+    return results
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    main()
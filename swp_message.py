@@ -4,15 +4,43 @@
 # - SWP08 Protocol doc:
 # - https://github.com/peterallanwalker/SWP08-Probel/blob/master/protocol%20docs/SW-P-08%20Issue%2032.pdf
 
+import socket
+import struct
+import sys
+from array import array
+
 import cli_utils
 import swp_utils as utils
 from swp_node import Node
 import swp_node
+import swp_unpack
 
 TITLE = 'SWP Messages'
 VERSION = 0.3
 
 
+FRAME_WRITER_CAPACITY = 8192  # - Initial size of a FrameWriter's buffer, (grows if needed)
+
+_SOM = bytes(utils.SOM)
+_EOM = bytes(utils.EOM)
+_DLE = bytes([utils.DLE])
+_DLE_DLE = _DLE + _DLE
+
+
+def _frame_body(payload):
+    """
+    :param payload: list of ints or bytes - command byte + data bytes
+    :return: bytes - DATA + BTC + CHK with any DLE values escaped (doubled), ready to wrap with SOM & EOM
+    """
+    data = bytes(payload)
+    byte_count = len(data)
+    body = data + bytes((byte_count, -(sum(data) + byte_count) & 0xFF))
+    if utils.DLE in body:
+        # - Escape DLEs in one pass, (byte count & checksum are of the unescaped DATA)
+        body = body.replace(_DLE, _DLE_DLE)
+    return body
+
+
 def _format_message(payload):
     """
     Takes swp command payload as list of ints per byte, adds byte-count & checksum, escapes any DLE values,
@@ -20,19 +48,117 @@ def _format_message(payload):
     :param payload: list - ints representing command bytes.
     :return: byte string - encoded SWP message.
     """
-    payload = list(payload)
-    byte_count = len(payload)
-    payload.append(byte_count)
-    checksum = utils.calculate_checksum(payload)
-    payload.append(checksum)
+    return _SOM + _frame_body(payload) + _EOM
+
+
+def _unescaped(encoded_message):
+    """
+    :param encoded_message: bytes - valid SWP message, with or without its DLEs escaped
+    :return: bytes - the message with escaped DLEs (DLE DLE) within DATA, BTC & CHK reduced to one,
+             (byte positions then match the protocol doc, as the decoders expect)
+    """
+    if _DLE_DLE not in encoded_message:
+        return encoded_message
+    body = encoded_message[2: -2]
+    if swp_unpack._is_valid_payload(body):
+        # - Already unescaped, (as returned by swp_unpack), consecutive DLEs are data
+        return encoded_message
+    return _SOM + body.replace(_DLE_DLE, _DLE) + _EOM
 
-    payload = bytes(payload)
-    if utils.DLE in payload:
-        # - Escape any DLE values within the payload
-        payload.replace(bytes([utils.DLE]), bytes([utils.DLE, utils.DLE]))
 
-    message = bytes(utils.SOM) + payload + bytes(utils.EOM)
-    return message
+def _escaped(unescaped_message):
+    """
+    :param unescaped_message: bytes - valid SWP message with its DLEs not escaped, (as passed to from_bytes)
+    :return: bytes - the message as sent over a socket, (the same bytes if there are no DLEs to escape)
+    """
+    body = unescaped_message[2: -2]
+    if utils.DLE not in body:
+        return bytes(unescaped_message)
+    return _SOM + bytes(body).replace(_DLE, _DLE_DLE) + _EOM
+
+
+class FrameWriter:
+    """
+    Encodes any number of messages into one reusable buffer to send with a single sendall, e.g. a salvo of
+    Connects or a run of tally dumps.
+    """
+    def __init__(self, capacity=FRAME_WRITER_CAPACITY):
+        """
+        :param capacity: int - bytes to preallocate
+        """
+        self._buffer = bytearray(capacity)
+        self._end = 0
+        self.frames = 0  # - Number of messages in the buffer
+
+    def __len__(self):
+        return self._end
+
+    def _write(self, data):
+        end = self._end + len(data)
+        self._buffer[self._end: end] = data  # - Overwrites the preallocated space, extending past it if needed
+        self._end = end
+
+    def append(self, message):
+        """
+        :param message: swp_message object, or encoded bytes, (e.g. utils.ACK)
+        """
+        self._write(message if type(message) is bytes else message.encoded)
+        self.frames += 1
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def append_payload(self, payload):
+        """
+        Encodes a command straight into the buffer, (adds byte count & checksum, escapes DLEs, wraps with SOM & EOM)
+        :param payload: list of ints or bytes - command byte + data bytes
+        """
+        self._write(_SOM)
+        self._write(_frame_body(payload))
+        self._write(_EOM)
+        self.frames += 1
+
+    def getvalue(self):
+        """
+        :return: bytes - everything appended since last cleared/flushed
+        """
+        return bytes(self._buffer[:self._end])
+
+    def clear(self):
+        self._end = 0
+        self.frames = 0
+
+    def flush(self, sock):
+        """
+        Sends everything appended with one sendall, then clears the buffer
+        :param sock: socket.socket
+        :return: int - number of bytes sent
+        """
+        sent = self._end
+        if sent:
+            with memoryview(self._buffer)[:sent] as view:
+                sock.sendall(view)
+        self.clear()
+        return sent
+
+
+# - Decoder registry - command byte value: message class, (each class provides a from_bytes classmethod)
+# - populated by the @_decoder class decorator as the message classes are defined, so supporting another
+# - SWP08 command is a case of adding its class.
+_DECODERS = {}
+
+
+def _decoder(*commands):
+    """
+    Class decorator, registers the class's from_bytes classmethod as the decoder for the given commands
+    :param commands: str - command names as per utils.COMMANDS
+    """
+    def register(cls):
+        for command in commands:
+            _DECODERS[utils.COMMANDS[command]] = cls
+        return cls
+    return register
 
 
 def decode(encoded_message):
@@ -41,70 +167,100 @@ def decode(encoded_message):
     :return: Message object of the appropriate Class
     """
     # First check if bytes are a simple ACK or NAK message
-    if encoded_message == bytes(utils.ACK):
+    if encoded_message == utils.ACK:
         return Response()
-    elif encoded_message == bytes(utils.NAK):
+    elif encoded_message == utils.NAK:
         return Response(response='NAK')
-    else:
-        # Get the value of the command byte and lookup the key for that value in utils.COMMANDS
-        try:
-            command = list(utils.COMMANDS.keys())[
-                list(utils.COMMANDS.values()).index(encoded_message[utils.COMMAND_BYTE])]
-        except ValueError:
-            print(f'[swp_message.decode]: Command not supported: {encoded_message[utils.COMMAND_BYTE]}')
-            return None
-
-        # Create an swp_message object based on the command type
-        if command in ('connect', 'connected'):
-            source, destination = utils.decode_connect_source_destination(encoded_message)
-            matrix, level = utils.decode_matrix_level(encoded_message)
-            return Connect(source, destination, matrix, level, command)
-
-        elif command in ('push_labels', 'push_labels_extended'):
-            destination = utils.decode_labels_destination(encoded_message)
-            matrix, level = utils.decode_matrix_level(encoded_message)
-            labels = utils.get_labels(encoded_message)
-            # - get the value of the character length byte and look up its key to get the actual char length
-            char_len = list(utils.CHAR_LEN_CODES.keys())[
-                list(utils.CHAR_LEN_CODES.values()).index(encoded_message[utils.CHAR_LEN_BYTE])]
-            return PushLabels(destination, labels, matrix, char_len)
 
-        elif command == 'cross-point tally dump request':
-            matrix, level = utils.decode_matrix_level(encoded_message)
-            return GetConnections(matrix, level)
+    # Look up the decoder for the value of the command byte
+    command_byte = encoded_message[utils.COMMAND_BYTE]
+    decoder = _DECODERS.get(command_byte)
+    if decoder:
+        return decoder.from_bytes(_unescaped(encoded_message))
 
-        # TODO, handle "cross-point tally dump (byte)" message type
-        # elif command in ("cross-point tally dump (byte)", "cross-point tally dump (word/extended)"):
-        elif command == "cross-point tally dump (word/extended)":
-            # - TODO I'm getting matrix & level in the same way for every message type so far, so move to above
-            matrix, level = utils.decode_matrix_level(encoded_message)
-            tallies = encoded_message[utils.COMMAND_BYTE + 2]  # Number of connections represented in the message
+    if command_byte in utils.COMMAND_NAMES:
+        # raise ValueError(f"[swp_massage.decode]: {command} command not yet supported")
+        print(f"[swp_massage.decode]: {utils.COMMAND_NAMES[command_byte]} command not yet supported")
+    else:
+        print(f'[swp_message.decode]: Command not supported: {command_byte}')
+    return None
 
-            first_destination_div = encoded_message[utils.COMMAND_BYTE + 3]
-            first_destination_mod = encoded_message[utils.COMMAND_BYTE + 4]
-            first_destination = 256 * first_destination_div + first_destination_mod
-            destinations = []
-            connected_sources = []
 
-            for i in range(tallies):
-                # decode the source ID and create a source node object
-                div = encoded_message[utils.COMMAND_BYTE + 5 + (i * 2)]
-                mod = encoded_message[utils.COMMAND_BYTE + 6 + (i * 2)]
-                source_id = 256 * div + mod
-                connected_sources.append(Node.source(matrix, level, source_id))
+class LazyMessage:
+    """
+    Wraps a received (pre-validated) encoded message without decoding it.
+    command, matrix and level are read straight from the header bytes, which is all that is needed to count,
+    filter or route most received messages. Any other attribute (source, destination, labels, sources...) decodes
+    the message to the appropriate message object on first access, which is cached and used for later access
+    and for __str__.
+    """
+    def __init__(self, encoded_message, timestamp=None):
+        """
+        :param encoded_message: bytes, pre-validated SWP message as received by a socket
+        :param timestamp: datetime.datetime - time the message was received, (optional)
+        """
+        self.encoded = encoded_message
+        self.timestamp = timestamp
+        self._message = None
+        self._decoded = False
 
-                # create destination node object (only the first destination is available in the encoded message,
-                # The subsequent ones have consecutive IDs
-                destination = Node.destination(matrix, level, first_destination + i)
-                destination.connected_source = connected_sources[i]
-                destinations.append(destination)
+    @property
+    def command_byte(self):
+        """
+        :return: int - value of the command byte, or None for ACK/NAK
+        """
+        if len(self.encoded) > utils.COMMAND_BYTE:
+            return self.encoded[utils.COMMAND_BYTE]
+        return None
 
-            return CrossPointTallyDumpWord(destinations)
+    @property
+    def command(self):
+        """
+        :return: str - command name as per utils.COMMANDS, 'ACK' or 'NAK', (None if the command is unknown)
+        """
+        if self.encoded == utils.ACK:
+            return "ACK"
+        if self.encoded == utils.NAK:
+            return "NAK"
+        return utils.COMMAND_NAMES.get(self.command_byte)
+
+    @property
+    def matrix(self):
+        if self.command_byte == utils.COMMANDS["push_labels_extended"]:
+            return self.encoded[utils.MATRIX_LEVEL_BYTE]  # - Whole byte is the matrix
+        return utils.decode_matrix_level(self.encoded)[0]
+
+    @property
+    def level(self):
+        if self.command_byte == utils.COMMANDS["push_labels_extended"]:
+            return 0
+        return utils.decode_matrix_level(self.encoded)[1]
+
+    @property
+    def message(self):
+        """
+        :return: The decoded message object, (None if the command is not supported)
+        """
+        if not self._decoded:
+            self._message = decode(self.encoded)
+            self._decoded = True
+        return self._message
+
+    def __getattr__(self, name):
+        # - Only called for attributes not found on the LazyMessage itself, so decode and get it from the message
+        if name.startswith('_'):
+            raise AttributeError(name)
+        message = self.message
+        if message is None:
+            raise AttributeError("[swp_message.LazyMessage]: {} not available, command {} not supported"
+                                 .format(name, self.command_byte))
+        return getattr(message, name)
 
-        else:
-            # raise ValueError(f"[swp_massage.decode]: {command} command not yet supported")
-            print(f"[swp_massage.decode]: {command} command not yet supported")
-            return None
+    def __str__(self):
+        message = self.message
+        if message is None:
+            return "[swp_message object]: Command: {} ({}) not supported".format(self.command, self.command_byte)
+        return message.__str__()
 
 
 class Response:
@@ -113,7 +269,7 @@ class Response:
         if response == "ACK":
             self.encoded = bytes(utils.ACK)
         elif response == "NAK":
-            self.encoded = bytes(utils.ACK)
+            self.encoded = bytes(utils.NAK)
         else:
             raise ValueError("[swp_message.Response]: response must be 'ACK' or 'NAK'")
 
@@ -125,6 +281,7 @@ class Response:
         return "[swp_message object]: Command: {}{}".format(self.command.upper(), description)
 
 
+@_decoder("connect")
 class Connect:
     """
     Cross Point Connect message - SWP protocol Command 2 (protocol doc 3.1.3, page 13), issued by controllers.
@@ -168,6 +325,23 @@ class Connect:
         self.command = command
         self.encoded = self._encode()
 
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded Connect (02) or Connected (04) message
+        """
+        return cls._decoded(encoded_message, utils.COMMAND_NAMES[encoded_message[utils.COMMAND_BYTE]])
+
+    @classmethod
+    def _decoded(cls, encoded_message, command):
+        # - Sets the fields from the received message and keeps its bytes, rather than validating & encoding again
+        message = cls.__new__(cls)
+        message.source, message.destination = utils.decode_connect_source_destination(encoded_message)
+        message.matrix, message.level = utils.decode_matrix_level(encoded_message)
+        message.command = command
+        message.encoded = _escaped(encoded_message)
+        return message
+
     def _encode(self):
         matrix_level = utils.encode_matrix_level(self.matrix, self.level)
         multiplier = utils.encode_source_destination_multiplier(self.source, self.destination)
@@ -180,6 +354,7 @@ class Connect:
                                                     self.matrix, self.level, self.source, self.destination, )
 
 
+@_decoder("connected")
 class Connected(Connect):
     def __init__(self, source, destination, matrix=None, level=None):
         if type(source) is Node and type(destination) is Node:
@@ -188,7 +363,15 @@ class Connected(Connect):
         elif type(source) is int and type(destination) is int and type(matrix) is int and type(level) is int:
             super().__init__(source, destination, matrix=matrix, level=level, command='connected')
 
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded Connected (04) message
+        """
+        return cls._decoded(encoded_message, "connected")
+
 
+@_decoder("cross-point tally dump request")
 class GetConnections:
     """
     Cross-point tally dump request - SWP protocol command 21 (protocol doc 3.1.11, page 18)
@@ -207,6 +390,14 @@ class GetConnections:
         self.level = level
         self.encoded = self._encode()
 
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded cross-point tally dump request (21) message
+        """
+        matrix, level = utils.decode_matrix_level(encoded_message)
+        return cls(matrix, level)
+
     def _encode(self):
         matrix_level = utils.encode_matrix_level(self.matrix, self.level)
         data = utils.COMMANDS[self.command], matrix_level
@@ -217,47 +408,258 @@ class GetConnections:
             .format(self.command.upper(), utils.COMMANDS[self.command], self.matrix, self.level)
 
 
-class CrossPointTallyDumpWord:
+@_decoder("source names request", "single source name request")
+class GetSourceNames:
+    """
+    All Source Names Request - SWP protocol command 100, or Single Source Name Request - command 101.
+    The router responds with Source Names Response messages - command 106 (SourceNames).
+    """
+    def __init__(self, matrix, level, char_len=12, source=None):
+        """
+        :param char_len: int - length of the names to respond with, 4, 8, 12, 16 or 32
+        :param source: int - ID of the source for a single name, None for all names
+        """
+        self.command = "source names request" if source is None else "single source name request"
+        self.matrix = matrix
+        self.level = level
+        self.char_len = char_len
+        self.source = source
+        self.encoded = self._encode()
+
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded source names request (100 or 101) message
+        """
+        matrix, level = utils.decode_matrix_level(encoded_message)
+        char_len = utils.CHAR_LENS[encoded_message[utils.CHAR_LEN_BYTE]]
+        source = None
+        if encoded_message[utils.COMMAND_BYTE] == utils.COMMANDS["single source name request"]:
+            source = utils.decode_labels_destination(encoded_message)  # - Same position as for labels
+        return cls(matrix, level, char_len, source)
+
+    def _encode(self):
+        data = [utils.COMMANDS[self.command], utils.encode_matrix_level(self.matrix, self.level),
+                utils.CHAR_LEN_CODES[self.char_len]]
+        if self.source is not None:
+            data += [self.source // 256, self.source % 256]
+        return _format_message(data)
+
+    def __str__(self):
+        return "[swp_message object]: Command: {} ({}), matrix: {}, level: {}, char length: {}{}" \
+            .format(self.command.upper(), utils.COMMANDS[self.command], self.matrix, self.level, self.char_len,
+                    "" if self.source is None else ", source: {}".format(self.source))
+
+
+@_decoder("destination names request", "single destination name request")
+class GetDestinationNames:
+    """
+    All Destination Association Names Request - SWP protocol command 102, or Single Destination Association Name
+    Request - command 103. The router responds with Destination Association Names Response messages - command 107,
+    (PushLabels, the same message controllers push labels with).
+    """
+    def __init__(self, matrix, char_len=12, destination=None):
+        """
+        :param char_len: int - length of the names to respond with, 4, 8, 12, 16 or 32
+        :param destination: int - ID of the destination for a single name, None for all names
+        """
+        self.command = "destination names request" if destination is None else "single destination name request"
+        self.matrix = matrix
+        self.level = 0  # - Destination association names are per matrix
+        self.char_len = char_len
+        self.destination = destination
+        self.encoded = self._encode()
+
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded destination names request (102 or 103) message
+        """
+        matrix, level = utils.decode_matrix_level(encoded_message)
+        char_len = utils.CHAR_LENS[encoded_message[utils.CHAR_LEN_BYTE]]
+        destination = None
+        if encoded_message[utils.COMMAND_BYTE] == utils.COMMANDS["single destination name request"]:
+            destination = utils.decode_labels_destination(encoded_message)
+        return cls(matrix, char_len, destination)
+
+    def _encode(self):
+        data = [utils.COMMANDS[self.command], utils.encode_matrix_level(self.matrix, self.level),
+                utils.CHAR_LEN_CODES[self.char_len]]
+        if self.destination is not None:
+            data += [self.destination // 256, self.destination % 256]
+        return _format_message(data)
+
+    def __str__(self):
+        return "[swp_message object]: Command: {} ({}), matrix: {}, char length: {}{}" \
+            .format(self.command.upper(), utils.COMMANDS[self.command], self.matrix, self.char_len,
+                    "" if self.destination is None else ", destination: {}".format(self.destination))
+
+
+class _CrossPointTallyDump:
+    """
+    Base for Cross-point tally dump messages, (byte and word variants differ in the size of the IDs).
+    These messages only pass the first destination's ID, the number of tallies/connections in the message
+    and source IDs for the given destination and every following consecutive ID'd destination.
+    All destinations and sources are of the same matrix & level.
+    Source IDs are held as a compact array rather than Node objects, the destinations property builds Nodes on demand.
+    """
+    COMMAND = None
+    ID_TYPECODE = None  # - array typecode for the size of the IDs in the message
+    MAX_TALLIES = None
+    MAX_ID = None  # - Highest destination/source ID the message can carry
+
     def __init__(self, destinations):
         """
-        :param destinations: list of up to 64 consecutive ID'd destination Nodes
+        :param destinations: list of up to MAX_TALLIES consecutive ID'd destination Nodes
         (provided by swp_node.get_consecutive_nodes())
         """
-        if len(destinations) > 64:
-            print(f'[{TITLE}.CrossPointTallyDumpWord]: Max number of tallies per message is 64,'
+        if len(destinations) > self.MAX_TALLIES:
+            print(f'[{TITLE}.{type(self).__name__}]: Max number of tallies per message is {self.MAX_TALLIES},'
                   f' {len(destinations)} received')
         else:
-            self.command = "cross-point tally dump (word/extended)"
-            # This message type only passes the first destination's ID, the number of tallies/connections in the message
-            # and source IDs for the given destination and every following consecutive ID'd destination,
-            # up to a max of 64. It assumes all destinations and sources are of the same matrix & level.
-            self.first_destination = destinations[0]
-            self.matrix = self.first_destination.matrix
-            self.level = self.first_destination.level
-            self.sources = swp_node.get_connected_sources(destinations)
-            self.verbose = self._verbose_listing()
-            self.encoded = self._encode()
+            first_destination = destinations[0]
+            self._set_tallies(first_destination.matrix, first_destination.level, first_destination.id,
+                              array('H', swp_node.get_connected_sources(destinations)))
+
+    @classmethod
+    def from_sources(cls, matrix, level, first_destination, sources):
+        """
+        Constructor from IDs, without Node objects
+        :param matrix: int
+        :param level: int
+        :param first_destination: int - ID of the first destination
+        :param sources: iterable of int - IDs of the sources connected to the first and following destinations
+        """
+        message = cls.__new__(cls)
+        message._set_tallies(matrix, level, first_destination, array('H', sources))
+        return message
+
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded cross-point tally dump message
+        """
+        matrix, level = utils.decode_matrix_level(encoded_message)
+        tallies = encoded_message[utils.COMMAND_BYTE + 2]  # Number of connections represented in the message
+        start = utils.COMMAND_BYTE + 3
+        id_size = struct.calcsize(cls.ID_TYPECODE)
+
+        first_destination, = struct.unpack_from('>' + cls.ID_TYPECODE, encoded_message, start)
+        start += id_size
+        sources = _unpack_ids(encoded_message[start: start + tallies * id_size], cls.ID_TYPECODE)
+
+        message = cls.__new__(cls)
+        # - Keeps the received bytes rather than encoding them again
+        message._set_tallies(matrix, level, first_destination, sources, _escaped(encoded_message))
+        return message
+
+    def _set_tallies(self, matrix, level, first_destination, sources, encoded=None):
+        """
+        :param encoded: bytes - the message as sent/received, (default encoded from the other arguments)
+        """
+        if len(sources) > self.MAX_TALLIES:
+            raise ValueError(f'[{TITLE}.{type(self).__name__}]: Max number of tallies per message is '
+                             f'{self.MAX_TALLIES}, {len(sources)} received')
+        if encoded is None and max(first_destination, max(sources, default=0)) > self.MAX_ID:
+            raise ValueError(f'[{TITLE}.{type(self).__name__}]: Destination/source IDs must be 0-{self.MAX_ID}, '
+                             f'use CrossPointTallyDumpWord for higher IDs (e.g. {utils.MUTE_ID} for no connection)')
+        self.command = self.COMMAND
+        self.matrix = matrix
+        self.level = level
+        self.first_destination = first_destination  # - ID of the first destination
+        self.sources = sources  # - array('H') of source IDs, for the first and following consecutive destinations
+        self.encoded = self._encode() if encoded is None else encoded
+
+    @property
+    def verbose(self):
+        """ Listing of the connections, built when printed rather than for every message """
+        return self._verbose_listing()
+
+    @property
+    def destinations(self):
+        """
+        :return: list of destination Nodes, each with its connected source Node
+        """
+        destinations = []
+        for destination_id, source_id in self.connections():
+            destination = Node.destination(self.matrix, self.level, destination_id)
+            destination.connected_source = Node.source(self.matrix, self.level, source_id)
+            destinations.append(destination)
+        return destinations
+
+    def connections(self):
+        """
+        :return: iterator of (destination ID, source ID) tuples
+        """
+        return zip(range(self.first_destination, self.first_destination + len(self.sources)), self.sources)
 
     def _encode(self):
         matrix_level = utils.encode_matrix_level(self.matrix, self.level)
-        data = [utils.COMMANDS[self.command], matrix_level, len(self.sources)]
-        data += utils.div_mod(self.first_destination.id)
-        for source in self.sources:
-            source = utils.div_mod(source)
-            data += source
+        data = bytes([utils.COMMANDS[self.command], matrix_level, len(self.sources)])
+        data += _pack_ids([self.first_destination], self.ID_TYPECODE)
+        data += _pack_ids(self.sources, self.ID_TYPECODE)
         return _format_message(data)
 
     def _verbose_listing(self):
-        r = ''
-        for i, src in enumerate(self.sources):
-            r += f'Destination {self.first_destination.id + i} <- Source {src}\n'
-        return r
+        return ''.join(f'Destination {destination} <- Source {source}\n'
+                       for destination, source in self.connections())
 
     def __str__(self):
         return f'[swp_message object]: command:{self.command}, matrix:{self.matrix}, level:{self.level}, ' \
                f'\nConnections:\n{self.verbose}'
 
 
+@_decoder("cross-point tally dump (byte)")
+class CrossPointTallyDumpByte(_CrossPointTallyDump):
+    """
+    Cross-point tally dump (byte) - SWP protocol command 22 (protocol doc 3.2.10, page 36)
+    For destination/source IDs up to 191, one byte per ID.
+    """
+    COMMAND = "cross-point tally dump (byte)"
+    ID_TYPECODE = 'B'
+    MAX_TALLIES = utils.MAX_DATA_LEN - 4  # - Command, matrix/level, tallies & first destination bytes, then sources
+    MAX_ID = 191
+
+
+@_decoder("cross-point tally dump (word/extended)")
+class CrossPointTallyDumpWord(_CrossPointTallyDump):
+    """
+    Cross-point tally dump (word) - SWP protocol command 23 (protocol doc 3.2.11, page 37)
+    For destination/source IDs up to 65535, two bytes per ID (DIV 256, MOD 256)
+    """
+    COMMAND = "cross-point tally dump (word/extended)"
+    ID_TYPECODE = 'H'
+    MAX_TALLIES = 64
+    MAX_ID = 65535
+
+
+def _unpack_ids(data, typecode):
+    """
+    :param data: bytes - consecutive big-endian IDs of the given size
+    :param typecode: str - 'B' for byte IDs, 'H' for word (2 byte) IDs
+    :return: array('H') of IDs
+    """
+    if typecode == 'B':
+        return array('H', iter(data))
+    ids = array('H', bytes(data))
+    if sys.byteorder == 'little':
+        ids.byteswap()
+    return ids
+
+
+def _pack_ids(ids, typecode):
+    """
+    :param ids: iterable of int
+    :param typecode: str - 'B' for byte IDs, 'H' for word (2 byte) IDs
+    :return: bytes - IDs packed big-endian
+    """
+    ids = array(typecode, ids)
+    if typecode == 'H' and sys.byteorder == 'little':
+        ids.byteswap()
+    return ids.tobytes()
+
+
+@_decoder("push_labels", "push_labels_extended")
 class PushLabels:
     """
     Destination Association Names Response Message - SWP protocol command 107 (protocol doc 3.2.20, page 46).
@@ -274,6 +676,9 @@ class PushLabels:
         :param char_len: int - Length to truncate the labels to; 4, 8, 12, 16, 32 character length labels
                          are supported by the protocol. Calrec has a max len of 12 and will truncate to 12
                          if passed 16 or 32 char length labels.
+        Max labels per message depends on char_len, (utils.max_labels), use PushLabels.bulk() for more.
+        Matrices above 15 are sent as push_labels_extended (235), which has a byte for the matrix rather than
+        sharing it with the level.
         """
         if type(first_destination) is Node:
             # - Note, this message type is only supported for level 0
@@ -297,14 +702,45 @@ class PushLabels:
                             "matrix: {}".format(first_destination, matrix)
             raise ValueError(error_message)
 
-        self.command = "push_labels"
+        self.command = "push_labels_extended" if self.matrix > 15 else "push_labels"
         self.char_len = char_len
         self.labels = utils.set_label_length(labels, self.char_len)
+        if len(self.labels) > utils.max_labels(char_len):
+            raise ValueError("[swp_message.PushLabels]: Max {} labels of {} chars per message, {} passed".format(
+                utils.max_labels(char_len), char_len, len(self.labels)))
         self.encoded = self._encode()
 
+    @classmethod
+    def bulk(cls, labels, matrix=0, char_len=12):
+        """
+        Packs labels into as few messages as possible, one or more per run of consecutive destination IDs
+        :param labels: dict - {destination ID: label}
+        :return: list of PushLabels
+        """
+        destinations = sorted(labels)
+        return [cls(run[0], [labels[d] for d in run], matrix, char_len)
+                for run in swp_node.iter_consecutive_runs(destinations, utils.max_labels(char_len))]
+
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded push labels (107) or push labels extended (235) message
+        """
+        destination = utils.decode_labels_destination(encoded_message)
+        if encoded_message[utils.COMMAND_BYTE] == utils.COMMANDS["push_labels_extended"]:
+            matrix = encoded_message[utils.MATRIX_LEVEL_BYTE]
+        else:
+            matrix, level = utils.decode_matrix_level(encoded_message)
+        labels = utils.get_labels(encoded_message)
+        char_len = utils.CHAR_LENS[encoded_message[utils.CHAR_LEN_BYTE]]
+        return cls(destination, labels, matrix, char_len)
+
     def _encode(self):
         labels = utils.format_labels(self.labels)
-        matrix_level = utils.encode_matrix_level(self.matrix, self.level)
+        if self.command == "push_labels_extended":
+            matrix_level = self.matrix
+        else:
+            matrix_level = utils.encode_matrix_level(self.matrix, self.level)
         data = [utils.COMMANDS[self.command], matrix_level, utils.CHAR_LEN_CODES[self.char_len],
                 int(self.destination / 256), self.destination % 256, len(self.labels)] + labels
         return _format_message(data)
@@ -315,13 +751,66 @@ class PushLabels:
                     self.matrix, self.level, self.destination, self.labels)
 
 
+@_decoder("source names")
+class SourceNames:
+    """
+    Source Names Response - SWP protocol command 106, sent by the router in response to a source names request.
+    Same layout as PushLabels (107), with the names of consecutive sources on a matrix & level.
+    """
+    def __init__(self, first_source, names, matrix=0, level=0, char_len=12):
+        """
+        :param first_source: int - ID of the source for the first name
+        :param names: list of strings - one per consecutive source, up to utils.max_labels(char_len)
+        """
+        self.command = "source names"
+        self.source = first_source
+        self.matrix = matrix
+        self.level = level
+        self.char_len = char_len
+        self.labels = utils.set_label_length(names, char_len)
+        if len(self.labels) > utils.max_labels(char_len):
+            raise ValueError("[swp_message.SourceNames]: Max {} names of {} chars per message, {} passed".format(
+                utils.max_labels(char_len), char_len, len(self.labels)))
+        self.encoded = self._encode()
+
+    @classmethod
+    def bulk(cls, names, matrix=0, level=0, char_len=12):
+        """
+        :param names: dict - {source ID: name}
+        :return: list of SourceNames, as few as possible, one or more per run of consecutive source IDs
+        """
+        return [cls(run[0], [names[s] for s in run], matrix, level, char_len)
+                for run in swp_node.iter_consecutive_runs(sorted(names), utils.max_labels(char_len))]
+
+    @classmethod
+    def from_bytes(cls, encoded_message):
+        """
+        :param encoded_message: bytes - validated encoded source names response (106) message
+        """
+        matrix, level = utils.decode_matrix_level(encoded_message)
+        char_len = utils.CHAR_LENS[encoded_message[utils.CHAR_LEN_BYTE]]
+        return cls(utils.decode_labels_destination(encoded_message), utils.get_labels(encoded_message),
+                   matrix, level, char_len)
+
+    def _encode(self):
+        data = [utils.COMMANDS[self.command], utils.encode_matrix_level(self.matrix, self.level),
+                utils.CHAR_LEN_CODES[self.char_len], self.source // 256, self.source % 256, len(self.labels)]
+        return _format_message(data + utils.format_labels(self.labels))
+
+    def __str__(self):
+        return "[swp_message_object]: Command: {} ({}), matrix: {}, level: {}, first source: {}, name/s: {}" \
+            .format(self.command.upper(), utils.COMMANDS[self.command],
+                    self.matrix, self.level, self.source, self.labels)
+
+
 # TEST FUNCTIONS
 
 def test_connect():
     # - Proven connect message for matrix 0, level 0, source 0, destination 1
     test_results = [b'\x10\x02\x02\x00\x00\x01\x00\x05\xf8\x10\x03',
-                    # - Proven connect message for matrix 2, level 3, source 100, destination 200
-                    b'\x10\x02\x02#\x10Hd\x05\x1a\x10\x03',
+                    # - Proven connect message for matrix 2, level 3, source 100, destination 200,
+                    # - (multiplier byte is DLE so is escaped)
+                    b'\x10\x02\x02#\x10\x10Hd\x05\x1a\x10\x03',
                     # - Proven connect message for matrix 2, Level 3, source: 300, destination: 999,
                     b'\x10\x02\x02#rg,\x05\xd1\x10\x03']
 
@@ -383,10 +872,114 @@ def test_push_labels():
             print("Test Push Labels {}: FAIL".format(i + 1))
 
 
+def test_decode():
+    # - Decoding encoded messages should return an object of the right class that encodes back to the same bytes
+    test_messages = [Connect(0, 1, 0, 0),
+                     Connected(10, 0, matrix=0, level=0),
+                     GetConnections(2, 3),
+                     CrossPointTallyDumpWord([Node.destination(1, 2, 300), Node.destination(1, 2, 301)]),
+                     CrossPointTallyDumpWord.from_sources(1, 2, 300, [16, 1023, 4096]),
+                     CrossPointTallyDumpByte.from_sources(0, 0, 5, [1, 2, 191]),
+                     PushLabels(0, ["one", "two", "three"], matrix=0, char_len=8),
+                     GetSourceNames(1, 2, char_len=8),
+                     GetSourceNames(1, 2, char_len=4, source=300),
+                     GetDestinationNames(3),
+                     GetDestinationNames(3, char_len=16, destination=16),
+                     SourceNames(256, ["Mic 1", "Mic 2"], matrix=1, level=2, char_len=12)]
+
+    for i, message in enumerate(test_messages):
+        decoded = decode(message.encoded)
+        if type(decoded) is type(message) and decoded.encoded == message.encoded:
+            print("Test Decode {}: PASS".format(i + 1))
+        else:
+            print("Test Decode {}: FAIL".format(i + 1))
+
+    # - A tally dump received unescaped, (as returned by swp_unpack), keeps its bytes as sent
+    message = CrossPointTallyDumpWord.from_sources(1, 2, 300, [16, 1023, 4096])
+    if decode(_unescaped(message.encoded)).encoded == message.encoded:
+        print("Test Decode {}: PASS".format(len(test_messages) + 1))
+    else:
+        print("Test Decode {}: FAIL".format(len(test_messages) + 1))
+
+    # - IDs too high for a byte tally dump, (e.g. MUTE_ID), are refused with a ValueError rather than mis-encoded
+    try:
+        CrossPointTallyDumpByte.from_sources(0, 0, 5, [1, utils.MUTE_ID])
+        print("Test Decode {}: FAIL".format(len(test_messages) + 2))
+    except ValueError:
+        print("Test Decode {}: PASS".format(len(test_messages) + 2))
+
+
+def test_push_labels_bulk():
+    # - 25 labels, 12 chars so 10 per message, over 2 runs of consecutive destinations.
+    # - Matrix 20 needs the extended message
+    labels = {d: "CH {}".format(d) for d in list(range(20)) + list(range(300, 305))}
+    messages = PushLabels.bulk(labels, matrix=20, char_len=12)
+    decoded = [decode(m.encoded) for m in messages]
+
+    passed = [(m.destination, len(m.labels)) for m in decoded] == [(0, 10), (10, 10), (300, 5)] \
+        and all(m.command == "push_labels_extended" and m.matrix == 20 for m in decoded) \
+        and decoded[2].labels[4].strip() == "CH 304" and PushLabels.bulk(labels)[0].command == "push_labels"
+    try:
+        PushLabels(0, ["x"] * 11, char_len=12)
+        passed = False
+    except ValueError:
+        pass
+
+    if passed:
+        print("Test Push Labels Bulk: PASS")
+    else:
+        print("Test Push Labels Bulk: FAIL")
+
+
+def test_lazy_message():
+    # - Header fields should be available without decoding, other fields and str should match the decoded message
+    message = Connect(Node.source(2, 3, 300), Node.destination(2, 3, 999))
+    lazy = LazyMessage(message.encoded)
+    header_ok = (lazy.command, lazy.matrix, lazy.level) == ("connect", 2, 3) and not lazy._decoded
+    fields_ok = (lazy.source, lazy.destination) == (300, 999) and lazy.__str__() == message.__str__()
+    ack = LazyMessage(bytes(utils.ACK))
+
+    if header_ok and fields_ok and ack.command == "ACK":
+        print("Test Lazy Message: PASS")
+    else:
+        print("Test Lazy Message: FAIL")
+
+
+def test_frame_writer():
+    # - Messages with DLE values in the data, byte count & checksum, written beyond the initial capacity,
+    # - should parse back to the same messages as sent
+    messages = [Connect(Node.source(1, 0, 16), Node.destination(1, 0, 16 + 128 * i)) for i in range(8)]
+    messages += [PushLabels(16, ["DLE" + chr(16) * 4] * 3, 0, 4)]
+    writer = FrameWriter(capacity=16)
+    writer.extend(messages)
+    writer.append(utils.ACK)
+    writer.append_payload([2, 0x10, 0, 16, 16])  # - Command + data bytes of messages[0]
+    sent = writer.getvalue()
+
+    a, b = socket.socketpair()
+    sent_ok = writer.flush(a) == len(sent) and not len(writer) and not writer.frames
+    received = b.recv(len(sent) + 1)
+    a.close()
+    b.close()
+
+    parsed = swp_unpack.SwpStreamParser().feed(received)
+    expected = [m.encoded for m in messages] + [bytes(utils.ACK), messages[0].encoded]
+    decoded_ok = [decode(e).encoded for e in parsed] == expected
+
+    if sent_ok and received == sent and len(parsed) == 11 and decoded_ok:
+        print("Test Frame Writer: PASS")
+    else:
+        print("Test Frame Writer: FAIL")
+
+
 if __name__ == '__main__':
     cli_utils.print_header(TITLE, VERSION)
     print("Tests...")
     test_connect()
     test_connected()
     test_push_labels()
+    test_decode()
+    test_push_labels_bulk()
+    test_lazy_message()
+    test_frame_writer()
 
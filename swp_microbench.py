@@ -0,0 +1,310 @@
+# - Micro-benchmarks for the SWP08/Probel codec & parser hot paths
+# - Times each benchmark on synthetic inputs and compares with the stored baselines (swp_microbench_baselines.json),
+# - failing any that are slower than the baseline by more than the threshold.
+#
+# - Usage:
+# -   python swp_microbench.py                  (compare with the baselines, exits with 1 if any regressed)
+# -   python swp_microbench.py --filter decode  (only benchmarks with 'decode' in their name)
+# -   python swp_microbench.py --update         (re-record the baselines, e.g. after an optimisation, or on a
+# -                                              different machine as timings are machine dependent)
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+import cli_utils
+import swp_message
+import swp_utils
+from crosspoint_table import CrosspointTable
+from import_io import import_io_from_csv
+from io_catalogue import IOCatalogue
+from router_emulator import TallyDumpCache
+from swp_node import Node, get_consecutive_nodes
+from swp_unpack import unpack_data
+
+TITLE = "SWP Micro-benchmarks"
+VERSION = 0.1
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "swp_microbench_baselines.json")
+DEFAULT_THRESHOLD = 0.3  # - Fail if more than 30% slower than the baseline
+DEFAULT_REPEAT = 7  # - Best of
+MESSAGE_QTY = 1000  # - Number of messages in the synthetic inputs
+NODE_QTY = 5000  # - Number of nodes for get_consecutive_nodes & rows for import_io_from_csv
+CHUNK_SIZES = (16, 256, 4096, 65536)
+SEED = 0
+
+BENCHMARKS = {}  # - name: setup function returning (function to time, number of operations per call), optionally
+                 # - followed by a function to clean up after timing, (e.g. remove temporary files)
+
+
+def _benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# - SYNTHETIC INPUTS - #
+def _messages(command, qty=MESSAGE_QTY, seed=SEED):
+    """
+    :param command: str - "connect", "connected", "push_labels", "tally_dump_byte" or "tally_dump_word"
+    :return: list of swp_message objects with random IDs
+    """
+    rand = random.Random(seed)
+    if command in ("connect", "connected"):
+        message_class = swp_message.Connect if command == "connect" else swp_message.Connected
+        return [message_class(rand.randrange(1024), rand.randrange(1024), rand.randrange(16), rand.randrange(16))
+                for _ in range(qty)]
+    if command == "push_labels":
+        return [swp_message.PushLabels(rand.randrange(1000), ["LBL{:05}".format(rand.randrange(99999))
+                                                              for _ in range(rand.randint(1, 15))],
+                                       rand.randrange(16), 8)
+                for _ in range(qty)]
+    if command == "tally_dump_byte":
+        return [swp_message.CrossPointTallyDumpByte.from_sources(0, 0, rand.randrange(64),
+                                                                 [rand.randrange(192) for _ in range(64)])
+                for _ in range(qty)]
+    return [swp_message.CrossPointTallyDumpWord.from_sources(0, 0, rand.randrange(960),
+                                                             [rand.randrange(1024) for _ in range(64)])
+            for _ in range(qty)]
+
+
+def _stream():
+    """
+    :return: bytes - a received data stream, ACKs and a mix of message types, as a router might send
+    """
+    messages = []
+    for i, command in enumerate(("connected", "push_labels", "tally_dump_word", "connected")):
+        messages += [m.encoded for m in _messages(command, MESSAGE_QTY // 4, SEED + i)]
+    random.Random(SEED).shuffle(messages)
+    return swp_utils.ACK.join(messages)
+
+
+def _payloads(qty=MESSAGE_QTY):
+    """
+    :return: list of lists of ints - random command + data bytes, 3 to 128 long
+    """
+    rand = random.Random(SEED)
+    return [[rand.randrange(256) for _ in range(rand.randint(3, swp_utils.MAX_DATA_LEN))] for _ in range(qty)]
+
+
+def _write_csv(filename, rows=NODE_QTY):
+    """ Writes a Calrec VPB format CSV with rows alternately sources & destinations """
+    fields = ["Virtual Patchbay Name", "Patch Point Number", "Patch Point Default Label",
+              "EDIT Patch Point User Label", "EDIT Patch Point Description",
+              "EDIT In SW-P-08 Matrix", "EDIT In SW-P-08 Level", "EDIT In SW-P-08 ID",
+              "EDIT Out SW-P-08 Matrix", "EDIT Out SW-P-08 Level", "EDIT Out SW-P-08 ID", "Checksum"]
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for i in range(rows):
+            swp = [1, 1, i // 2 + 1]
+            line = ["VPB-{}".format(i // 64 + 1), i % 64 + 1, "VPB-{}".format(i), "label{}".format(i), ""]
+            line += (swp + ["", "", ""]) if i % 2 else (["", "", ""] + swp)
+            writer.writerow(line + [hashlib.md5(str(line).encode()).hexdigest()])
+
+
+# - BENCHMARKS - #
+def _unpack_setup(chunk_size):
+    def setup():
+        data = _stream()
+        chunks = [data[i: i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+        def run():
+            residual = False
+            for chunk in chunks:
+                messages, residual = unpack_data(chunk, residual)
+        return run, data.count(swp_utils.ACK) + 1
+    return setup
+
+
+for _size in CHUNK_SIZES:
+    _benchmark("unpack_data chunk {}".format(_size))(_unpack_setup(_size))
+
+
+def _decode_setup(command):
+    def setup():
+        encoded = [m.encoded for m in _messages(command)]
+
+        def run():
+            for e in encoded:
+                swp_message.decode(e)
+        return run, len(encoded)
+    return setup
+
+
+for _command in ("connect", "connected", "push_labels", "tally_dump_byte", "tally_dump_word"):
+    _benchmark("decode {}".format(_command))(_decode_setup(_command))
+
+
+@_benchmark("_format_message")
+def _format_message_setup():
+    payloads = _payloads()
+
+    def run():
+        for payload in payloads:
+            swp_message._format_message(payload)
+    return run, len(payloads)
+
+
+@_benchmark("FrameWriter salvo")
+def _frame_writer_setup():
+    # - Connects appended into one reused buffer, as sent with a single sendall
+    messages = _messages("connect")
+    writer = swp_message.FrameWriter()
+
+    def run():
+        writer.clear()
+        writer.extend(messages)
+        writer.getvalue()
+    return run, len(messages)
+
+
+@_benchmark("tally dump response")
+def _tally_dump_response_setup():
+    # - Emulator's response to a tally dump request of a full level, with a crosspoint changed between requests
+    io = IOCatalogue(destinations=[Node.destination(0, 0, i) for i in range(1023)])
+    crosspoints = CrosspointTable()
+    cache = TallyDumpCache(io, crosspoints)
+    rand = random.Random(SEED)
+    changes = [(rand.randrange(1023), rand.randrange(1023)) for _ in range(MESSAGE_QTY)]
+
+    def run():
+        for destination, source in changes:
+            crosspoints.connect(0, 0, destination, source)
+            cache.mark(0, 0, destination)
+            cache.response(0, 0)
+    return run, len(changes)
+
+
+@_benchmark("calculate_checksum")
+def _checksum_setup():
+    payloads = _payloads()
+
+    def run():
+        for payload in payloads:
+            swp_utils.calculate_checksum(payload)
+    return run, len(payloads)
+
+
+@_benchmark("twos_compliment")
+def _twos_compliment_setup():
+    values = list(range(0, 256 * swp_utils.MAX_DATA_LEN, 7))
+
+    def run():
+        for value in values:
+            swp_utils.twos_compliment(value)
+    return run, len(values)
+
+
+@_benchmark("get_consecutive_nodes")
+def _consecutive_nodes_setup():
+    # - IDs with random gaps, shuffled, plus nodes on another matrix & level to filter out
+    rand = random.Random(SEED)
+    ids = [i for i in range(NODE_QTY * 2) if rand.random() > 0.1][:NODE_QTY]
+    nodes = [Node.destination(1, 1, i) for i in ids] + [Node.destination(2, 1, i) for i in range(NODE_QTY // 10)]
+    rand.shuffle(nodes)
+
+    def run():
+        get_consecutive_nodes(nodes, 1, 1)
+    return run, len(nodes)
+
+
+@_benchmark("import_io_from_csv")
+def _import_io_setup():
+    directory = tempfile.TemporaryDirectory()
+    csv_file = os.path.join(directory.name, "bench.csv")
+    _write_csv(csv_file)
+
+    def run():
+        import_io_from_csv(csv_file, use_cache=False)
+    return run, NODE_QTY, directory.cleanup
+
+
+def time_benchmark(name, repeat=DEFAULT_REPEAT):
+    """
+    :return: float - best time per operation in microseconds
+    """
+    run, operations, *cleanup = BENCHMARKS[name]()
+    try:
+        timer = timeit.Timer(run)
+        number, _ = timer.autorange()
+        return 1e6 * min(timer.repeat(repeat, number)) / number / operations
+    finally:
+        for function in cleanup:
+            function()
+
+
+def load_baselines(filename=BASELINES_FILE):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"threshold": DEFAULT_THRESHOLD, "benchmarks": {}}
+
+
+def save_baselines(baselines, filename=BASELINES_FILE):
+    with open(filename, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the SWP08 codec & parser")
+    parser.add_argument("--filter", default="", help="only run benchmarks with this in their name")
+    parser.add_argument("--update", action="store_true", help="record the results as the new baselines")
+    parser.add_argument("--threshold", type=float, help="max fractional slowdown vs baseline, (default from the "
+                                                        "baselines file, or {})".format(DEFAULT_THRESHOLD))
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--baselines", default=BASELINES_FILE)
+    options = parser.parse_args(args)
+
+    baselines = load_baselines(options.baselines)
+    threshold = options.threshold if options.threshold is not None else baselines.get("threshold",
+                                                                                    DEFAULT_THRESHOLD)
+    failed = []
+    print("{:<28}{:>14}{:>14}{:>10}".format("benchmark", "baseline us/op", "current us/op", "change"))
+    for name in BENCHMARKS:
+        if options.filter not in name:
+            continue
+        current = time_benchmark(name, options.repeat)
+        baseline = baselines["benchmarks"].get(name)
+        if options.update:
+            current = min(current, time_benchmark(name, options.repeat))
+            baselines["benchmarks"][name] = round(current, 4)
+
+        if baseline and not options.update and (current - baseline) / baseline > threshold:
+            # - Timed again before failing, so a one-off slow run (e.g. other load on the machine) isn't a failure
+            current = min(current, time_benchmark(name, options.repeat))
+
+        if baseline:
+            change = (current - baseline) / baseline
+            if options.update:
+                result = "UPDATED"
+            elif change > threshold:
+                result = "FAIL"
+                failed.append(name)
+            else:
+                result = "PASS"
+            print("{:<28}{:>14.3f}{:>14.3f}{:>+9.1f}% {}".format(name, baseline, current, 100 * change, result))
+        else:
+            print("{:<28}{:>14}{:>14.3f}".format(name, "-", current))
+
+    if options.update:
+        baselines.setdefault("threshold", threshold)
+        save_baselines(baselines, options.baselines)
+        print("Baselines saved to", options.baselines)
+    elif failed:
+        print("\n{} benchmark/s slower than baseline by more than {:.0f}%: {}".format(len(failed), 100 * threshold,
+                                                                                    ", ".join(failed)))
+    return failed
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    sys.exit(1 if main() else 0)
@@ -82,48 +82,39 @@ def get_by_matrix_level(matrix, level, nodes):
     return r
 
 
+def iter_consecutive_runs(items, max_run=64):
+    """
+    Groups IDs or Nodes into runs of consecutive IDs, in a single pass and without modifying the input.
+    Runs are split where IDs are not consecutive, in the order given, so pass sorted IDs/Nodes
+    (e.g. IOCatalogue.ids()) to get the fewest runs.
+    :param items: iterable of int IDs or Node objects
+    :param max_run: int, max length of a run (max tally qty in a tally dump message is 64)
+    :return: generator of lists of consecutive IDs/Nodes
+    """
+    run = []
+    previous = None
+    for item in items:
+        item_id = getattr(item, 'id', item)
+        if run and (item_id != previous + 1 or len(run) == max_run):
+            yield run
+            run = []
+        run.append(item)
+        previous = item_id
+    if run:
+        yield run
+
+
 def get_consecutive_nodes(nodes, matrix=1, level=1, max_set_size=64):
     """
     Splits a list of nodes into lists of nodes with consecutive IDs for a given matrix & level
-    :param nodes: list of Node objects
+    :param nodes: list of Node objects (not modified)
     :param matrix: int
     :param level: int
     :param max_set_size: int, limit max size of the node lists (max tally qty in a tally dump message is 64)
     :return: list of lists of sorted consecutive nodes
     """
-    nodes = get_by_matrix_level(matrix, level, nodes)
-    r = []
-    l = []
-    # Sort node list by their ids (the lambda is equivalent of `def get_id(node): return node.id`
-    nodes.sort(key=lambda n: n.id)
-    # Split single node list into lists of nodes with consecutive IDs
-
-    for n in range(len(nodes)):
-        try:
-            # Check if nodes have consecutive ids
-            if nodes[n+1].id - nodes[n].id == 1:
-                # Check if already added (to add first entry in new list)
-                if nodes[n] not in l:
-                    l.append(nodes[n])
-                # Add the next one
-                l.append(nodes[n + 1])
-
-            else:
-                l = set_max_list_len(l, max_set_size)
-                for i in l:
-                    r.append(i)
-                l = []
-        except IndexError:
-            pass
-
-    l = set_max_list_len(l, max_set_size)
-    for i in l:
-        r.append(i)
-    return r
-
-
-def set_max_list_len(node_list, max_len):
-    return [node_list[i * max_len:(i + 1) * max_len] for i in range((len(node_list) + max_len - 1) // max_len)]
+    nodes = sorted(get_by_matrix_level(matrix, level, nodes), key=lambda n: n.id)
+    return list(iter_consecutive_runs(nodes, max_set_size))
 
 
 def get_connected_sources(destination_list):
@@ -140,9 +131,25 @@ def get_connected_sources(destination_list):
     return r
 
 
+def test_consecutive_runs():
+    ids = [100, 1, 2, 99, 50, 4, 98, 101, 5, 7, 6, 49, 51, 10]
+    nodes = [Node.destination(1, 1, i) for i in ids]
+    runs = get_consecutive_nodes(nodes)
+
+    passed = [[n.id for n in run] for run in runs] == [[1, 2], [4, 5, 6, 7], [10], [49, 50, 51], [98, 99, 100, 101]] \
+        and [n.id for n in nodes] == ids \
+        and [len(run) for run in iter_consecutive_runs(range(200))] == [64, 64, 64, 8]
+
+    if passed:
+        print("TEST CONSECUTIVE RUNS: PASS")
+    else:
+        print("TEST CONSECUTIVE RUNS: FAIL")
+
+
 if __name__ == '__main__':
 
     cli_utils.print_header(TITLE, VERSION)
+    test_consecutive_runs()
 
     source = Node.source(1, 2, 3, "group label", "channel label", "node label", "user label")
     destination = Node.destination(4, 5, 6, "group label", "channel label", "node label", "user label")
@@ -0,0 +1,387 @@
+# - Pipelined sending of SWP08/Probel messages
+# - Routers ACK/NAK messages in the order they are received, so rather than waiting for the ACK of each message
+# - before sending the next, up to a window of messages can be in flight, with each ACK/NAK matched to the
+# - oldest message awaiting one. NAK'd or timed out messages are resent, up to the max send attempts.
+# - ACK/NAKs carry no ID and the router applies messages in the order received, so a NAK or timeout resends the
+# - failed message and every message sent after it, in their original order, (go-back-N). Otherwise e.g. a NAK'd
+# - Connect resent after a later Connect to the same destination would leave the earlier source connected.
+#
+# - AckWindow does the bookkeeping only, (no sockets, threads or clocks), so the same logic is used by the
+# - threaded PipelinedSender below, (client_connection.py), and by swp_async_client.py.
+
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+import cli_utils
+import swp_message
+import swp_utils
+
+TITLE = "SWP Pipeline"
+VERSION = 0.1
+DEFAULT_WINDOW = 8  # - Max messages sent but not yet ACK'd
+
+
+class SendError(Exception):
+    """ A message was not acknowledged by the router """
+
+
+class NakError(SendError):
+    """ The router NAK'd the last attempt to send the message """
+
+
+class AckTimeout(SendError):
+    """ No ACK/NAK was received for the last attempt to send the message """
+
+
+class Frame:
+    """ A message submitted to an AckWindow """
+    __slots__ = ("message", "encoded", "future", "attempts", "sent_at")
+
+    def __init__(self, message, future=None):
+        """
+        :param message: bytes or swp_message object
+        :param future: concurrent.futures.Future or asyncio.Future to resolve with True on ACK, or set with
+                       the SendError if never ACK'd
+        """
+        self.message = message
+        self.encoded = message if type(message) is bytes else message.encoded
+        self.future = future
+        self.attempts = 0
+        self.sent_at = None
+
+    def _resolve(self, error=None):
+        if self.future is None or self.future.done():
+            return
+        if error:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(True)
+
+
+class AckWindow:
+    """
+    Tracks messages waiting to be sent and messages in flight.
+    The caller writes the frames returned by to_send(), passes every ACK/NAK received to on_response(), and calls
+    expire() when next_deadline() is reached. Times are whatever clock the caller uses, in seconds.
+    """
+    def __init__(self, window=DEFAULT_WINDOW, ack_timeout=swp_utils.ACK_TIMEOUT,
+                 max_send_attempts=swp_utils.MAX_SEND_ATTEMPTS):
+        """
+        :param window: int - max messages in flight, (1 to send and wait for each ACK in turn)
+        :param ack_timeout: float - seconds to wait for an ACK/NAK before resending
+        :param max_send_attempts: int - number of times to send a message before failing it
+        """
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.max_send_attempts = max_send_attempts
+        self._waiting = collections.deque()  # - Frames to send, (resends go to the front)
+        self._in_flight = collections.deque()  # - Frames sent, in the order sent
+        self.stale = 0  # - ACK/NAKs still due for sends abandoned by a go-back-N resend, ignored when received
+
+    def __len__(self):
+        return len(self._waiting) + len(self._in_flight)
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def submit(self, message, future=None):
+        """
+        :param message: bytes or swp_message object
+        :param future: optional future to resolve once ACK'd or failed
+        :return: Frame
+        """
+        frame = Frame(message, future)
+        self._waiting.append(frame)
+        return frame
+
+    def to_send(self, now):
+        """
+        :return: list of Frames to write now, (moved in flight, up to the window size)
+        """
+        frames = []
+        while self._waiting and len(self._in_flight) < self.window:
+            frame = self._waiting.popleft()
+            frame.attempts += 1
+            frame.sent_at = now
+            self._in_flight.append(frame)
+            frames.append(frame)
+        return frames
+
+    def on_response(self, response):
+        """
+        Matches an ACK/NAK to the oldest frame in flight. A NAK'd frame and those sent after it are queued to be
+        resent next, the responses still due for those sent after it are then ignored.
+        :param response: bytes - swp_utils.ACK or swp_utils.NAK
+        :return: the Frame if ACK'd or failed, else None, (also None for an ACK/NAK with nothing in flight, or
+                 for a stale response)
+        """
+        if self.stale:
+            self.stale -= 1
+            return None
+        if not self._in_flight:
+            return None
+        frame = self._in_flight.popleft()
+        if response == swp_utils.ACK:
+            frame._resolve()
+            return frame
+        failed = self._go_back(frame, NakError)
+        return failed[0] if failed else None
+
+    def expire(self, now):
+        """
+        If the oldest frame in flight has waited longer than ack_timeout, it and every frame sent after it are
+        queued to be resent. Late responses to the abandoned sends are ignored, (responses still due from an
+        earlier timeout are then assumed lost). A frame timed out on its last attempt is assumed never to get a
+        response.
+        :return: list of Frames failed on their last attempt
+        """
+        if not self._in_flight or self._in_flight[0].sent_at + self.ack_timeout > now:
+            return []
+        return self._go_back(self._in_flight.popleft(), AckTimeout)
+
+    def next_deadline(self):
+        """
+        :return: time the oldest frame in flight times out, None if nothing in flight
+        """
+        if self._in_flight:
+            return self._in_flight[0].sent_at + self.ack_timeout
+        return None
+
+    def fail_all(self, error):
+        """
+        Fails every waiting & in flight frame, e.g. when the connection is lost
+        :param error: Exception to set on the frames' futures
+        :return: list of the failed Frames
+        """
+        frames = list(self._in_flight) + list(self._waiting)
+        self._in_flight.clear()
+        self._waiting.clear()
+        self.stale = 0
+        for frame in frames:
+            frame._resolve(error)
+        return frames
+
+    def _go_back(self, frame, error_class):
+        # - Requeues the frame, (unless out of attempts), then the rest in flight, in their original order ahead of
+        # - those not yet sent. Frames sent after it are requeued without using up an attempt, as they weren't
+        # - failed. Sets stale to the responses still due for the abandoned sends: those sent after the frame,
+        # - plus the frame itself if it timed out and is to be resent, (a late response). Returns the failed frames
+        failed = []
+        resend = list(self._in_flight)
+        self._in_flight.clear()
+        self.stale = len(resend)
+        for later in resend:
+            later.attempts -= 1
+        if frame.attempts < self.max_send_attempts:
+            resend.insert(0, frame)
+            if error_class is AckTimeout:
+                self.stale += 1
+        else:
+            frame._resolve(error_class("[{}]: {} after {} attempts".format(
+                TITLE, "NAK'd" if error_class is NakError else "No ACK", frame.attempts)))
+            failed.append(frame)
+        self._waiting.extendleft(reversed(resend))
+        return failed
+
+
+class PipelinedSender:
+    """
+    Threaded wrapper of AckWindow for socket connections with a receive thread (client_connection.py).
+    submit() returns a concurrent.futures.Future, the receive thread passes ACK/NAKs to on_response(),
+    and a timer thread (started on first use) resends timed out frames.
+    """
+    def __init__(self, write, window=DEFAULT_WINDOW, ack_timeout=swp_utils.ACK_TIMEOUT,
+                 max_send_attempts=swp_utils.MAX_SEND_ATTEMPTS):
+        """
+        :param write: function taking bytes to send, raising OSError on failure
+        """
+        self._write = write
+        self.window = AckWindow(window, ack_timeout, max_send_attempts)
+        self._condition = threading.Condition()
+        self._timer = None
+
+    def submit(self, message):
+        """
+        :param message: bytes or swp_message object
+        :return: concurrent.futures.Future - result True once ACK'd, or raises SendError / ConnectionError
+        """
+        return self.submit_many([message])[0]
+
+    def submit_many(self, messages):
+        """
+        Submits all the messages before sending, so those that fit in the window are written in one call
+        :param messages: iterable of bytes or swp_message objects
+        :return: list of concurrent.futures.Future, one per message as per submit()
+        """
+        futures = []
+        with self._condition:
+            for message in messages:
+                future = Future()
+                self.window.submit(message, future)
+                futures.append(future)
+            self._send()
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._run)
+                self._timer.daemon = True
+                self._timer.start()
+            self._condition.notify()
+        return futures
+
+    def on_response(self, response):
+        """
+        :param response: bytes - ACK or NAK received
+        :return: bool - True if matched to a message in flight, False if unsolicited
+        """
+        with self._condition:
+            if not self.window.in_flight and not self.window.stale:
+                return False
+            self.window.on_response(response)
+            self._send()
+            self._condition.notify()
+            return True
+
+    def fail_all(self, error):
+        with self._condition:
+            self.window.fail_all(error)
+
+    def _send(self):
+        # - Call with the condition held. Frames sent together are written in one call
+        frames = self.window.to_send(time.monotonic())
+        if frames:
+            try:
+                self._write(b''.join(frame.encoded for frame in frames))
+            except OSError as e:
+                self.window.fail_all(ConnectionError("[{}]: Failed to send, error: {}".format(TITLE, e)))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = self.window.next_deadline()
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                self._condition.wait(timeout)
+                self.window.expire(time.monotonic())
+                self._send()
+
+
+def test_ack_window():
+    window = AckWindow(window=2, ack_timeout=1, max_send_attempts=2)
+    futures = [Future() for _ in range(4)]
+    for i, future in enumerate(futures):
+        window.submit(bytes([i]), future)
+
+    sent = [f.encoded for f in window.to_send(0)]
+    window.on_response(swp_utils.ACK)  # - 0 ACK'd
+    window.on_response(swp_utils.NAK)  # - 1 NAK'd, resent next
+    sent += [f.encoded for f in window.to_send(0.5)]
+    window.expire(2)  # - 1 times out and is out of attempts, 2 was sent after it so goes back to be resent
+    sent += [f.encoded for f in window.to_send(2)]
+    window.on_response(swp_utils.ACK)  # - Late response to the first send of 2, ignored, (1 is assumed unanswered)
+    window.on_response(swp_utils.ACK)
+    window.on_response(swp_utils.ACK)
+
+    passed = sent == [b'\x00', b'\x01', b'\x01', b'\x02', b'\x02', b'\x03'] \
+        and futures[0].result() and isinstance(futures[1].exception(), AckTimeout) \
+        and futures[2].result() and futures[3].result() and not len(window) \
+        and window.on_response(swp_utils.ACK) is None
+
+    if passed:
+        print("TEST ACK WINDOW: PASS")
+    else:
+        print("TEST ACK WINDOW: FAIL")
+
+
+def test_go_back_n():
+    # - Two Connects to the same destination in flight, the first NAK'd. Both are resent in order so the router
+    # - ends up with the second's source
+    window = AckWindow(window=4)
+    futures = [Future(), Future()]
+    first = swp_message.Connect(1, 5, 0, 0)
+    second = swp_message.Connect(2, 5, 0, 0)
+    window.submit(first, futures[0])
+    window.submit(second, futures[1])
+
+    sent = window.to_send(0)
+    window.on_response(swp_utils.NAK)
+    sent += window.to_send(0)
+    for _ in range(3):
+        window.on_response(swp_utils.ACK)  # - The first is the response to the first send of second, ignored
+
+    router = {}
+    for frame in sent:
+        router[frame.message.destination] = frame.message.source
+    passed = [f.message for f in sent] == [first, second, first, second] and router[5] == 2 \
+        and all(f.result() for f in futures) and not len(window) and not window.stale
+
+    if passed:
+        print("TEST GO BACK N: PASS")
+    else:
+        print("TEST GO BACK N: FAIL")
+
+
+def _run_window(window, frame_qty, unanswered):
+    # - Sends frame_qty frames through the window to a simulated router that ACKs each frame sent except those
+    # - in unanswered, one second per round trip. Returns the futures' results, (exception class if failed)
+    futures = [Future() for _ in range(frame_qty)]
+    for i, future in enumerate(futures):
+        window.submit(bytes([i]), future)
+    now = 0
+    while len(window) and now < 100:
+        responses = [swp_utils.ACK for frame in window.to_send(now) if frame.encoded[0] not in unanswered]
+        for response in responses:
+            window.on_response(response)
+        now += 1
+        window.expire(now)
+    return [type(f.exception()) if f.exception() else f.result() for f in futures]
+
+
+def test_unanswered():
+    # - A frame the router never responds to fails, without the responses to frames sent after it being taken as
+    # - stale, (which would fail every frame from then on)
+    window = AckWindow(window=4, ack_timeout=1, max_send_attempts=2)
+    passed = _run_window(window, 1, {0}) == [AckTimeout] and _run_window(window, 3, ()) == [True] * 3 \
+        and not window.stale
+
+    # - Unanswered in the middle of a pipelined batch, only one frame fails, (ACKs carry no ID, so which one is
+    # - down to the window), and later batches are unaffected
+    window = AckWindow(window=4, ack_timeout=1, max_send_attempts=2)
+    results = _run_window(window, 8, {2})
+    passed = passed and results.count(AckTimeout) == 1 and results.count(True) == 7 and not window.stale \
+        and _run_window(window, 8, ()) == [True] * 8
+    results = _run_window(AckWindow(window=1, ack_timeout=1, max_send_attempts=2), 8, {2})
+    passed = passed and results == [True, True, AckTimeout] + [True] * 5
+
+    if passed:
+        print("TEST UNANSWERED: PASS")
+    else:
+        print("TEST UNANSWERED: FAIL")
+
+
+def test_pipelined_sender():
+    written = []
+    sender = PipelinedSender(written.append, window=4, ack_timeout=0.1, max_send_attempts=2)
+    futures = [sender.submit(bytes([i])) for i in range(6)]
+    passed = len(written) == 4  # - Window full
+    for _ in range(6):
+        sender.on_response(swp_utils.ACK)
+    nak = sender.submit(b'\xff')
+    batch = PipelinedSender(written.append, window=3).submit_many([b'\x01', b'\x02', b'\x03', b'\x04'])
+
+    passed = passed and all(f.result(timeout=1) for f in futures) and b''.join(written[:6]) == bytes(range(6)) \
+        and isinstance(nak.exception(timeout=1), AckTimeout) and written[-3:] == [b'\xff', b'\x01\x02\x03', b'\xff'] \
+        and len(batch) == 4 and not any(f.done() for f in batch)
+
+    if passed:
+        print("TEST PIPELINED SENDER: PASS")
+    else:
+        print("TEST PIPELINED SENDER: FAIL")
+
+
+if __name__ == '__main__':
+    cli_utils.print_header(TITLE, VERSION)
+    test_ack_window()
+    test_go_back_n()
+    test_unanswered()
+    test_pipelined_sender()
@@ -26,6 +26,11 @@ EOM = [DLE, 3]  # - SWP message end ("End of Message")
 ACK = bytes([DLE, 6])  # - Acknowledged message returned by router on receipt of a valid message.
 NAK = bytes([DLE, 21])  # - Not Acknowledged message returned by router on receipt of an invalid message.
 
+MAX_DATA_LEN = 128  # - Max size of DATA (command byte + payload) guaranteed to work with all systems
+
+ACK_TIMEOUT = 3  # - Seconds to wait for an ACK/NAK before resending a message
+MAX_SEND_ATTEMPTS = 5  # - Number of send/resend to attempt until ACK received
+
 COMMAND_BYTE = 2  # - Command type is the 3rd byte of any SWP message other than ACK/NAK (first byte after SOM)
 MATRIX_LEVEL_BYTE = 3  # - For Connect, Connected, Push Labels, Push Labels Extended (+ others)
 SOURCE_BYTE = 6  # - For Connect & Connected messages
@@ -39,6 +44,11 @@ COMMANDS = {"connect": 2,  # Send to router to make a connection.
             "connected": 4,  # Received from router when a connection is made.
             "push_labels": 107,
             "push_labels_extended": 235,
+            "source names request": 100,  # - All source names
+            "single source name request": 101,
+            "destination names request": 102,  # - All destination association names
+            "single destination name request": 103,
+            "source names": 106,  # - Source names response, (push_labels is the destination names response)
             "cross-point tally dump request": 21,
             "cross-point tally dump (byte)": 22,
             "cross-point tally dump (word/extended)": 23,
@@ -47,6 +57,17 @@ COMMANDS = {"connect": 2,  # Send to router to make a connection.
 # LABEL MESSAGE LENGTH CODES, keys - num chars, values - coded value
 CHAR_LEN_CODES = {4: 0, 8: 1, 12: 2, 16: 3, 32: 4}
 
+# - Reverse lookups, built once - command byte value to command name, and length code to num chars
+COMMAND_NAMES = {value: name for name, value in COMMANDS.items()}
+CHAR_LENS = {code: char_len for char_len, code in CHAR_LEN_CODES.items()}
+
+# - Lookup tables for decoding header bytes, indexed by byte value (0-255), built once
+# - Matrix/level byte (protocol doc 3.1.2): bits 4-7 matrix, bits 0-3 level
+MATRIX_LEVEL_TABLE = tuple((value >> 4, value & 0x0F) for value in range(256))
+# - Multiplier byte (protocol doc 3.1.2): bits 0-2 source DIV 128, bits 4-6 destination DIV 128.
+# - Table values are what to add to the source & destination bytes, (multiplier * 128)
+MULTIPLIER_TABLE = tuple(((value & 0x07) << 7, ((value >> 4) & 0x07) << 7) for value in range(256))
+
 
 def format_timestamp(t):
     # takes a datetime.datetime object and returns as formatted string
@@ -89,17 +110,13 @@ def encode_matrix_level(matrix, level):
     :param level: int
     :return: int representing matrix and level
     """
-    if matrix not in range(16) or level not in range(16):
+    if not (0 <= matrix < 16 and 0 <= level < 16):
         error_message = "[swp_utils.encode_matrix_level]: Matrix and level need to be within range 0 to 15, " \
                         "values passed - matrix: {}, level: {}" \
             .format(matrix, level)
         raise ValueError(error_message)
 
-    # - Convert values to 4 bit binary
-    matrix = format(matrix, '04b')
-    level = format(level, '04b')
-    # - Concatenate to 8 bits and return as decimal int
-    return int(matrix + level, 2)
+    return matrix << 4 | level
 
 
 def encode_source_destination_multiplier(source, destination):
@@ -110,79 +127,49 @@ def encode_source_destination_multiplier(source, destination):
     :param destination: int in range 0-1023
     :return: int, decimal, encoded multiplier for the given source and destination IDs
     """
-    if source not in range(1024) or destination not in range(1024):
+    if not (0 <= source < 1024 and 0 <= destination < 1024):
         error_message = "[swp_utils.encode_source_destination_multiplier]: Source and destination IDs must be in range 0 to 1023, " \
                         "\n\tReceived Source: {}, Destination: {}".format(source, destination)
         raise ValueError(error_message)
 
-    bit7 = '0'
-    bit3 = '0'
-    # - Multiplier values are source/dest DIV 128
-    # - Using format to convert dec values to binary padded to 3 bits
-    bits4_6 = format(int(destination / 128), '03b')
-    bits0_3 = format(int(source / 128), '03b')
-    binary_num = '0b' + bit7 + bits4_6 + bit3 + bits0_3
-    return int(binary_num, 2)
+    # - Multiplier values are source/dest DIV 128, destination in bits 4-6, source in bits 0-2
+    return (destination >> 7) << 4 | source >> 7
 
 
 def decode_matrix_level(msg):
-    d = msg[MATRIX_LEVEL_BYTE]
-    d = format(d, '08b')  # converted to 8bit binary
-    matrix = d[:4]  # - 4 MSBs (bits 4-7)
-    level = d[4:]  # - 4 LSBs (bits 0-3)
-    matrix = int(matrix, 2)
-    level = int(level, 2)
-    return matrix, level
+    """
+    :param msg: bytes - encoded message
+    :return: int, int - matrix, level
+    """
+    return MATRIX_LEVEL_TABLE[msg[MATRIX_LEVEL_BYTE]]
 
 
 def calculate_checksum(data):
     """
         Calculates and returns a checksum for an SWP08 message.
-        :param data: list of byte values that make up the message payload
+        :param data: list of byte values (or bytes / bytearray / memoryview slice) that make up the message payload
             [command byte, data byte 1, ... , data byte n, byte-count byte]
         :return: int - decimal value of checksum for data
     """
-    checksum = 0
-    for value in data:
-        checksum += value
-
-    return twos_compliment(checksum)
+    # - 8 bit two's complement of the sum
+    return -sum(data) & 0xFF
 
 
 def is_checksum_valid(message):
-    message = message[2: -2]  # - Strip SOM & EOM
-    message_checksum = message[-1]  # - Last byte
-    message = message[:-1]  # - Strip checksum
-    # need to pass list of bytes to calculate_checksum, not byte string
-    payload = [b for b in message]  # - Bytes from bytestring to list of bytes
-    compare_checksum = calculate_checksum(payload)
-
-    if message_checksum == compare_checksum:
-        return True
-    else:
-        return False
+    """
+    :param message: bytes - encoded message, SOM + DATA + BTC + CHK + EOM (DLE's not escaped)
+    :return: bool
+    """
+    # - The checksum is the two's complement of the sum of DATA & BTC, so adding it on gives 0 (in 8 bits)
+    return sum(message[2: -2]) & 0xFF == 0
 
 
 def twos_compliment(value):
     """
     :param value: int (decimal)
-    :return: int - decimal two's compliment of the received value
+    :return: int - decimal two's compliment of the received value, (8 bit)
     """
-    # - https://stackoverflow.com/questions/16926130/convert-to-binary-and-keep-leading-zeros
-    # - https://docs.python.org/2/library/string.html#format-specification-mini-language
-    # - Convert to 8 bit binary value
-    value = format(value, '08b')
-    # - Invert the bits
-    value = ''.join('1' if x == '0' else '0' for x in value)
-    # - Add one, as per two's compliment
-    value = int(value, 2) + 1
-
-    # - If result is larger than 1 byte...
-    if value > 255:
-        value = bin(value)[-8:]  # - Convert to binary and take the last 8 bits
-        value = int(value, 2)  # - Convert back to decimal int
-
-    return value
+    return -value & 0xFF
 
 
 def set_label_length(labels, length):
@@ -208,6 +195,15 @@ def set_label_length(labels, length):
         return fixed_len
 
 
+def max_labels(char_len):
+    """
+    :param char_len: int - number of chars per label, 4, 8, 12, 16 or 32
+    :return: int - max labels that fit in one push labels message, (DATA is max MAX_DATA_LEN bytes, including the
+             command & header bytes before the first label)
+    """
+    return (MAX_DATA_LEN - (FIRST_LABEL_CHAR_BYTE - len(SOM))) // char_len
+
+
 def format_labels(labels):
     """
     :param labels: List of strings
@@ -226,15 +222,8 @@ def decode_connect_source_destination(encoded_message):
     :param encoded_message: bytes - valid encoded SWP message
     :return: int, int - source ID, destination ID
     """
-    source = encoded_message[SOURCE_BYTE]
-    destination = encoded_message[DESTINATION_BYTE]
-    # - Converted byte to 8 bit binary string using format
-    multiplier = format(encoded_message[MULTIPLIER_BYTE], '08b')
-    source_multiplier = multiplier[-3:]  # - bits 0-2 (3 LSBs)
-    dest_multiplier = multiplier[-7:-4]  # - bits 4-6
-    source += int(source_multiplier, 2) * 128
-    destination += int(dest_multiplier, 2) * 128
-    return source, destination
+    source_offset, destination_offset = MULTIPLIER_TABLE[encoded_message[MULTIPLIER_BYTE]]
+    return encoded_message[SOURCE_BYTE] + source_offset, encoded_message[DESTINATION_BYTE] + destination_offset
 
 
 def decode_labels_destination(msg):
@@ -254,15 +243,13 @@ def get_labels(msg):
     :return: list of strings - labels
     """
     label_qty = msg[LABEL_QTY_BYTE]
-    char_len = list(CHAR_LEN_CODES.keys())[list(CHAR_LEN_CODES.values()).index(msg[CHAR_LEN_BYTE])]
+    char_len = CHAR_LENS[msg[CHAR_LEN_BYTE]]
     labels = []
     i = FIRST_LABEL_CHAR_BYTE
     for _ in range(label_qty):
-        label = ''
-        for letter in range(char_len):
-            label += chr(msg[i])
-            i += 1
-        labels.append(label)
+        # - latin-1 maps each byte straight to the char of the same value
+        labels.append(bytes(msg[i: i + char_len]).decode('latin-1'))
+        i += char_len
 
     #print("DEBUG CHAR LEN:", char_len)
     #print("DEBUG LABEL QTY:", label_qty)
@@ -292,10 +279,32 @@ def match_source(msg, sources):
 
 
 def div_mod(value, factor=256):
-    return int(value / factor), value % factor
+    return divmod(value, factor)
+
+
+def test_codec():
+    # - Round trip every matrix/level & every source/destination multiplier, and checksums against
+    # - the protocol doc's definition, (two's complement of the sum, 8 bit)
+    passed = all(MATRIX_LEVEL_TABLE[encode_matrix_level(m, l)] == (m, l) for m in range(16) for l in range(16))
+
+    for source in range(0, 1024, 7):
+        for destination in range(0, 1024, 11):
+            msg = bytes([DLE, 2, 2, 0, encode_source_destination_multiplier(source, destination),
+                         destination % 128, source % 128])
+            passed = passed and decode_connect_source_destination(msg) == (source, destination)
+
+    payload = [2, 0, 0, 0x10, 0x03, 5]
+    passed = passed and calculate_checksum(payload) == 0xE6 and twos_compliment(0) == 0 \
+        and twos_compliment(0x1FF) == 1 and is_checksum_valid(bytes(SOM + payload + [0xE6] + EOM))
+
+    if passed:
+        print("TEST CODEC: PASS")
+    else:
+        print("TEST CODEC: FAIL")
 
 
 if __name__ == '__main__':
     cli_utils.print_header(TITLE, VERSION)
     print("Tests...")
     test_get_labels()
+    test_codec()